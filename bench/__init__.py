@@ -0,0 +1,22 @@
+"""Benchmarks for python-lounge.
+
+From the top of the tree:
+
+	python -m bench run -o before.json            # everything
+	python -m bench run -k prefs -k path          # just the names matching these
+	python -m bench run --quick                   # fewer iterations, for a smoke test
+	python -m bench compare before.json after.json
+
+Microbenchmarks (bench.micro) time hot paths in a loop: record creation,
+validation, view row access, selectors, ShardMap and Prefs lookups.
+Macrobenchmarks (bench.macro) drive lounge.client against a FakeLounge
+running in a child process and report throughput and latency percentiles
+for finds, saves, views and bulk requests.
+
+Results are written as JSON.  compare lines up two runs and flags every
+benchmark that got slower by more than the threshold (10% by default),
+exiting with status 1 if any did, so it can gate a change.
+
+The *_bench.py scripts in this directory are standalone before/after
+comparisons for particular optimizations; run them from bench/.
+"""
@@ -0,0 +1,50 @@
+"""Command line for the benchmark suite; see bench/__init__.py."""
+
+import optparse
+import sys
+
+from bench import runner
+# register the benchmarks
+import bench.micro
+import bench.macro
+
+def main(argv):
+	usage = "usage: python -m bench run [options]\n       python -m bench compare OLD.json NEW.json [--threshold T]"
+	parser = optparse.OptionParser(usage=usage)
+	parser.add_option("-o", "--output", help="write the results to this JSON file")
+	parser.add_option("-k", dest="patterns", action="append", default=[],
+		help="only run benchmarks whose names match this regular expression (repeatable)")
+	parser.add_option("--quick", action="store_true", help="fewer and shorter runs, for a smoke test")
+	parser.add_option("--repeat", type="int", default=5, help="timing runs per microbenchmark [%default]")
+	parser.add_option("--min-time", type="float", default=0.2, help="seconds per microbenchmark timing run [%default]")
+	parser.add_option("--scale", type="int", default=1, help="multiply the macrobenchmark workloads by this [%default]")
+	parser.add_option("--threshold", type="float", default=0.1,
+		help="with compare, the fraction slower that counts as a regression [%default]")
+	options, args = parser.parse_args(argv[1:])
+	if not args or args[0] not in ("run", "compare"):
+		parser.error("expected run or compare")
+
+	if args[0] == "run":
+		run_options = {'repeat': options.repeat, 'min_time': options.min_time, 'scale': options.scale}
+		if options.quick:
+			run_options.update({'repeat': 1, 'min_time': 0.01})
+		results = runner.run(options.patterns, run_options)
+		if options.output:
+			runner.save(results, options.output)
+		return 0
+
+	if len(args) != 3:
+		parser.error("compare needs two result files")
+	old, new = runner.load(args[1]), runner.load(args[2])
+	rows = runner.compare(old, new, options.threshold)
+	print "%-40s %10s %10s %8s" % ("", "old", "new", "new/old")
+	for name, before, after, ratio, verdict in rows:
+		print "%-40s %10s %10s %7.2fx %s" % (name, runner.format_seconds(before), runner.format_seconds(after), ratio, verdict.upper())
+	regressions = [row for row in rows if row[4] == 'slower']
+	if regressions:
+		print "\n%d of %d benchmarks got more than %d%% slower" % (len(regressions), len(rows), options.threshold * 100)
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+"""Macrobenchmarks: lounge.client against a FakeLounge in a child process.
+
+The server runs in its own process so that it doesn't compete with the
+client for the interpreter lock.
+"""
+
+import os
+import signal
+import time
+
+from lounge import client
+from lounge.client import BulkDocView, Database, DesignDoc, Document, LoungeError, Resource, View
+from lounge.fakelounge import FakeLounge
+
+from bench.runner import benchmark, latency_result
+
+class BenchDoc(Document):
+	db_name = "macrobench"
+
+VIEW_MAP = "def fun(doc):\n\tyield doc['group'], doc['n']"
+
+class _Server(object):
+	"""A FakeLounge in a forked child, with the client pointed at it."""
+	def __init__(self, shards=8):
+		r, w = os.pipe()
+		self.pid = os.fork()
+		if self.pid == 0:
+			try:
+				os.close(r)
+				fake = FakeLounge(shards=shards).start()
+				os.write(w, "%d\n" % fake.port)
+				while True:
+					time.sleep(3600)
+			finally:
+				os._exit(0)
+		os.close(w)
+		port = int(os.read(r, 32))
+		os.close(r)
+		self.url = "http://127.0.0.1:%d/" % port
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.url, ''
+		Database.create(BenchDoc.db_name)
+
+	def close(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		os.kill(self.pid, signal.SIGTERM)
+		os.waitpid(self.pid, 0)
+
+def _measure(operations):
+	"""Run each callable in operations, timing each one."""
+	latencies = []
+	errors = 0
+	start = time.time()
+	for operation in operations:
+		op_start = time.time()
+		try:
+			operation()
+		except LoungeError:
+			errors += 1
+			continue
+		latencies.append(time.time() - op_start)
+	return latency_result(latencies, time.time() - start, errors)
+
+def _with_server(f):
+	"""Run f(options, count) against a fresh server."""
+	def run(options):
+		server = _Server()
+		try:
+			return f(options, 200 * options['scale'])
+		finally:
+			server.close()
+	return run
+
+def _create_docs(count):
+	for i in xrange(count):
+		BenchDoc.create("doc%d" % i, group=i % 10, n=i, payload="x" * 200)
+
+@benchmark("macro.create", kind='macro')
+@_with_server
+def create(options, count):
+	return _measure([lambda i=i: BenchDoc.create("doc%d" % i, group=i % 10, n=i, payload="x" * 200)
+		for i in xrange(count)])
+
+@benchmark("macro.find", kind='macro')
+@_with_server
+def find(options, count):
+	_create_docs(count)
+	return _measure([lambda i=i: BenchDoc.find("doc%d" % i) for i in xrange(count)])
+
+@benchmark("macro.update", kind='macro')
+@_with_server
+def update(options, count):
+	_create_docs(count)
+	docs = [BenchDoc.find("doc%d" % i) for i in xrange(count)]
+	def save(doc):
+		doc.n += 1
+		doc.save()
+	return _measure([lambda doc=doc: save(doc) for doc in docs])
+
+@benchmark("macro.view", kind='macro')
+@_with_server
+def view(options, count):
+	_create_docs(count)
+	DesignDoc.create(BenchDoc.db_name, "bench", language="python", views={"by_group": {"map": VIEW_MAP}})
+	return _measure([lambda i=i: View.execute(BenchDoc.db_name, "bench/by_group", args={"key": i % 10, "include_docs": True})
+		for i in xrange(count)])
+
+@benchmark("macro.bulk_fetch_50", kind='macro')
+@_with_server
+def bulk_fetch(options, count):
+	_create_docs(count)
+	batches = [["doc%d" % ((i * 50 + j) % count) for j in range(50)] for i in xrange(count / 10)]
+	return _measure([lambda keys=keys: BulkDocView.fetch(BenchDoc.db_name, keys) for keys in batches])
+
+@benchmark("macro.bulk_save_100", kind='macro')
+@_with_server
+def bulk_save(options, count):
+	url = client.db_connectinfo + BenchDoc.db_name + "/_bulk_docs"
+	def save(i):
+		docs = [{"_id": "bulk%d-%d" % (i, j), "group": j % 10, "n": j, "payload": "x" * 200} for j in range(100)]
+		Resource()._request('POST', url, body={"docs": docs})
+	return _measure([lambda i=i: save(i) for i in xrange(count / 10)])
@@ -0,0 +1,136 @@
+"""Microbenchmarks for the client, ShardMap and Prefs hot paths."""
+
+import os
+import tempfile
+try:
+	import simplejson as json
+except ImportError:
+	import json
+
+from lounge import ShardMap
+from lounge.client import Document, TuplyDict, ViewRow, ViewRows, get_path, set_path
+from lounge.client.schema import Field, ListOf
+from lounge.client.validations import ensure_all, exists, is_type, min_length, max_length
+from lounge.prefs import Prefs
+
+from bench.runner import benchmark
+
+class BenchDoc(Document):
+	db_name = "bench"
+	defaults = {"tags": [], "profile": {}}
+
+class ValidatedDoc(Document):
+	db_name = "bench"
+	_schema = {
+		"name": Field(basestring, required=True, min_length=1, max_length=64),
+		"age": Field(int, min=0, max=200),
+		"tags": ListOf(Field(basestring, max_length=16)),
+	}
+	validate_email = ensure_all("email", exists, (is_type, basestring), (min_length, 3), (max_length, 128))
+
+def _temp_file(contents, suffix):
+	fd, path = tempfile.mkstemp(suffix=suffix)
+	f = os.fdopen(fd, "w")
+	f.write(contents)
+	f.close()
+	return path
+
+def _shard_map(shards=64, nodes=8):
+	config = {
+		"shard_map": [[i % nodes, (i + 1) % nodes] for i in range(shards)],
+		"nodes": [["node%d.example.com" % i, 5984] for i in range(nodes)],
+	}
+	path = _temp_file(json.dumps(config), ".conf")
+	try:
+		return ShardMap(path)
+	finally:
+		os.unlink(path)
+
+@benchmark("client.resource_new")
+def resource_new():
+	return lambda: BenchDoc.new("key", name="kevin", age=25)
+
+@benchmark("client.document_validate")
+def document_validate():
+	# make sure the schema is really checked, or this measures nothing
+	assert not ValidatedDoc.new("bad", name="", age=-1, email="kevin@example.com").validate()
+	doc = ValidatedDoc.new("key", name="kevin", age=25, tags=["a", "b", "c"], email="kevin@example.com")
+	assert doc.validate()
+	return doc.validate
+
+@benchmark("client.tuplydict_access")
+def tuplydict_access():
+	row = TuplyDict({"id": "doc1", "key": ["user", 1], "value": 1})
+	def access():
+		row[0]
+		row[1]
+		row["id"]
+	return access
+
+@benchmark("client.viewrow_access")
+def viewrow_access():
+	row = ViewRow({"id": "doc1", "key": ["user", 1], "value": 1})
+	def access():
+		row[0]
+		row[1]
+		row["id"]
+	return access
+
+@benchmark("client.viewrows_iterate_1k")
+def viewrows_iterate():
+	rows = ViewRows([{"id": "doc%d" % i, "key": ["user", i], "value": i} for i in xrange(1000)])
+	def iterate():
+		for key, value in rows:
+			pass
+	return iterate
+
+@benchmark("client.get_path")
+def get_path_bench():
+	rec = {"profile": {"emails": [{"address": "a@example.com"}], "name": "kevin"}}
+	return lambda: get_path(rec, "profile.emails[0].address")
+
+@benchmark("client.set_path")
+def set_path_bench():
+	rec = {"profile": {"emails": [{"address": "a@example.com"}], "name": "kevin"}}
+	return lambda: set_path(rec, "profile.emails[0].address", "b@example.com")
+
+@benchmark("shardmap.shards")
+def shardmap_shards():
+	shard_map = _shard_map()
+	return lambda: shard_map.shards("userinfo")
+
+@benchmark("shardmap.nodes")
+def shardmap_nodes():
+	shard_map = _shard_map()
+	shard = shard_map.shards("userinfo")[17]
+	return lambda: shard_map.nodes(shard)
+
+@benchmark("shardmap.primary_shards")
+def shardmap_primary_shards():
+	shard_map = _shard_map()
+	return lambda: shard_map.primary_shards("userinfo")
+
+def _prefs(sections=500):
+	lines = ['<?xml version="1.0"?>', '<pref name="/">']
+	for i in range(sections):
+		lines.append('<pref name="section%d">' % i)
+		lines.append('<pref name="port" type="int" value="%d"/>' % (8000 + i))
+		lines.append('<pref name="enabled" type="bool" value="1"/>')
+		lines.append('<pref name="hosts" type="stringlist"><item value="a"/><item value="b"/></pref>')
+		lines.append('</pref>')
+	lines.append('</pref>')
+	path = _temp_file("\n".join(lines), ".xml")
+	try:
+		return Prefs(path)
+	finally:
+		os.unlink(path)
+
+@benchmark("prefs.get_pref")
+def prefs_get_pref():
+	prefs = _prefs()
+	return lambda: prefs.get_pref("/section250/port")
+
+@benchmark("prefs.get_pref_unnormalized")
+def prefs_get_pref_unnormalized():
+	prefs = _prefs()
+	return lambda: prefs.get_pref("x/section250/*/ignored")
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""Compare loading a big prefs file with minidom against the streaming parser.
+
+Each parser runs in a forked child so its peak RSS can be measured on its own.
+
+Usage: cd bench ; python prefs_parse_bench.py [number of prefs]
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import time
+from xml.dom.minidom import parse
+
+sys.path = ['..'] + sys.path
+
+from lounge.prefs import Prefs
+
+def write_prefs(n):
+	fd, path = tempfile.mkstemp(suffix=".xml")
+	f = os.fdopen(fd, "w")
+	f.write('<?xml version="1.0"?>\n<pref name="/">\n')
+	for i in xrange(n / 10):
+		f.write('\t<pref name="section%d">\n' % i)
+		for j in range(3):
+			f.write('\t\t<pref name="int%d" type="int" value="%d"/>\n' % (j, i * j))
+			f.write('\t\t<pref name="flag%d" type="bool" value="%d"/>\n' % (j, j % 2))
+			f.write('\t\t<pref name="name%d" type="string" value="section %d name %d"/>\n' % (j, i, j))
+		f.write('\t\t<pref name="hosts" type="stringlist">\n')
+		for j in range(4):
+			f.write('\t\t\t<item value="host%d.example.com"/>\n' % j)
+		f.write('\t\t</pref>\n\t</pref>\n')
+	f.write('</pref>\n')
+	f.close()
+	return path
+
+def measure(load):
+	"""Run load() in a child; return (seconds, peak RSS in MB)."""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		start = time.time()
+		kept = load()
+		elapsed = time.time() - start
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+		os.write(w, "%f %f" % (elapsed, rss))
+		os._exit(0)
+	os.close(w)
+	result = os.read(r, 100)
+	os.close(r)
+	os.waitpid(pid, 0)
+	return [float(x) for x in result.split()]
+
+def main(n=200000):
+	path = write_prefs(n)
+	try:
+		size = os.path.getsize(path) / 1e6
+		baseline = measure(lambda: None)
+		minidom = measure(lambda: parse(path))
+		streaming = measure(lambda: Prefs(path))
+		print "%d prefs, %.1f MB file" % (n, size)
+		print "%-20s %10s %14s" % ("", "parse", "RSS over base")
+		print "%-20s %9.2fs %12.1fMB" % ("minidom tree", minidom[0], minidom[1] - baseline[1])
+		print "%-20s %9.2fs %12.1fMB" % ("Prefs (expat)", streaming[0], streaming[1] - baseline[1])
+	finally:
+		os.unlink(path)
+
+if __name__ == "__main__":
+	n = 200000
+	if len(sys.argv) > 1:
+		n = int(sys.argv[1])
+	main(n)
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""Compare constructing Prefs with and without the parsed-prefs cache.
+
+Each case runs in a freshly forked child, the way a cron script would start.
+
+Usage: cd bench ; python prefs_startup_bench.py [number of prefs] [runs]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path = ['..'] + sys.path
+
+from lounge.prefs import Prefs
+from prefs_parse_bench import write_prefs
+
+def startup(make_prefs):
+	"""Time make_prefs() in a child; return seconds."""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		start = time.time()
+		make_prefs()
+		os.write(w, "%f" % (time.time() - start))
+		os._exit(0)
+	os.close(w)
+	result = os.read(r, 100)
+	os.close(r)
+	os.waitpid(pid, 0)
+	return float(result)
+
+def best(make_prefs, runs):
+	return min([startup(make_prefs) for i in range(runs)])
+
+def main(n=20000, runs=5):
+	path = write_prefs(n)
+	cache_dir = tempfile.mkdtemp()
+	try:
+		parse = best(lambda: Prefs(path), runs)
+		# the first run fills the cache
+		Prefs(path, cache_dir=cache_dir)
+		cached = best(lambda: Prefs(path, cache_dir=cache_dir), runs)
+		print "%d prefs, %.1f MB file, best of %d" % (n, os.path.getsize(path) / 1e6, runs)
+		print "%-20s %9.3fs" % ("parse", parse)
+		print "%-20s %9.3fs" % ("cache_dir", cached)
+	finally:
+		os.unlink(path)
+		shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+	args = [int(a) for a in sys.argv[1:3]]
+	main(*args)
@@ -0,0 +1,173 @@
+"""Timing, registration and result files for the benchmark suite."""
+
+import gc
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+try:
+	import simplejson as json
+except ImportError:
+	import json
+
+from lounge import percentile
+
+# name -> (function, kind); see benchmark()
+registry = {}
+
+def benchmark(name, kind='micro'):
+	"""Register a benchmark.
+
+	A micro benchmark is a function taking no arguments that sets up and
+	returns the callable to time.  A macro benchmark takes the options dict
+	and returns its own result dict (see latency_result).
+	"""
+	def register(f):
+		registry[name] = (f, kind)
+		return f
+	return register
+
+def time_loop(f, number):
+	"""Seconds to call f number times, with the garbage collector off like timeit."""
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		start = time.time()
+		for i in xrange(number):
+			f()
+		return time.time() - start
+	finally:
+		if gc_was_enabled:
+			gc.enable()
+
+def calibrate(f, min_time):
+	"""How many calls of f take at least min_time seconds."""
+	number = 1
+	while True:
+		if time_loop(f, number) >= min_time or number >= 10 ** 7:
+			return number
+		number *= 10
+
+def run_micro(setup, options):
+	random.seed(0)
+	f = setup()
+	number = calibrate(f, options['min_time'])
+	times = sorted([time_loop(f, number) / number for i in range(options['repeat'])])
+	return {
+		'kind': 'micro',
+		'unit': 's/op',
+		'value': times[0],
+		'median': percentile(times, 50),
+		'number': number,
+		'repeat': options['repeat'],
+	}
+
+def latency_result(latencies, elapsed, errors=0):
+	"""The result of a macro benchmark from per-operation latencies in seconds."""
+	latencies = sorted(latencies)
+	return {
+		'kind': 'macro',
+		'unit': 's/op',
+		# the p50 is what compare looks at
+		'value': percentile(latencies, 50),
+		'p95': percentile(latencies, 95),
+		'p99': percentile(latencies, 99),
+		'mean': latencies and sum(latencies) / len(latencies) or None,
+		'ops': len(latencies),
+		'errors': errors,
+		'throughput': elapsed and len(latencies) / elapsed or None,
+	}
+
+def git_revision():
+	try:
+		p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out = p.communicate()[0].strip()
+		if p.returncode == 0:
+			return out
+	except OSError:
+		pass
+	return None
+
+def run(patterns=(), options=None):
+	"""Run the registered benchmarks whose names match any of patterns (all, if none)."""
+	defaults = {'min_time': 0.2, 'repeat': 5, 'scale': 1}
+	options = dict(defaults, **(options or {}))
+	results = {}
+	for name in sorted(registry):
+		if patterns and not [p for p in patterns if re.search(p, name)]:
+			continue
+		f, kind = registry[name]
+		if kind == 'micro':
+			results[name] = run_micro(f, options)
+		else:
+			random.seed(0)
+			results[name] = f(options)
+		print >>sys.stderr, "%-40s %s" % (name, format_result(results[name]))
+	return {
+		'meta': {
+			'time': time.time(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'revision': git_revision(),
+			'options': options,
+		},
+		'results': results,
+	}
+
+def format_seconds(value):
+	if value is None:
+		return "-"
+	for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+		if value >= scale:
+			return "%.2f%s" % (value / scale, unit)
+	return "%.0fns" % (value / 1e-9)
+
+def format_result(result):
+	if result['kind'] == 'micro':
+		return "%s/op" % format_seconds(result['value'])
+	s = "p50 %s  p95 %s  p99 %s" % tuple([format_seconds(result[k]) for k in ('value', 'p95', 'p99')])
+	if result['throughput']:
+		s += "  %.0f ops/s" % result['throughput']
+	if result['errors']:
+		s += "  %d errors" % result['errors']
+	return s
+
+def save(results, path):
+	f = open(path, 'w')
+	try:
+		json.dump(results, f, indent=1, sort_keys=True)
+	finally:
+		f.close()
+
+def load(path):
+	f = open(path)
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def compare(old, new, threshold=0.1):
+	"""Line up the results of two runs.
+
+	Returns a list of (name, old value, new value, ratio, verdict) for the
+	benchmarks in both, where verdict is 'slower' if new is more than
+	threshold worse than old, 'faster' if it's that much better, and ''
+	otherwise.
+	"""
+	rows = []
+	old_results, new_results = old['results'], new['results']
+	for name in sorted(set(old_results) & set(new_results)):
+		before, after = old_results[name]['value'], new_results[name]['value']
+		if not before or after is None:
+			continue
+		ratio = after / before
+		verdict = ''
+		if ratio > 1 + threshold:
+			verdict = 'slower'
+		elif ratio < 1 - threshold:
+			verdict = 'faster'
+		rows.append((name, before, after, ratio, verdict))
+	return rows
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""Compare validate_ helpers against a compiled schema on a wide document.
+
+Usage: cd bench ; python schema_bench.py [number of fields]
+"""
+
+import sys
+import timeit
+
+sys.path = ['..'] + sys.path
+
+from lounge.client import Document
+from lounge.client.schema import Field, ListOf
+from lounge.client.validations import ensure_all, exists, is_type, max_length, min_length, min_int, max_int, each
+
+def make_classes(width):
+	helpers = {'db_name': 'bench'}
+	schema = {}
+	for i in range(width):
+		if i % 3 == 0:
+			helpers['validate_s%d' % i] = ensure_all('s%d' % i, exists,
+				(is_type, basestring), (min_length, 1), (max_length, 64))
+			schema['s%d' % i] = Field(basestring, required=True, min_length=1, max_length=64)
+		elif i % 3 == 1:
+			helpers['validate_i%d' % i] = ensure_all('i%d' % i, exists,
+				(is_type, int), (min_int, 0), (max_int, 1000))
+			schema['i%d' % i] = Field(int, required=True, min=0, max=1000)
+		else:
+			helpers['validate_l%d' % i] = each('l%d' % i, max_length, 16)
+			schema['l%d' % i] = ListOf(Field(basestring, max_length=16))
+	Helpers = type('Helpers', (Document,), helpers)
+	Schema = type('Schema', (Document,), {'db_name': 'bench', '_schema': schema})
+	return Helpers, Schema
+
+def make_record(width):
+	rec = {}
+	for i in range(width):
+		if i % 3 == 0:
+			rec['s%d' % i] = 'value %d' % i
+		elif i % 3 == 1:
+			rec['i%d' % i] = i
+		else:
+			rec['l%d' % i] = ['a', 'b', 'c', 'd']
+	return rec
+
+def main(width=300, number=200):
+	Helpers, Schema = make_classes(width)
+	rec = make_record(width)
+	helpers_doc = Helpers.new('wide', **rec)
+	schema_doc = Schema.new('wide', **rec)
+	assert helpers_doc.validate() and schema_doc.validate()
+
+	t_helpers = min(timeit.repeat(helpers_doc.validate, number=number, repeat=3)) / number
+	t_schema = min(timeit.repeat(schema_doc.validate, number=number, repeat=3)) / number
+	print "%d fields" % width
+	print "validate_ helpers: %8.1f usec/validate" % (t_helpers * 1e6)
+	print "compiled schema:   %8.1f usec/validate" % (t_schema * 1e6)
+	print "speedup:           %8.1fx" % (t_helpers / t_schema)
+
+if __name__ == "__main__":
+	width = 300
+	if len(sys.argv) > 1:
+		width = int(sys.argv[1])
+	main(width)
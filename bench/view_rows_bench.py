@@ -0,0 +1,58 @@
+#!/usr/bin/python
+"""Compare ViewRows against the old list of TuplyDicts for a large view result.
+
+Usage: cd bench ; python view_rows_bench.py [number of rows]
+"""
+
+import sys
+import time
+
+sys.path = ['..'] + sys.path
+
+from lounge.client import TuplyDict, ViewRows
+
+def make_rows(n):
+	return [{'id': 'doc%d' % i, 'key': ['user', i], 'value': i} for i in xrange(n)]
+
+def timed(f):
+	start = time.time()
+	f()
+	return time.time() - start
+
+def access(rows):
+	total = 0
+	for row in rows:
+		key, value = row
+		total += row[1]
+		row[0]
+		row['id']
+	return total
+
+def main(n=1000000):
+	raw = make_rows(n)
+
+	t_wrap_old = timed(lambda: [TuplyDict(row) for row in raw])
+	t_wrap_new = timed(lambda: ViewRows(raw))
+
+	old = [TuplyDict(row) for row in raw]
+	new = ViewRows(raw)
+	t_access_old = timed(lambda: access(old))
+	t_access_new = timed(lambda: access(new))
+	t_column_old = timed(lambda: [row[0] for row in old])
+	t_column_new = timed(lambda: new.keys())
+
+	wrapper_bytes_old = sys.getsizeof(old) + sum([sys.getsizeof(r) + sys.getsizeof(r.__dict__) for r in old])
+	wrapper_bytes_new = sys.getsizeof(new)
+
+	print "%d rows" % n
+	print "%-24s %12s %12s" % ("", "TuplyDict", "ViewRows")
+	print "%-24s %11.3fs %11.3fs" % ("wrap", t_wrap_old, t_wrap_new)
+	print "%-24s %11.3fs %11.3fs" % ("iterate + index", t_access_old, t_access_new)
+	print "%-24s %11.3fs %11.3fs" % ("key column", t_column_old, t_column_new)
+	print "%-24s %11.1fM %11.1fM" % ("wrapper memory", wrapper_bytes_old / 1e6, wrapper_bytes_new / 1e6)
+
+if __name__ == "__main__":
+	n = 1000000
+	if len(sys.argv) > 1:
+		n = int(sys.argv[1])
+	main(n)
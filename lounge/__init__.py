@@ -1,9 +1,26 @@
 import re
+import zlib
 try:
 	import simplejson as json
 except ImportError:
 	import json
 
+def shard_index(key, nshards):
+	"""Figure out which of nshards shards a document key lives on.
+
+	This is the hash the lounge proxies use: bits 16-30 of the key's crc32,
+	modulo the number of shards.
+	"""
+	if isinstance(key, unicode):
+		key = key.encode('utf8')
+	return ((zlib.crc32(key) >> 16) & 0x7fff) % nshards
+
+def percentile(sorted_values, p):
+	"""The pth percentile (nearest rank) of an already sorted list, or None if it's empty."""
+	if not sorted_values:
+		return None
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
 class ShardMap(object):
 	def __init__(self, fname=None):
 		if fname is None:
@@ -33,6 +50,13 @@ class ShardMap(object):
 		low_key = int(self.get_db_shard.sub(r'\1', shard), 16)
 		return low_key / int(0x100000000 / len(self.shardmap))
 	
+	def get_shard_index(self, key):
+		"""Figure out which shard a document key lives on.
+		Ex: in -- kevin
+		   out -- 17
+		"""
+		return shard_index(key, len(self.shardmap))
+
 	def shards(self, dbname):
 		shard_size = 0x100000000 / len(self.shardmap)
 		ranges = [[s,s+shard_size-1]
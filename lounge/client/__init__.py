@@ -18,15 +18,24 @@ try:
 except ImportError:
 	import json
 import httplib2
+import itertools
 import logging
 import os
 import random
 import socket
 import StringIO
+import threading
+import time
 import urllib
+import weakref
 
 from UserDict import DictMixin
 
+from lounge.client.jsonfields import extract_fields
+from lounge.client.paths import compile_path, get_path, set_path, get_paths, project, Projection
+from lounge.client.schema import compile_schema
+from lounge.client.uuidpool import UUIDPools
+
 db_config = {
 	'prod': 'http://lounge:6984/',
 	'dev': 'http://lounge.dev.meebo.com:6984/',
@@ -36,6 +45,24 @@ db_connectinfo = None
 db_prefix = ''
 db_timeout = None
 
+# set to a lounge.client.replay.Recorder to log every request made
+recorder = None
+
+# set to a lounge.client.singleflight.SingleFlight to share concurrent
+# identical GETs
+single_flight = None
+
+# counters for Document.save_with_merge
+merge_stats = {'saves': 0, 'attempts': 0, 'conflicts': 0, 'failures': 0}
+_merge_stats_lock = threading.Lock()
+
+def _count_merge(name):
+	_merge_stats_lock.acquire()
+	try:
+		merge_stats[name] += 1
+	finally:
+		_merge_stats_lock.release()
+
 def random_junk():
 	return ''.join(random.sample("abcdefghijklmnopqrstuvwxyz", 6))
 
@@ -53,29 +80,6 @@ def use_config(cfg, testing=False):
 	else:
 		db_prefix = ''
 
-def get_path(it, selector):
-	"""Finds a value deep within a collection of collections, hopefully without throwing any KeyErrors along the way.
-	NOTE: Assumes no lists are involved.  Please patch to account for these."""
-	args = selector.split('.')
-	for arg in args:
-		if not hasattr(it, 'get'):
-			return None
-		it = it.get(arg, None)
-	return it
-
-def set_path(it, selector, value):
-	"""Like get_path, but sets a value instead."""
-	args = selector.split('.')
-	last_arg = args.pop(-1)
-	for arg in args:
-		try:
-			it = it[arg]
-		except KeyError, e:
-			it[arg] = {}
-			it = it[arg]
-	it[last_arg] = value
-	return value
-
 # default to production config
 use_config('prod')
 
@@ -140,6 +144,10 @@ class ValidationFailed(Exception):
 	"""Exception for when an object fails validation."""
 	pass
 
+class PartialDocument(Exception):
+	"""Exception for saving a record that was loaded with only some fields."""
+	pass
+
 def get_db_connectinfo(resource):
 	# if it's set on the resource, use it; otherwise, fall
 	# back on the global db_connectinfo
@@ -163,6 +171,18 @@ class Resource(object, DictMixin):
 	defaults = {}
 	db_connectinfo = None
 
+	# set _lazy = True to keep the body of found records as-is and only decode
+	# it the first time the record is used.  (It's private so that it doesn't
+	# hide a record field named lazy.)
+	_lazy = False
+
+	# the fields a record was loaded with, if it was loaded with find(fields=...)
+	_fields = None
+
+	# an httplib2.Http to reuse between requests; by default every request
+	# gets a fresh one
+	_http = None
+
 	def __init__(self):
 		"""Private!  Use find or new."""
 		self._responsecode = 0
@@ -216,12 +236,26 @@ class Resource(object, DictMixin):
 			return json.loads(payload)
 		except ValueError:
 			raise ValueError(payload)
+
+	def _decode_fields(self, payload, headers, fields):
+		"""Decode only some top-level fields of a response.
+
+		For typical Couch stuff, we scan the JSON and skip over everything
+		else.  Override along with _decode.
+		"""
+		try:
+			return extract_fields(payload, fields)
+		except ValueError:
+			raise ValueError(payload)
 	
 	### REST helpers
-	def _request(self, method, url, args=None, body=None):
-		"""Make a REST request."""
+	def _request(self, method, url, args=None, body=None, raw=False):
+		"""Make a REST request.
 
-		handle = httplib2.Http(timeout=db_timeout)
+		If raw is True, return the undecoded (content, content_type) pair.
+		"""
+
+		handle = self._http or httplib2.Http(timeout=db_timeout)
 
 		if args is not None:
 			uri = url + '?' + urllib.urlencode(args)
@@ -236,38 +270,56 @@ class Resource(object, DictMixin):
 			headers = {'Content-Length': '0'}
 
 		reason = None
+		active_recorder = recorder
+		start = time.time()
 		try:
-			response, content = handle.request(uri, method=method, headers=headers, body=body)
-			self._responsecode = int(response.get('status', 0))
-
-		except socket.timeout, e:
-			self._responsecode = 408
-			raise RequestTimedOut(self._responsecode, self._key)
-
-		except Exception, e:
-			self._responsecode = 400
-
-			if isinstance(e, socket.error):
-				raise SocketError(self._responsecode, self._key, e.args[1])
-			elif isinstance(e, httplib2.HttpLib2Error):
-				reason = "HTTPLib2Error: %s" % str(e)
-			else:
-				reason = "Exception: %s" % str(e)
-
-		# if nginx has a bad request, it will return a 400-like error page
-		# without setting the correct header.
-		if self._responsecode == 0:
-			self._responsecode = 400
-
-		if self._responsecode >= 400:
-			raise LoungeError.make(self._responsecode, self._key, reason)
+			try:
+				if method == 'GET' and single_flight is not None:
+					response, content = single_flight.do(uri, lambda: handle.request(uri, method=method, headers=headers, body=body))
+				else:
+					response, content = handle.request(uri, method=method, headers=headers, body=body)
+				self._responsecode = int(response.get('status', 0))
+
+			except socket.timeout, e:
+				self._responsecode = 408
+				raise RequestTimedOut(self._responsecode, self._key)
+
+			except Exception, e:
+				self._responsecode = 400
+
+				if isinstance(e, socket.error):
+					raise SocketError(self._responsecode, self._key, e.args[1])
+				elif isinstance(e, httplib2.HttpLib2Error):
+					reason = "HTTPLib2Error: %s" % str(e)
+				else:
+					reason = "Exception: %s" % str(e)
+
+			# if nginx has a bad request, it will return a 400-like error page
+			# without setting the correct header.
+			if self._responsecode == 0:
+				self._responsecode = 400
+
+			if self._responsecode >= 400:
+				raise LoungeError.make(self._responsecode, self._key, reason)
+		finally:
+			if active_recorder is not None:
+				# the request's own result or error matters more than the recording
+				try:
+					active_recorder.record(method, uri, body, self._responsecode, start, time.time() - start)
+				except Exception:
+					logging.exception("Couldn't record request to %s" % uri[:200])
 
 		content_type = response.get('content-type', 'application/octet-stream')
+		if raw:
+			return content, content_type
 		return self._decode(content, content_type)
 	
 	### basic REST operations
 	def _get(self, args=None):
 		return self._request('GET', self.url(), args=args)
+
+	def _get_raw(self, args=None):
+		return self._request('GET', self.url(), args=args, raw=True)
 	
 	def _put(self, args=None):
 		result = self._request('PUT', self.url(), body=self._rec, args=args)
@@ -303,17 +355,38 @@ class Resource(object, DictMixin):
 		return inst
 
 	@classmethod
-	def find(cls, *key):
+	def find(cls, *key, **kwargs):
 		"""Load a record from the database.
 
 		Ex.
 		me = UserProfile.find("kevin")
 
 		raises ResourceNotFound if there is no match
+
+		Keyword arguments:
+		`fields` -- only decode these top-level fields (plus _id and _rev) and
+		  skip over the rest of the body without decoding it.  That saves
+		  decoding the other fields, but not reading them: httplib2 still
+		  reads the whole body into memory first.  The result can't be saved.
+		`lazy` -- keep the body and decode it on first use.  Defaults to the
+		  class's _lazy attribute.
 		"""
+		fields = kwargs.pop('fields', None)
+		lazy = kwargs.pop('lazy', cls._lazy)
+		if kwargs:
+			raise TypeError("find() got unexpected keyword arguments: %s" % ', '.join(kwargs))
+
 		inst = cls()
 		inst._key = cls.make_key(*key)
-		inst._rec = inst._get()
+		if fields is not None:
+			fields = list(fields)
+			inst._fields = fields
+			content, content_type = inst._get_raw()
+			inst._rec = inst._decode_fields(content, content_type, fields + ['_id', '_rev'])
+		elif lazy:
+			inst.__dict__['_raw'] = inst._get_raw()
+		else:
+			inst._rec = inst._get()
 
 		return inst
 
@@ -325,8 +398,13 @@ class Resource(object, DictMixin):
 		except NotFound:
 			return cls.new(*key)
 	
+	def _check_complete(self):
+		if self._fields is not None:
+			raise PartialDocument("Record %s was loaded with only the fields %s and can't be saved" % (self._key, ', '.join(self._fields)))
+
 	def save(self, batchok=False):
 		"""Create or update an existing record."""
+		self._check_complete()
 		args = None
 		if batchok:
 			args = {"batch": "ok"}
@@ -338,7 +416,12 @@ class Resource(object, DictMixin):
 				self._rec["_rev"] = result["rev"]
 	
 	def reload(self):
-		"""Update a record from the database."""
+		"""Update a record from the database.
+
+		This always loads the whole record, even if it was found with fields.
+		"""
+		self.__dict__.pop('_raw', None)
+		self.__dict__.pop('_fields', None)
 		self._rec = self._get()
 	
 	def destroy(self):
@@ -358,6 +441,9 @@ class Resource(object, DictMixin):
 	def set_path(self, selector, value):
 		return set_path(self._rec, selector, value)
 
+	def get_paths(self, selectors):
+		return get_paths(self._rec, selectors)
+
 	def keys(self):
 		return self._rec.keys()
 
@@ -380,6 +466,13 @@ class Resource(object, DictMixin):
 		dictionary.  We fall back on checking the record.  So for example 
 		if our document is {"monkeys": "great"}, then inst.monkeys == "great".
 		"""
+		if attr == '_rec':
+			# a lazily found record gets decoded the first time it's used
+			if '_raw' not in self.__dict__:
+				raise AttributeError(attr)
+			content, content_type = self.__dict__.pop('_raw')
+			self.__dict__['_rec'] = self._decode(content, content_type)
+			return self.__dict__['_rec']
 		try:
 			return self._rec[attr]
 		except KeyError:
@@ -401,11 +494,18 @@ class Resource(object, DictMixin):
 		in the constructor.
 		"""
 		# override default setattr only after construction
-		if ("_rec" in self.__dict__) and (not attr in self.__dict__) and attr != "_rec":
+		if ("_rec" in self.__dict__ or "_raw" in self.__dict__) and (not attr in self.__dict__) and attr != "_rec":
 			self._rec[attr] = v
 		else: 
 			return object.__setattr__(self, attr, v)
 
+def fetch_uuids(connectinfo, count):
+	"""Get count UUIDs from the lounge at connectinfo."""
+	return Resource.find(connectinfo + "_uuids?count=%d" % count).uuids
+
+# where Document.generate_uuid gets its UUIDs; see lounge.client.uuidpool
+uuid_pools = UUIDPools(fetch_uuids)
+
 class Database(Resource):
 	@classmethod
 	def make_key(cls, key):
@@ -423,6 +523,11 @@ class Database(Resource):
 		# See https://issues.apache.org/jira/browse/COUCHDB-1146
 		return self._request('PUT', self.url(), args=args)
 
+# compiled validators per Document class: (schema, schema validator, sizes of
+# the dicts along the class's mro, validate_ names).  Weak so that classes
+# made on the fly can still go away.
+_validator_cache = weakref.WeakKeyDictionary()
+
 class Document(Resource):
 	"""Base class for a lounge record.
 
@@ -441,6 +546,11 @@ class Document(Resource):
 	# set this to the name of your database
 	db_name = None
 
+	# optionally, a dict of lounge.client.schema Fields describing the record.
+	# It is compiled into a single validator the first time it's needed.
+	# (It's private so that it doesn't hide a record field named schema.)
+	_schema = None
+
 	# use _db_name internally-- it will add the test prefix if needed.
 	# external applications can set db_name
 	def get_db_name(self):
@@ -455,16 +565,62 @@ class Document(Resource):
 
 	@classmethod
 	def generate_uuid(cls):
-		url = get_db_connectinfo(cls) + "_uuids?count=1";
-		uuids = Resource.find(url).uuids
-		return uuids[0]
+		return uuid_pools.next(get_db_connectinfo(cls))
 
 	def save(self, **kwargs):
+		 self._check_complete()
 		 is_valid = self.validate()
 		 if not is_valid:
 			 raise ValidationFailed("Validation failed for object of type %s: %s.  Errors: %s" % (self.__class__, str(self._rec), str(self._errors)))
 		 super(Document, self).save(**kwargs)
 
+	def save_with_merge(self, mutator, max_attempts=5, backoff=0.01, reuse_connection=True, **kwargs):
+		"""Apply a change to the document and save it, retrying on conflicts.
+
+		mutator is called with the document and should change it in place,
+		depending on nothing but the document.  If the save raises
+		RevisionConflict, we sleep a random time up to backoff * 2^attempt
+		seconds, fetch the latest revision, call mutator on that and try again.
+		With reuse_connection, all of the requests share one connection.
+
+		Returns the number of attempts it took.  Raises RevisionConflict if the
+		last of max_attempts still conflicts.  Totals are kept in merge_stats.
+
+		Ex.
+		def add_friend(doc):
+			if "bob" not in doc.friends:
+				doc.friends.append("bob")
+		me.save_with_merge(add_friend)
+		"""
+		had_http = '_http' in self.__dict__
+		if reuse_connection and not had_http:
+			self.__dict__['_http'] = httplib2.Http(timeout=db_timeout)
+		_count_merge('saves')
+		try:
+			attempt = 0
+			while True:
+				attempt += 1
+				_count_merge('attempts')
+				mutator(self)
+				try:
+					self.save(**kwargs)
+					return attempt
+				except RevisionConflict:
+					_count_merge('conflicts')
+					if attempt >= max_attempts:
+						_count_merge('failures')
+						raise
+				time.sleep(random.uniform(0, backoff * 2 ** attempt))
+				try:
+					self.reload()
+				except NotFound:
+					# deleted out from under us; start over from a new record
+					self._rec = copy.deepcopy(self.defaults)
+					self._rec["_id"] = self._key
+		finally:
+			if reuse_connection and not had_http:
+				del self.__dict__['_http']
+
 	def url(self):
 		# It should be OK to create a Document instance with no db-- the only
 		# issue will come when you try to save it
@@ -494,15 +650,38 @@ class Document(Resource):
 		"""
 		status = True
 		self._errors = {}
-		# find all method named validate_
-		for attr in dir(self):
-			if attr.startswith('validate_'):
-				f = getattr(self, attr)
-				# make sure it's actually callable
-				if hasattr(f, '__call__'):
-					status = f() and status
+		schema_validator, validators = self._get_validators()
+		if schema_validator is not None:
+			status = schema_validator(self, self._rec)
+		for attr in validators:
+			f = getattr(self, attr)
+			# make sure it's actually callable
+			if hasattr(f, '__call__'):
+				status = f() and status
 		return status
 
+	@classmethod
+	def _get_validators(cls):
+		"""Return the compiled schema (or None) and the names of the validate_
+		methods for this class.  The schema is compiled again only when the
+		class's _schema is replaced, and the names are looked up again only
+		when attributes are added to or removed from the class or a base."""
+		schema = cls._schema
+		sizes = tuple([len(c.__dict__) for c in cls.__mro__])
+		cached = _validator_cache.get(cls)
+		if cached is None or cached[0] is not schema or cached[2] != sizes:
+			if cached is not None and cached[0] is schema:
+				schema_validator = cached[1]
+			elif schema is not None:
+				schema_validator = compile_schema(schema)
+			else:
+				schema_validator = None
+			# find all method named validate_
+			names = [attr for attr in dir(cls) if attr.startswith('validate_')]
+			cached = (schema, schema_validator, sizes, names)
+			_validator_cache[cls] = cached
+		return cached[1], cached[3]
+
 	def get_attachment(self, name):
 		"""
 		Retrieves an attachment from this Document, raising NotFound if
@@ -613,6 +792,162 @@ class TuplyDict(object):
 	def __str__(self):
 		return str(self._dict)
 
+class ViewRow(object):
+	"""A row of a view result.
+
+	Like TuplyDict, it behaves as the (key, value) tuple for indexes 0 and 1,
+	iteration and comparison, and as the row dict for everything else, but it
+	reads straight from the row dict instead of building a tuple each time.
+	"""
+	__slots__ = ('_dict',)
+
+	def __init__(self, row_dict):
+		self._dict = row_dict
+
+	def __contains__(self, item):
+		return (item == 0) or (item == 1) or item in self._dict
+
+	def __getitem__(self, key):
+		if key == 0:
+			return self._dict['key']
+		elif key == 1:
+			return self._dict['value']
+		return self._dict[key]
+
+	def __eq__(self, obj):
+		if isinstance(obj, tuple):
+			return len(obj) == 2 and self._dict['key'] == obj[0] and self._dict['value'] == obj[1]
+		elif isinstance(obj, (ViewRow, TuplyDict)):
+			return self._dict == obj._dict
+		return False
+
+	def __ne__(self, obj):
+		return not self.__eq__(obj)
+
+	def __cmp__(self, obj):
+		if isinstance(obj, tuple):
+			return cmp(self._keyvalue, obj)
+		else:
+			return cmp(self._dict, obj._dict)
+
+	def __iter__(self):
+		""" We only iterate over the fake key,value tuple,
+		 	for backwards compatibility
+		"""
+		yield self._dict['key']
+		yield self._dict['value']
+
+	@property
+	def _keyvalue(self):
+		return (self._dict['key'], self._dict['value'])
+
+	def __repr__(self):
+		return "ViewRow(%s)" % repr(self._dict)
+
+	def __str__(self):
+		return str(self._dict)
+
+def _wrap_row(row):
+	"""A ViewRow for a row dict; anything else (say, a row a caller appended)
+	is returned as it is."""
+	if type(row) is dict:
+		return ViewRow(row)
+	return row
+
+def _row_dict(row):
+	if isinstance(row, ViewRow):
+		return row._dict
+	return row
+
+class ViewRows(list):
+	"""The rows of a view result.
+
+	A list that holds the decoded row dicts as they came off the wire and only
+	wraps a row in a ViewRow when it is accessed.  For whole columns, use
+	keys(), values(), ids() and docs(), which never build row objects at all.
+
+	Everything that hands out or compares rows (indexing, slicing, iteration,
+	pop, index, count, remove, sort, in, ==) sees ViewRows, so it works like
+	the old list of TuplyDicts, and it is still a list for append, slice
+	assignment and isinstance checks.
+	"""
+	__slots__ = ()
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return map(_wrap_row, list.__getitem__(self, index))
+		return _wrap_row(list.__getitem__(self, index))
+
+	def __getslice__(self, i, j):
+		return map(_wrap_row, list.__getslice__(self, i, j))
+
+	def __iter__(self):
+		return itertools.imap(_wrap_row, list.__iter__(self))
+
+	def __reversed__(self):
+		return itertools.imap(_wrap_row, list.__reversed__(self))
+
+	def __contains__(self, item):
+		for row in self:
+			if row == item:
+				return True
+		return False
+
+	def __eq__(self, obj):
+		if isinstance(obj, ViewRows):
+			return map(_row_dict, list.__iter__(self)) == map(_row_dict, list.__iter__(obj))
+		return list(self) == obj
+
+	def __ne__(self, obj):
+		return not self.__eq__(obj)
+
+	def __add__(self, obj):
+		return list(self) + list(obj)
+
+	def __radd__(self, obj):
+		return list(obj) + list(self)
+
+	def pop(self, *index):
+		return _wrap_row(list.pop(self, *index))
+
+	def index(self, item, *bounds):
+		return list(self).index(item, *bounds)
+
+	def count(self, item):
+		return list(self).count(item)
+
+	def remove(self, item):
+		del self[self.index(item)]
+
+	def sort(self, *args, **kwargs):
+		# key and cmp functions get the same rows as everybody else
+		self[:] = list(self)
+		list.sort(self, *args, **kwargs)
+
+	def keys(self):
+		return [_row_dict(row)['key'] for row in list.__iter__(self)]
+
+	def values(self):
+		return [_row_dict(row)['value'] for row in list.__iter__(self)]
+
+	def ids(self):
+		return [_row_dict(row).get('id') for row in list.__iter__(self)]
+
+	def docs(self):
+		"""The included documents, when the view ran with include_docs."""
+		return [_row_dict(row).get('doc') for row in list.__iter__(self)]
+
+	def project(self, selectors):
+		"""Pull the given selectors out of every row in one pass.
+
+		Selectors apply to the row dict, so with include_docs you can do
+		rows.project(['key', 'doc.name', 'doc.emails[0]']).
+		"""
+		return Projection(selectors).extract_all(map(_row_dict, list.__iter__(self)))
+
+	def __repr__(self):
+		return "ViewRows(%s)" % list.__repr__(self)
+
 class View(Resource):
 	def __init__(self, db_name):
 		Resource.__init__(self)
@@ -628,6 +963,14 @@ class View(Resource):
 
 	@classmethod
 	def execute(cls, db_name, *key, **kwargs):
+		"""Query the view.
+
+		Keyword arguments:
+		`args` -- the query arguments, like startkey or include_docs
+		`db_connectinfo` -- the lounge to query, if not the default
+		`cache` -- a lounge.client.viewcache.ViewCache to look in first
+		Anything else is sent as the body, for views that POST.
+		"""
 		inst = cls(db_name)
 		inst.db_connectinfo = kwargs.pop('db_connectinfo', None)
 		inst._key = cls.make_key(*key)
@@ -640,18 +983,25 @@ class View(Resource):
 				if k!='stale':
 					# json-encode the args
 					args[k] = json.dumps(v)
+		cache = kwargs.pop('cache', None)
 		#this sets the post-body to the arguments of the view (so it's actually not a no-op)
 		#this behaviour is used in TempView below
 		inst._rec = kwargs
-		inst._rec = inst.get_results(args)
+		if cache is not None:
+			inst._rec = cache.get(inst, args)
+		else:
+			inst._rec = inst.get_results(args)
 		try:
-			inst._rec['rows'] = [TuplyDict(row) for row in inst._rec['rows']]
+			rows = inst._rec['rows']
+			if not isinstance(rows, list):
+				raise TypeError
+			inst._rec['rows'] = ViewRows(rows)
 		except TypeError:
 			raise TypeError("Expected a JSON object with 'rows' attribute, got %s" % str(inst._rec))
 		return inst
 
-	def get_results(self, args):
-		return self._request('GET', self.url(), args=args)
+	def get_results(self, args, raw=False):
+		return self._request('GET', self.url(), args=args, raw=raw)
 
 	def save(self, **kwargs):
 		raise NotImplementedError
@@ -661,8 +1011,8 @@ class TempView(View):
 	def make_key(cls):
 		return '_temp_view'
 	
-	def get_results(self, args):
-		return self._request('POST', self.url(), args=args, body=self._rec)
+	def get_results(self, args, raw=False):
+		return self._request('POST', self.url(), args=args, body=self._rec, raw=raw)
 
 class AllDocView(View):
 	@classmethod
@@ -674,8 +1024,8 @@ class BulkDocView(View):
 	def make_key(cls):
 		return '_all_docs'
 
-	def get_results(self, args):
-		return self._request('POST', self.url(), args=args, body=self._rec)
+	def get_results(self, args, raw=False):
+		return self._request('POST', self.url(), args=args, body=self._rec, raw=raw)
 
 	@classmethod
 	def fetch(cls, db, keys):
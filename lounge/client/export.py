@@ -0,0 +1,280 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Export a whole database to JSON lines, reading its shards in parallel.
+
+	python -m lounge.client.export -j 8 userinfo /backup/userinfo
+
+reads every primary shard of userinfo (from /etc/lounge/shards.conf, or
+--shards) with paged _all_docs?include_docs=true queries, and writes each
+shard's documents, one JSON object per line, to
+/backup/userinfo/userinfo.<shard>.jsonl.gz.  Only one page per worker is in
+memory at a time.  --merge concatenates the shard files into
+userinfo.jsonl.gz at the end.
+
+Each page is written as a complete gzip member and then checkpointed, so
+an export that fails (or is killed) picks up where it left off when it's
+run again; --restart starts from scratch instead.  Design documents live
+on every shard, so each is only exported from the shard its id hashes to.
+
+From code:
+
+	results = export("userinfo", "/backup/userinfo", shard_map=ShardMap())
+
+returns each shard's ShardExport, with its document count and throughput.
+"""
+
+try:
+	import simplejson as json
+except ImportError:
+	import json
+import gzip
+import logging
+import optparse
+import os
+import shutil
+import sys
+import threading
+import time
+
+from lounge import ShardMap, shard_index
+from lounge import client
+
+class ExportFailed(Exception):
+	"""Some shards failed to export; run the export again to resume."""
+	def __init__(self, results):
+		self.results = results
+		failed = [r for r in results if r.error is not None]
+		Exception.__init__(self, "%d of %d shards failed: %s" % (len(failed), len(results),
+			"; ".join(["%s: %s" % (r.url, r.error) for r in failed])))
+
+class ShardExport(object):
+	"""The export of one shard: where it's going, how far it's got and how fast."""
+	def __init__(self, index, url, path, compress=True):
+		self.index = index
+		self.url = url
+		self.path = path
+		self.checkpoint_path = path + ".checkpoint"
+		self.compress = compress
+		self.last_id = None
+		self.docs = 0
+		self.bytes = 0
+		self.size = 0
+		self.done = False
+		self.seconds = 0.0
+		self.error = None
+
+	def docs_per_second(self):
+		return self.seconds and self.docs / self.seconds or 0.0
+
+	def load_checkpoint(self):
+		try:
+			f = open(self.checkpoint_path)
+		except IOError:
+			return False
+		try:
+			state = json.load(f)
+		finally:
+			f.close()
+		self.last_id, self.docs, self.bytes, self.size, self.done, self.seconds = \
+			state['last_id'], state['docs'], state['bytes'], state['size'], state['done'], state['seconds']
+		return True
+
+	def save_checkpoint(self):
+		tmp = self.checkpoint_path + ".tmp"
+		f = open(tmp, "w")
+		try:
+			json.dump({'last_id': self.last_id, 'docs': self.docs, 'bytes': self.bytes,
+				'size': self.size, 'done': self.done, 'seconds': self.seconds}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(tmp, self.checkpoint_path)
+
+	def clear(self):
+		for path in (self.path, self.checkpoint_path):
+			if os.path.exists(path):
+				os.unlink(path)
+
+	def write_page(self, lines):
+		"""Append lines as one gzip member (or as plain text), dropping anything
+		written since the last checkpoint."""
+		f = open(self.path, "ab")
+		try:
+			# drop anything written after the last checkpoint
+			f.truncate(self.size)
+			f.seek(self.size)
+			data = "".join(lines)
+			if self.compress:
+				member = gzip.GzipFile(fileobj=f, mode="wb")
+				member.write(data)
+				member.close()
+			else:
+				f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+			self.size = f.tell()
+		finally:
+			f.close()
+		self.bytes += len(data)
+
+	def __repr__(self):
+		return "<ShardExport %d %s: %d docs>" % (self.index, self.url, self.docs)
+
+class Exporter(object):
+	def __init__(self, page_size=1000, retries=3, backoff=1.0):
+		self.page_size = page_size
+		self.retries = retries
+		self.backoff = backoff
+
+	def _get(self, resource, url, args):
+		for attempt in range(self.retries + 1):
+			try:
+				return resource._request('GET', url, args=args)
+			except (client.LoungeError, ValueError), e:
+				if attempt == self.retries:
+					raise
+				logging.warning("export: %s failed (%s); retrying" % (url, e))
+				time.sleep(self.backoff * (2 ** attempt))
+
+	def export_shard(self, shard, nshards=1):
+		"""Export one shard (of nshards) from its checkpoint to the end."""
+		resource = client.Resource()
+		resource._key = shard.url
+		while not shard.done:
+			start = time.time()
+			args = {'include_docs': 'true', 'limit': self.page_size}
+			if shard.last_id is not None:
+				args.update({'startkey': json.dumps(shard.last_id), 'skip': 1})
+			rows = self._get(resource, shard.url + "/_all_docs", args)['rows']
+			lines = []
+			for row in rows:
+				doc = row.get('doc')
+				if doc is None:
+					continue
+				if row['id'].startswith('_design/') and shard_index(row['id'], nshards) != shard.index:
+					continue
+				lines.append(json.dumps(doc) + "\n")
+			if lines:
+				shard.write_page(lines)
+			shard.docs += len(lines)
+			if rows:
+				shard.last_id = rows[-1]['id']
+			shard.done = len(rows) < self.page_size
+			shard.seconds += time.time() - start
+			shard.save_checkpoint()
+
+def _shard_urls(db_name, shard_map, db_connectinfo):
+	name = client.db_prefix + db_name
+	if shard_map is None:
+		return [(db_connectinfo or client.db_connectinfo) + name]
+	return shard_map.primary_shards(name)
+
+def export(db_name, out_dir, shard_map=None, workers=4, page_size=1000, compress=True,
+		merge=False, restart=False, retries=3, db_connectinfo=None):
+	"""Export db_name to out_dir and return a ShardExport for each shard.
+
+	With a ShardMap, each primary shard is read directly; without one, the
+	whole database is read through the lounge as a single "shard".  Raises
+	ExportFailed if any shard fails, after the others have finished.
+	"""
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+	suffix = compress and ".jsonl.gz" or ".jsonl"
+	shards = []
+	for i, url in enumerate(_shard_urls(db_name, shard_map, db_connectinfo)):
+		shard = ShardExport(i, url, os.path.join(out_dir, "%s.%d%s" % (db_name, i, suffix)), compress)
+		if restart:
+			shard.clear()
+		shard.load_checkpoint()
+		shards.append(shard)
+
+	exporter = Exporter(page_size, retries)
+	lock = threading.Lock()
+	pending = list(shards)
+	def work():
+		while True:
+			lock.acquire()
+			try:
+				if not pending:
+					return
+				shard = pending.pop(0)
+			finally:
+				lock.release()
+			try:
+				exporter.export_shard(shard, len(shards))
+			except Exception, e:
+				logging.exception("export: shard %s failed" % shard.url)
+				shard.error = e
+	threads = [threading.Thread(target=work, name="export-%d" % i) for i in range(min(workers, len(shards)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if [shard for shard in shards if shard.error is not None]:
+		raise ExportFailed(shards)
+	if merge:
+		merged = os.path.join(out_dir, db_name + suffix)
+		out = open(merged + ".tmp", "wb")
+		try:
+			for shard in shards:
+				if os.path.exists(shard.path):
+					f = open(shard.path, "rb")
+					try:
+						shutil.copyfileobj(f, out)
+					finally:
+						f.close()
+		finally:
+			out.close()
+		os.rename(merged + ".tmp", merged)
+		for shard in shards:
+			shard.clear()
+	return shards
+
+def main(argv):
+	parser = optparse.OptionParser(usage="usage: %prog [options] <database> <output directory>")
+	parser.add_option("--shards", default="/etc/lounge/shards.conf",
+		help="the lounge shard config [%default]; 'none' to read through the lounge")
+	parser.add_option("--lounge", help="with --shards=none, the lounge URL [the production lounge]")
+	parser.add_option("-j", "--workers", type="int", default=4, help="shards to read at once [%default]")
+	parser.add_option("--page-size", type="int", default=1000, help="documents per request [%default]")
+	parser.add_option("--merge", action="store_true", help="write one file instead of one per shard")
+	parser.add_option("--no-compress", action="store_true", help="write plain .jsonl")
+	parser.add_option("--restart", action="store_true", help="ignore checkpoints and start over")
+	options, args = parser.parse_args(argv[1:])
+	if len(args) != 2:
+		parser.error("expected a database and an output directory")
+
+	shard_map = None
+	if options.shards != "none":
+		shard_map = ShardMap(options.shards)
+	try:
+		shards = export(args[0], args[1], shard_map, options.workers, options.page_size,
+			not options.no_compress, options.merge, options.restart, db_connectinfo=options.lounge)
+		status = 0
+	except ExportFailed, e:
+		print >>sys.stderr, e
+		shards = e.results
+		status = 1
+	for shard in shards:
+		state = shard.error is not None and "FAILED" or (shard.done and "done" or "partial")
+		print "%3d %-60s %8d docs %8.1f docs/s %8.1f MB/s %s" % (shard.index, shard.url, shard.docs,
+			shard.docs_per_second(), shard.seconds and shard.bytes / shard.seconds / 1e6 or 0.0, state)
+	print "%d docs" % sum([shard.docs for shard in shards])
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
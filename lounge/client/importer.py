@@ -0,0 +1,500 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Import JSON lines into a database through _bulk_docs, with parallel writers.
+
+	python -m lounge.client.importer -j 8 --conflicts merge /backup/userinfo.jsonl.gz userinfo
+
+reads one document per line (gzipped or not, like the files
+lounge.client.export writes) and saves them in batches with a pool of
+writer threads.  The reader can only get a few batches ahead of the
+writers, so memory stays flat however big the file is.
+
+Batch sizes adapt: a batch that takes less than half of target_seconds
+makes the next ones bigger, and one that takes longer than target_seconds
+or fails makes them smaller.
+
+Documents that already exist are handled according to the conflict
+policy:
+
+	skip       leave the existing document alone (the default)
+	overwrite  replace it with the imported one
+	merge      save merge(existing, imported); by default the existing
+	           document updated with the imported fields
+
+Imported documents' _revs are dropped, since they're from another database.
+
+With a ShardMap (--shards), each batch goes straight to the primary shard
+that its documents hash to, instead of through the lounge.  Design
+documents go to every primary shard, like the lounge would send them (and
+each copy counts as saved).
+
+Documents without an _id get one made from the line number and an id for
+the import that's kept in the checkpoint, so a resumed import gives a line
+the same _id it got the first time.
+
+Progress is checkpointed to <file>.checkpoint as the line number before
+which everything has been saved, so an interrupted import can be run again
+to resume; --restart starts over (with new _ids for documents that have
+none).  Lines after the checkpoint may be saved twice; the second save
+finds the first one, which is told apart from a real conflict by its
+contents.  The same goes for a _bulk_docs request that's retried after an
+error but had gone through.
+"""
+
+try:
+	import simplejson as json
+except ImportError:
+	import json
+import gzip
+import hashlib
+import logging
+import optparse
+import os
+import Queue
+import sys
+import threading
+import time
+
+import httplib2
+
+from lounge import ShardMap, shard_index
+from lounge import client
+
+POLICIES = ('skip', 'overwrite', 'merge')
+
+class ImportFailed(Exception):
+	"""The import stopped; run it again to resume from the checkpoint."""
+	pass
+
+def default_merge(existing, imported):
+	merged = dict(existing)
+	merged.update(imported)
+	return merged
+
+def _same(existing, doc):
+	"""Whether the saved document existing is doc, as we'd have saved it."""
+	existing = dict(existing)
+	existing.pop('_rev', None)
+	return existing == doc
+
+def _unexpected(result):
+	"""An error for a _bulk_docs result that isn't for any doc we sent."""
+	return {'id': result.get('id'), 'error': 'unexpected_result',
+		'reason': 'not one of the documents in the batch: %r' % (result,)}
+
+def open_lines(path):
+	"""Open a JSON lines file, gzipped or not."""
+	f = open(path, "rb")
+	magic = f.read(2)
+	f.seek(0)
+	if magic == "\x1f\x8b":
+		return gzip.GzipFile(fileobj=f, mode="rb")
+	return f
+
+class BatchSizer(object):
+	"""Picks batch sizes between minimum and maximum that take about target seconds."""
+	def __init__(self, initial=500, minimum=10, maximum=5000, target=1.0):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.target = target
+		self._size = float(initial)
+		self._lock = threading.Lock()
+
+	def size(self):
+		return int(self._size)
+
+	def record(self, count, seconds, ok=True):
+		"""Note that a batch of count documents took seconds (or failed)."""
+		self._lock.acquire()
+		try:
+			if not ok or seconds > self.target:
+				self._size = max(self.minimum, self._size / 2)
+			elif seconds < self.target / 2 and count >= self._size:
+				self._size = min(self.maximum, self._size * 1.5)
+		finally:
+			self._lock.release()
+
+class _Progress(object):
+	"""Tracks which lines are saved, and the line before which all of them are.
+
+	run identifies the import, for making _ids; it's the same when resuming.
+	"""
+	def __init__(self, checkpoint_path, line=0, run=None):
+		self.checkpoint_path = checkpoint_path
+		self.line = line
+		self.run = run or os.urandom(8).encode('hex')
+		self._done = set()
+		# lines saved as more than one copy -> copies still to go
+		self._copies = {}
+		self._lock = threading.Lock()
+
+	def expect(self, line, copies):
+		"""Note that line is only done once it's been finished copies times."""
+		self._lock.acquire()
+		try:
+			self._copies[line] = copies
+		finally:
+			self._lock.release()
+
+	def finish(self, lines):
+		self._lock.acquire()
+		try:
+			for line in lines:
+				if line in self._copies:
+					self._copies[line] -= 1
+					if self._copies[line]:
+						continue
+					del self._copies[line]
+				self._done.add(line)
+			line = self.line
+			while line in self._done:
+				self._done.discard(line)
+				line += 1
+			if line != self.line:
+				self.line = line
+				self.save()
+		finally:
+			self._lock.release()
+
+	def save(self):
+		if self.checkpoint_path is None:
+			return
+		tmp = self.checkpoint_path + ".tmp"
+		f = open(tmp, "w")
+		try:
+			json.dump({'line': self.line, 'run': self.run}, f)
+			# on disk before it replaces the old one, or a crash can leave neither
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(tmp, self.checkpoint_path)
+
+	@classmethod
+	def load(cls, checkpoint_path):
+		try:
+			f = open(checkpoint_path)
+		except IOError:
+			return cls(checkpoint_path)
+		try:
+			state = json.load(f)
+		finally:
+			f.close()
+		return cls(checkpoint_path, state['line'], state['run'])
+
+	def make_id(self, line):
+		return hashlib.md5("%s:%d" % (self.run, line)).hexdigest()
+
+class Importer(object):
+	"""Saves documents into db_name in batches from a pool of writer threads.
+
+	See the module docstring for the conflict policies; merge(existing,
+	imported) returns the document to save for the merge policy.
+
+	A batch still filling up is sent anyway once max_lag lines have been
+	read since its first one, so a shard that few documents go to doesn't
+	hold the checkpoint back.
+	"""
+	def __init__(self, db_name, workers=4, batch_size=500, min_batch=10, max_batch=5000,
+			target_seconds=1.0, conflicts='skip', merge=None, shard_map=None, db_connectinfo=None,
+			retries=3, backoff=1.0, max_lag=10000):
+		if conflicts not in POLICIES:
+			raise ValueError("conflicts must be one of %s, not %r" % (", ".join(POLICIES), conflicts))
+		self.db_name = db_name
+		self.workers = workers
+		self.sizer = BatchSizer(batch_size, min_batch, max_batch, target_seconds)
+		self.conflicts = conflicts
+		self.merge = merge or default_merge
+		self.shard_map = shard_map
+		self.db_connectinfo = db_connectinfo or client.db_connectinfo
+		self.retries = retries
+		self.backoff = backoff
+		self.max_lag = max_lag
+		self._lock = threading.Lock()
+		self.stats = {'docs': 0, 'saved': 0, 'skipped': 0, 'overwritten': 0, 'merged': 0,
+			'errors': 0, 'batches': 0, 'retries': 0, 'seconds': 0.0}
+		self.errors = []
+
+	def _count(self, **counts):
+		self._lock.acquire()
+		try:
+			for name, count in counts.iteritems():
+				self.stats[name] += count
+		finally:
+			self._lock.release()
+
+	def _urls(self):
+		name = client.db_prefix + self.db_name
+		if self.shard_map is None:
+			return [self.db_connectinfo + name]
+		return self.shard_map.primary_shards(name)
+
+	### writers
+	def _post(self, resource, url, path, body):
+		"""POST body, retrying errors.  Returns the result and whether it took
+		more than one try."""
+		for attempt in range(self.retries + 1):
+			try:
+				return resource._request('POST', url + path, body=body), attempt > 0
+			except client.LoungeError, e:
+				if attempt == self.retries:
+					raise
+				self._count(retries=1)
+				logging.warning("import: %s%s failed (%s); retrying" % (url, path, e))
+				time.sleep(self.backoff * (2 ** attempt))
+
+	def _current(self, resource, url, ids, include_docs=False):
+		"""id -> (rev, doc) for those of ids that exist."""
+		args = {'include_docs': json.dumps(include_docs)}
+		resource._key = url
+		rows = resource._request('POST', url + "/_all_docs", args=args, body={'keys': ids})['rows']
+		current = {}
+		for row in rows:
+			value = row.get('value')
+			if value and not value.get('deleted'):
+				current[row['id']] = (value['rev'], row.get('doc'))
+		return current
+
+	def _save(self, resource, url, docs):
+		"""Save docs, resolving conflicts by the policy.  Returns the docs that failed."""
+		results, retried = self._post(resource, url, "/_bulk_docs", {'docs': docs})
+		by_id = dict([(doc['_id'], doc) for doc in docs])
+		conflicted = []
+		failed = []
+		saved = 0
+		for result in results:
+			doc = by_id.get(result.get('id'))
+			if doc is None:
+				failed.append(_unexpected(result))
+			elif 'error' not in result:
+				saved += 1
+			elif result['error'] == 'conflict':
+				conflicted.append(doc)
+			else:
+				failed.append(result)
+		if conflicted and (retried or self._resuming):
+			# a try that failed as far as we know, or an earlier run, may have
+			# saved these already; then they aren't conflicts
+			current = self._current(resource, url, [doc['_id'] for doc in conflicted], include_docs=True)
+			ours = set([doc['_id'] for doc in conflicted if doc['_id'] in current and _same(current[doc['_id']][1], doc)])
+			saved += len(ours)
+			conflicted = [doc for doc in conflicted if doc['_id'] not in ours]
+		self._count(saved=saved)
+		if not conflicted:
+			return failed
+		if self.conflicts == 'skip':
+			self._count(skipped=len(conflicted))
+			return failed
+
+		for attempt in range(self.retries + 1):
+			current = self._current(resource, url, [doc['_id'] for doc in conflicted], self.conflicts == 'merge')
+			retry = []
+			for doc in conflicted:
+				doc = dict(doc)
+				if doc['_id'] in current:
+					rev, existing = current[doc['_id']]
+					if self.conflicts == 'merge':
+						doc = self.merge(existing, doc)
+					doc['_rev'] = rev
+				retry.append(doc)
+			results = self._post(resource, url, "/_bulk_docs", {'docs': retry})[0]
+			by_id = dict([(doc['_id'], doc) for doc in retry])
+			conflicted = []
+			resolved = 0
+			for result in results:
+				doc = by_id.get(result.get('id'))
+				if doc is None:
+					failed.append(_unexpected(result))
+				elif 'error' not in result:
+					resolved += 1
+				elif result['error'] == 'conflict' and attempt < self.retries:
+					# changed again under us
+					conflicted.append(doc)
+				else:
+					failed.append(result)
+			if self.conflicts == 'merge':
+				self._count(merged=resolved)
+			else:
+				self._count(overwritten=resolved)
+			if not conflicted:
+				break
+		return failed
+
+	def _writer(self, queue):
+		resource = client.Resource()
+		resource._http = httplib2.Http(timeout=client.db_timeout)
+		while True:
+			batch = queue.get()
+			if batch is None:
+				return
+			url, lines, docs = batch
+			if self._failure is not None:
+				# stopping; just drain the queue so the reader isn't stuck
+				continue
+			resource._key = url
+			start = time.time()
+			try:
+				failed = self._save(resource, url, docs)
+			except Exception, e:
+				self.sizer.record(len(docs), time.time() - start, ok=False)
+				logging.exception("import: saving a batch to %s failed" % url)
+				self._failure = e
+				continue
+			self.sizer.record(len(docs), time.time() - start)
+			if failed:
+				self._lock.acquire()
+				try:
+					self.errors.extend(failed)
+				finally:
+					self._lock.release()
+			self._count(batches=1, errors=len(failed))
+			self._progress.finish(lines)
+
+	### the reader
+	def _read(self, f, queue, urls):
+		"""Read documents from f and queue them in batches, one batch per url at a time."""
+		pending = [([], []) for url in urls]
+		# documents read but not counted yet; a design doc is one of these, but
+		# goes out once per url
+		read = [0]
+		def flush(i):
+			lines, docs = pending[i]
+			if docs:
+				queue.put((urls[i], lines, docs))
+				pending[i] = ([], [])
+				self._count(docs=read[0])
+				read[0] = 0
+
+		# look for batches that are too far behind a few times per max_lag lines
+		next_check = self.max_lag / 4
+		for number, line in enumerate(f):
+			if self._failure is not None:
+				return
+			if number < self._progress.line:
+				continue
+			line = line.strip()
+			if not line:
+				self._progress.finish([number])
+				continue
+			doc = json.loads(line)
+			doc.pop('_rev', None)
+			if '_id' not in doc:
+				doc['_id'] = self._progress.make_id(number)
+			read[0] += 1
+			if len(urls) > 1 and doc['_id'].startswith('_design/'):
+				# design documents live on every shard
+				targets = range(len(urls))
+				self._progress.expect(number, len(urls))
+			elif len(urls) > 1:
+				targets = [shard_index(doc['_id'], len(urls))]
+			else:
+				targets = [0]
+			for i in targets:
+				lines, docs = pending[i]
+				lines.append(number)
+				docs.append(doc)
+				if len(docs) >= self.sizer.size():
+					flush(i)
+			if number >= next_check:
+				for i in range(len(urls)):
+					lines = pending[i][0]
+					if lines and number - lines[0] >= self.max_lag:
+						flush(i)
+				next_check = number + max(1, self.max_lag / 4)
+		for i in range(len(urls)):
+			flush(i)
+
+	def run(self, path, checkpoint=True, restart=False):
+		"""Import the JSON lines file at path and return the stats.
+
+		checkpoint is the checkpoint file, True for path + ".checkpoint", or
+		None for none.  Raises ImportFailed if a batch can't be saved.
+		Documents that fail on their own (not conflicts) are counted in
+		stats['errors'] and listed in self.errors.
+		"""
+		if checkpoint is True:
+			checkpoint = path + ".checkpoint"
+		if restart and checkpoint and os.path.exists(checkpoint):
+			os.unlink(checkpoint)
+		self._resuming = bool(checkpoint) and os.path.exists(checkpoint)
+		if checkpoint:
+			self._progress = _Progress.load(checkpoint)
+			# keep the run id from the start, in case we stop before line 0 is done
+			self._progress.save()
+		else:
+			self._progress = _Progress(None)
+		self._failure = None
+
+		start = time.time()
+		urls = self._urls()
+		# a couple of batches per writer in memory, at most
+		queue = Queue.Queue(self.workers * 2)
+		threads = [threading.Thread(target=self._writer, args=(queue,), name="importer-%d" % i)
+			for i in range(self.workers)]
+		for thread in threads:
+			thread.setDaemon(True)
+			thread.start()
+		f = open_lines(path)
+		try:
+			self._read(f, queue, urls)
+		finally:
+			f.close()
+			for thread in threads:
+				queue.put(None)
+			for thread in threads:
+				thread.join()
+			self.stats['seconds'] += time.time() - start
+		if self._failure is not None:
+			raise ImportFailed("import of %s stopped at line %d: %s" % (path, self._progress.line, self._failure))
+		if checkpoint and os.path.exists(checkpoint):
+			os.unlink(checkpoint)
+		return self.stats
+
+def main(argv):
+	parser = optparse.OptionParser(usage="usage: %prog [options] <jsonl file> <database>")
+	parser.add_option("-j", "--workers", type="int", default=4, help="parallel writers [%default]")
+	parser.add_option("--batch-size", type="int", default=500, help="documents in the first batches [%default]")
+	parser.add_option("--max-batch", type="int", default=5000, help="largest batch [%default]")
+	parser.add_option("--conflicts", default="skip", help="skip, overwrite or merge [%default]")
+	parser.add_option("--shards", help="a lounge shard config, to write to the shards directly")
+	parser.add_option("--lounge", help="the lounge URL [the production lounge]")
+	parser.add_option("--restart", action="store_true", help="ignore the checkpoint and start over")
+	options, args = parser.parse_args(argv[1:])
+	if len(args) != 2:
+		parser.error("expected a file and a database")
+	if options.conflicts not in POLICIES:
+		parser.error("--conflicts must be one of %s" % ", ".join(POLICIES))
+
+	shard_map = None
+	if options.shards:
+		shard_map = ShardMap(options.shards)
+	importer = Importer(args[1], options.workers, options.batch_size, max_batch=options.max_batch,
+		conflicts=options.conflicts, shard_map=shard_map, db_connectinfo=options.lounge)
+	try:
+		stats = importer.run(args[0], restart=options.restart)
+		status = 0
+	except ImportFailed, e:
+		print >>sys.stderr, e
+		stats = importer.stats
+		status = 1
+	print "%d docs in %.1fs (%.1f docs/s), %d batches, final batch size %d" % (stats['docs'], stats['seconds'],
+		stats['seconds'] and stats['docs'] / stats['seconds'] or 0.0, stats['batches'], importer.sizer.size())
+	print "saved %(saved)d  skipped %(skipped)d  overwritten %(overwritten)d  merged %(merged)d  errors %(errors)d  retries %(retries)d" % stats
+	for error in importer.errors[:10]:
+		print "  %s" % error
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+"""Pull selected top-level fields out of a JSON object without parsing the rest.
+
+extract_fields scans the encoded object key by key.  Values of the fields
+that were asked for are decoded; the other fields are skipped over without
+building anything: strings and numbers with regular expressions, and nested
+objects or lists by scanning for their brackets (and the strings that might
+hold brackets).  Scanning stops as soon as every requested field has been
+found.
+
+This saves decoding work only; text is the whole encoded object, already
+in memory.
+"""
+
+import re
+try:
+	import simplejson as json
+except ImportError:
+	import json
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+# matches the rest of a string, starting just after the opening quote
+_string_rest = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_scalar = re.compile(r'[^,\]}\s]+')
+# everything up to the next bracket that isn't in a string
+_plain = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_closers = {'{': '}', '[': ']'}
+
+def _skip_string(text, idx):
+	"""Return the index just past the string starting at idx."""
+	match = _string_rest.match(text, idx + 1)
+	if match is None:
+		raise ValueError("Unterminated string at %d" % idx)
+	return match.end()
+
+def _skip_container(text, idx):
+	"""Return the index just past the object or list starting at idx.
+
+	Only brackets and strings are looked at; whatever is between them is
+	left for json to complain about if the field is ever decoded.  An
+	unterminated string shows up as a missing bracket.
+	"""
+	expected = [_closers[text[idx]]]
+	idx += 1
+	while expected:
+		idx = _plain.match(text, idx).end()
+		c = text[idx:idx+1]
+		if c == '{' or c == '[':
+			expected.append(_closers[c])
+			idx += 1
+		elif c and c == expected[-1]:
+			expected.pop()
+			idx += 1
+		else:
+			raise ValueError("Expected %r at %d" % (expected[-1], idx))
+	return idx
+
+def _skip_value(text, idx):
+	"""Return the index just past the value starting at idx."""
+	c = text[idx:idx+1]
+	if c == '"':
+		return _skip_string(text, idx)
+	if c == '{' or c == '[':
+		return _skip_container(text, idx)
+	match = _scalar.match(text, idx)
+	if match is None:
+		raise ValueError("Expected a value at %d" % idx)
+	return match.end()
+
+def _decode_key(text, start, end):
+	key = text[start+1:end-1]
+	if '\\' in key:
+		return json.loads(text[start:end])
+	if isinstance(key, str):
+		return key.decode('utf8')
+	return key
+
+def extract_fields(text, fields):
+	"""Decode only `fields` from the JSON object in `text`.
+
+	Returns a dict holding the fields that were present.
+	Raises ValueError if text isn't a JSON object.
+	"""
+	wanted = set(fields)
+	result = {}
+	idx = _whitespace.match(text, 0).end()
+	if text[idx:idx+1] != '{':
+		raise ValueError("Expected a JSON object")
+	idx = _whitespace.match(text, idx + 1).end()
+	if text[idx:idx+1] == '}':
+		return result
+	while True:
+		if text[idx:idx+1] != '"':
+			raise ValueError("Expected a key at %d" % idx)
+		end = _skip_string(text, idx)
+		key = _decode_key(text, idx, end)
+		idx = _whitespace.match(text, end).end()
+		if text[idx:idx+1] != ':':
+			raise ValueError("Expected ':' at %d" % idx)
+		idx = _whitespace.match(text, idx + 1).end()
+		if key in wanted:
+			result[key], idx = _decoder.raw_decode(text, idx)
+			if len(result) == len(wanted):
+				return result
+		else:
+			idx = _skip_value(text, idx)
+		idx = _whitespace.match(text, idx).end()
+		c = text[idx:idx+1]
+		if c == '}':
+			return result
+		if c != ',':
+			raise ValueError("Expected ',' or '}' at %d" % idx)
+		idx = _whitespace.match(text, idx + 1).end()
@@ -0,0 +1,350 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Local indexes of a database, kept in SQLite and queried without the network.
+
+A LocalIndex is like a view whose map function is Python and whose index
+lives in a file next to the client:
+
+	def by_email(doc):
+		if 'email' in doc:
+			yield doc['email'].lower(), None
+
+	index = LocalIndex("/var/cache/lounge/users-by-email.db", User, by_email)
+	index.update()
+	rows = index.query(key="kevin@example.com")
+	users = [User.find(row["id"]) for row in rows]
+
+The first update() reads the whole database through _all_docs, a page at
+a time.  Later ones read only what changed since, from _changes, and apply
+it in a transaction together with the new since vector, so an update that
+dies partway leaves the index where it was.  follow() does that from a
+background thread.
+
+If the map function changes, pass a new version and the index is rebuilt.
+
+Keys are stored so that SQLite's ordering matches CouchDB's (so {} still
+works as the high end of a range), except that strings sort by code point
+instead of by CouchDB's Unicode collation, and objects compare their
+members in name order rather than in the order they were written.  Ints
+are kept exact, so ones beyond 2**53 that CouchDB would see as the same
+double are still told apart.
+"""
+
+try:
+	import simplejson as json
+except ImportError:
+	import json
+import logging
+import sqlite3
+import struct
+import threading
+
+import httplib2
+
+from lounge import client
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS rows (key BLOB, id TEXT, json_key TEXT, value TEXT, PRIMARY KEY (key, id));
+CREATE INDEX IF NOT EXISTS rows_by_id ON rows (id);
+"""
+
+# type tags, in CouchDB's order; 0 ends an array or object
+_NULL, _FALSE, _TRUE, _NUMBER, _STRING, _ARRAY, _OBJECT = [chr(i) for i in range(1, 8)]
+_DOUBLE = struct.Struct(">d")
+# bump this whenever encode_key changes, so old index files are rebuilt
+KEY_FORMAT = "2"
+
+_MISSING = object()
+
+def encode_key(key):
+	"""A byte string for key that sorts the way CouchDB would sort key."""
+	parts = []
+	_encode(key, parts)
+	return "".join(parts)
+
+def _encode(key, parts):
+	if key is None:
+		parts.append(_NULL)
+	elif key is False:
+		parts.append(_FALSE)
+	elif key is True:
+		parts.append(_TRUE)
+	elif isinstance(key, (int, long, float)):
+		try:
+			approx = float(key)
+		except OverflowError:
+			raise ValueError("can't index %d, it's beyond the range of a double" % key)
+		data = _DOUBLE.pack(approx)
+		if ord(data[0]) & 0x80:
+			# negative: flip everything so bigger magnitudes sort first
+			data = "".join([chr(~ord(c) & 0xff) for c in data])
+		else:
+			data = chr(ord(data[0]) | 0x80) + data[1:]
+		# ints the double can't hold exactly (beyond 2**53) are told apart, and
+		# put in order, by how far they are from it
+		offset = 0
+		if not isinstance(key, float):
+			offset = key - long(approx)
+		parts.append(_NUMBER + data + _encode_offset(offset))
+	elif isinstance(key, basestring):
+		if isinstance(key, unicode):
+			key = key.encode("utf8")
+		# escape NULs so the terminator sorts before everything
+		parts.append(_STRING + key.replace("\0", "\0\1") + "\0\0")
+	elif isinstance(key, (list, tuple)):
+		parts.append(_ARRAY)
+		for item in key:
+			_encode(item, parts)
+		parts.append("\0")
+	elif isinstance(key, dict):
+		parts.append(_OBJECT)
+		for name, value in sorted(key.items()):
+			_encode(name, parts)
+			_encode(value, parts)
+		parts.append("\0")
+	else:
+		raise TypeError("can't index a key of type %s" % type(key).__name__)
+
+def _encode_offset(n):
+	"""n as a sign byte that also gives the length, then its magnitude in
+	big-endian bytes (complemented if negative), so the encodings sort like
+	the numbers and never run into what follows."""
+	digits = []
+	magnitude = abs(n)
+	while magnitude:
+		digits.append(chr(magnitude & 0xff))
+		magnitude >>= 8
+	digits.reverse()
+	if n < 0:
+		return chr(0x80 - len(digits)) + "".join([chr(~ord(c) & 0xff) for c in digits])
+	return chr(0x80 + len(digits)) + "".join(digits)
+
+class LocalIndex(object):
+	"""An index of (key, value) rows made by map_fun(doc) for each document of
+	doc_class's database.
+
+	map_fun yields (key, value) pairs, the same way a Python view function
+	does.  Design documents are skipped.
+	"""
+	def __init__(self, path, doc_class, map_fun, version=1, page_size=1000, db_connectinfo=None):
+		self.path = path
+		self.doc_class = doc_class
+		self.map_fun = map_fun
+		self.version = str(version)
+		self.page_size = page_size
+		self.db_connectinfo = db_connectinfo
+		self._local = threading.local()
+		self._write_lock = threading.Lock()
+		self._follower = None
+		conn = self._conn()
+		conn.executescript(SCHEMA)
+		if self._meta("version") != self.version or self._meta("key_format") != KEY_FORMAT:
+			# a new map function, or keys stored the old way; start over
+			conn.execute("DELETE FROM rows")
+			conn.execute("DELETE FROM meta")
+			self._set_meta("version", self.version)
+			self._set_meta("key_format", KEY_FORMAT)
+			conn.commit()
+
+	def _conn(self):
+		"""This thread's connection to the index."""
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = self._local.conn = sqlite3.connect(self.path)
+			conn.text_factory = str
+			# readers don't wait on the writer
+			conn.execute("PRAGMA journal_mode=WAL")
+		return conn
+
+	def _meta(self, name):
+		row = self._conn().execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+		return row and row[0] or None
+
+	def _set_meta(self, name, value):
+		self._conn().execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+	def _db_url(self):
+		return (self.db_connectinfo or client.get_db_connectinfo(self.doc_class)) + client.db_prefix + self.doc_class.db_name
+
+	def _resource(self):
+		resource = getattr(self._local, 'resource', None)
+		if resource is None:
+			resource = self._local.resource = client.Resource()
+			resource._key = self._db_url()
+		return resource
+
+	def _request(self, url, args=None):
+		return self._resource()._request('GET', url, args=args)
+
+	def since(self):
+		"""The update sequence (a vector, for a lounge) that the index is up to date with,
+		or None if it hasn't been built."""
+		since = self._meta("since")
+		return since and json.loads(since)
+
+	def _index(self, conn, doc):
+		"""Replace doc's rows; doc is the id alone if it was deleted."""
+		if isinstance(doc, basestring):
+			docid, doc = doc, None
+		else:
+			docid = doc['_id']
+		conn.execute("DELETE FROM rows WHERE id = ?", (docid,))
+		if doc is None or docid.startswith("_design/"):
+			return
+		rows = []
+		for key, value in self.map_fun(doc) or ():
+			rows.append((sqlite3.Binary(encode_key(key)), docid, json.dumps(key), json.dumps(value)))
+		conn.executemany("INSERT OR REPLACE INTO rows (key, id, json_key, value) VALUES (?, ?, ?, ?)", rows)
+
+	def build(self):
+		"""Index the whole database from scratch."""
+		self._write_lock.acquire()
+		try:
+			db_url = self._db_url()
+			# anything that changes while we read gets picked up from here
+			since = self._request(db_url)['update_seq']
+			conn = self._conn()
+			conn.execute("DELETE FROM rows")
+			args = {'include_docs': 'true', 'limit': self.page_size}
+			while True:
+				page = self._request(db_url + "/_all_docs", args)['rows']
+				for row in page:
+					if row.get('doc') is not None:
+						self._index(conn, row['doc'])
+				if len(page) < self.page_size:
+					break
+				args = {'include_docs': 'true', 'limit': self.page_size, 'skip': 1,
+					'startkey': json.dumps(page[-1]['id'])}
+			self._set_meta("since", json.dumps(since))
+			conn.commit()
+		except:
+			self._conn().rollback()
+			raise
+		finally:
+			self._write_lock.release()
+
+	def update(self, longpoll=None):
+		"""Apply the changes since the last update, building the index first if needed.
+
+		With longpoll (seconds), wait that long for a change if there's none.
+		Returns the number of changed documents.
+		"""
+		since = self.since()
+		if since is None:
+			self.build()
+			return 0
+		args = {'since': json.dumps(since), 'include_docs': 'true'}
+		if longpoll:
+			args.update({'feed': 'longpoll', 'timeout': int(longpoll * 1000)})
+		changes = self._request(self._db_url() + "/_changes", args)
+		self._write_lock.acquire()
+		try:
+			if self.since() != since:
+				# someone else applied them first
+				return 0
+			conn = self._conn()
+			try:
+				for change in changes['results']:
+					if change.get('deleted') or change.get('doc') is None:
+						self._index(conn, change['id'])
+					else:
+						self._index(conn, change['doc'])
+				self._set_meta("since", json.dumps(changes['last_seq']))
+				conn.commit()
+			except:
+				conn.rollback()
+				raise
+		finally:
+			self._write_lock.release()
+		return len(changes['results'])
+
+	def follow(self, timeout=60, retry=5):
+		"""Keep the index up to date from a background thread until stop() is called."""
+		if self._follower is None:
+			self._follower = _Follower(self, timeout, retry)
+		return self._follower
+
+	def stop(self):
+		if self._follower is not None:
+			self._follower.stop()
+			self._follower = None
+
+	def query(self, key=_MISSING, startkey=None, endkey=None, limit=None, descending=False, inclusive_end=True):
+		"""The rows for key, or between startkey and endkey, as ViewRows with
+		the id, key and value of each.
+
+		Like a view, rows come in key order, then document id order.
+		"""
+		conditions = []
+		params = []
+		if key is not _MISSING:
+			conditions.append("key = ?")
+			params.append(sqlite3.Binary(encode_key(key)))
+		else:
+			low, low_inclusive, high, high_inclusive = startkey, True, endkey, inclusive_end
+			if descending:
+				low, low_inclusive, high, high_inclusive = endkey, inclusive_end, startkey, True
+			if low is not None:
+				conditions.append(low_inclusive and "key >= ?" or "key > ?")
+				params.append(sqlite3.Binary(encode_key(low)))
+			if high is not None:
+				conditions.append(high_inclusive and "key <= ?" or "key < ?")
+				params.append(sqlite3.Binary(encode_key(high)))
+		sql = "SELECT id, json_key, value FROM rows"
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		if descending:
+			sql += " ORDER BY key DESC, id DESC"
+		else:
+			sql += " ORDER BY key, id"
+		if limit is not None:
+			sql += " LIMIT %d" % limit
+		rows = self._conn().execute(sql, params).fetchall()
+		return client.ViewRows([{"id": id, "key": json.loads(key), "value": json.loads(value)} for id, key, value in rows])
+
+	def __len__(self):
+		return self._conn().execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+	def close(self):
+		"""Stop following and close this thread's connection."""
+		self.stop()
+		conn = getattr(self._local, 'conn', None)
+		if conn is not None:
+			conn.close()
+			self._local.conn = None
+
+class _Follower(object):
+	def __init__(self, index, timeout, retry):
+		self.index = index
+		self.timeout = timeout
+		self.retry = retry
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="LocalIndex")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def _run(self):
+		# longpolls outlast the usual db_timeout
+		self.index._resource()._http = httplib2.Http(timeout=self.timeout + 30)
+		while not self._stopped.isSet():
+			try:
+				self.index.update(longpoll=self.timeout)
+			except Exception:
+				logging.exception("LocalIndex: updating %s failed" % self.index.path)
+				self._stopped.wait(self.retry)
+
+	def stop(self):
+		self._stopped.set()
@@ -0,0 +1,179 @@
+"""Selectors for reaching into nested records.
+
+A selector is a dotted path through dicts, with optional list indices:
+
+	'profile.name'
+	'profile.emails[0].address'
+	'rows[-1]'
+
+Only a part of the form name[N][M]... is read as list indices.  A part with
+other brackets in it, like 'a[b' or 'x[]', is a dict key as it is, the way
+every selector part was before list indices were supported.
+
+Selectors are parsed once and kept in a bounded cache, so repeating the same
+selector costs a dict lookup.  To pull many fields out of many records (say
+the docs of an include_docs view), build a Projection once and run it over
+the records; selectors that share a prefix only walk that prefix once.
+"""
+
+import re
+
+# how many compiled selectors to keep around
+path_cache_size = 1024
+
+_path_cache = {}
+_part = re.compile(r'^([^\[\]]*)((?:\[-?\d+\])*)$')
+_index = re.compile(r'\[(-?\d+)\]')
+
+def compile_path(selector):
+	"""Turn a selector into a tuple of steps.
+
+	String steps are dict keys and int steps are list indices.
+	"""
+	steps = _path_cache.get(selector)
+	if steps is None:
+		steps = []
+		for part in selector.split('.'):
+			match = _part.match(part)
+			if match is None:
+				# not an index; a key with brackets in it
+				steps.append(part)
+				continue
+			name, indices = match.groups()
+			if name or not indices:
+				steps.append(name)
+			steps.extend([int(i) for i in _index.findall(indices)])
+		steps = tuple(steps)
+		if len(_path_cache) >= path_cache_size:
+			_path_cache.clear()
+		_path_cache[selector] = steps
+	return steps
+
+def _step(it, step):
+	"""Take one step into a record, returning None if there's nowhere to go."""
+	if isinstance(step, int):
+		if not isinstance(it, (list, tuple)):
+			return None
+		try:
+			return it[step]
+		except IndexError:
+			return None
+	if not hasattr(it, 'get'):
+		return None
+	return it.get(step, None)
+
+def get_path(it, selector):
+	"""Finds a value deep within a collection of collections, hopefully without throwing any KeyErrors along the way.
+
+	Returns None if any step along the selector is missing."""
+	for step in compile_path(selector):
+		if isinstance(step, int):
+			if not isinstance(it, (list, tuple)):
+				return None
+			try:
+				it = it[step]
+			except IndexError:
+				return None
+		else:
+			if not hasattr(it, 'get'):
+				return None
+			it = it.get(step, None)
+	return it
+
+def _container_for(step):
+	"""An empty container that the given step can go into."""
+	if isinstance(step, int):
+		return []
+	return {}
+
+def _check_step(it, step, selector):
+	if isinstance(step, int):
+		if not isinstance(it, list):
+			raise TypeError("Can't index a %s with [%d] in %r" % (type(it).__name__, step, selector))
+	elif isinstance(it, (list, tuple)):
+		raise TypeError("Can't look up %r in a %s in %r" % (step, type(it).__name__, selector))
+
+def set_path(it, selector, value):
+	"""Like get_path, but sets a value instead.
+
+	Missing dicts along the way are created.  A list index equal to the length
+	of the list appends to it; other missing indices raise IndexError.  A list
+	index into something other than a list, or a key into a list, raises
+	TypeError.
+	"""
+	steps = compile_path(selector)
+	last = len(steps) - 1
+	for i, step in enumerate(steps):
+		_check_step(it, step, selector)
+		if i == last:
+			if isinstance(step, int) and step == len(it):
+				it.append(value)
+			else:
+				it[step] = value
+			return value
+		if isinstance(step, int):
+			if step == len(it):
+				it.append(_container_for(steps[i+1]))
+			it = it[step]
+		else:
+			try:
+				it = it[step]
+			except KeyError:
+				it[step] = _container_for(steps[i+1])
+				it = it[step]
+
+def get_paths(it, selectors):
+	"""Get the values of several selectors from one record, as a list."""
+	return Projection(selectors).extract(it)
+
+def project(records, selectors):
+	"""Get the values of several selectors from each of many records.
+
+	Returns a list with one list of values per record.
+	"""
+	return Projection(selectors).extract_all(records)
+
+class Projection(object):
+	"""A set of selectors compiled into a tree of steps.
+
+	Ex:
+	  p = Projection(['name', 'emails[0]', 'address.zip'])
+	  for name, email, zipcode in p.extract_all(view.rows.docs()): ...
+	"""
+	def __init__(self, selectors):
+		self.selectors = list(selectors)
+		tree = {}
+		for slot, selector in enumerate(self.selectors):
+			node = tree
+			steps = compile_path(selector)
+			for i, step in enumerate(steps):
+				child, slots = node.setdefault(step, ({}, []))
+				if i == len(steps) - 1:
+					slots.append(slot)
+				node = child
+		self._tree = self._freeze(tree)
+
+	def _freeze(self, node):
+		# lists of tuples are quicker to walk than dicts
+		return [(step, self._freeze(child), slots)
+				for step, (child, slots) in node.iteritems()]
+
+	def _walk(self, it, node, out):
+		for step, child, slots in node:
+			value = _step(it, step)
+			if value is None:
+				continue
+			for slot in slots:
+				out[slot] = value
+			if child:
+				self._walk(value, child, out)
+
+	def extract(self, it):
+		"""Return the values of all the selectors for one record."""
+		out = [None] * len(self.selectors)
+		self._walk(it, self._tree, out)
+		return out
+
+	def extract_all(self, records):
+		"""Return a list of extracted values for each record."""
+		return [self.extract(it) for it in records]
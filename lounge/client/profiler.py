@@ -0,0 +1,328 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""A sampling profiler that can be switched on in a running process.
+
+A background thread samples the stacks of every other thread every
+`interval` seconds.  Each sample is put down to a phase of the client
+pipeline by the innermost frame it recognizes:
+
+	encode     Resource._encode and the JSON encoder
+	validate   Document.validate and lounge.client.schema/validations
+	quote      URL quoting (urllib.quote, urlencode)
+	connect    opening the connection
+	send       writing the request
+	wait       waiting for the response status and headers
+	read       reading the response body
+	decode     Resource._decode, extract_fields and the JSON decoder
+	row-wrap   TuplyDict, ViewRow and ViewRows
+	client     anything else in lounge.client
+	app        everything else
+
+Sampling from a thread sees wall clock time, network waits included, but
+not what happens inside C calls; start(cpu=True) samples the main thread's
+CPU time on SIGPROF instead (see SignalSampler).
+
+Nothing is hooked when the profiler is off, so it costs nothing until
+it's started.  From code:
+
+	profiler.start()
+	...
+	profile = profiler.stop()
+	print profile.report()
+	profile.write_collapsed("/tmp/worker.folded")
+
+or from outside, after install_signal_handler() at startup:
+
+	kill -USR2 <pid>    # start
+	kill -USR2 <pid>    # stop, and write /tmp/lounge-profile.<pid>.folded
+
+The .folded files are collapsed stacks ("frame;frame;frame count"), the
+input to flamegraph.pl and friends.  Each stack starts with its phase in
+brackets, so the flame graph groups by phase.
+"""
+
+import httplib
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib
+
+import httplib2
+
+from lounge import client
+from lounge.client import jsonfields, schema, validations
+
+PHASES = ["encode", "validate", "quote", "connect", "send", "wait", "read", "decode", "row-wrap", "client", "app"]
+
+_phase_codes = None
+
+def _codes(owner, names=None):
+	"""The code objects of the functions and methods named in owner (all of them if names is None)."""
+	codes = []
+	if names is None:
+		names = dir(owner)
+	for name in names:
+		f = getattr(owner, name, None)
+		f = getattr(f, 'im_func', f)
+		f = getattr(f, '__func__', f)
+		code = getattr(f, 'func_code', None)
+		if code is not None:
+			codes.append(code)
+	return codes
+
+def _modules(*names):
+	"""The json modules that are loaded, both the stdlib's and simplejson's."""
+	modules = []
+	for name in names:
+		for prefix in ("json.", "simplejson."):
+			module = sys.modules.get(prefix + name)
+			if module is not None:
+				modules.append(module)
+	return modules
+
+def _build_phase_codes():
+	table = {}
+	def add(phase, codes):
+		for code in codes:
+			table.setdefault(code, phase)
+
+	add("encode", _codes(client.Resource, ["_encode"]))
+	add("encode", _codes(client.json, ["dumps"]))
+	for module in _modules("encoder"):
+		add("encode", _codes(module))
+		add("encode", _codes(getattr(module, "JSONEncoder", None)))
+	add("validate", _codes(client.Document, ["validate", "_get_validators"]))
+	add("validate", _codes(schema))
+	add("validate", _codes(validations))
+	add("quote", _codes(urllib, ["quote", "quote_plus", "urlencode"]))
+	add("connect", _codes(httplib.HTTPConnection, ["connect"]))
+	add("connect", _codes(httplib2.HTTPConnectionWithTimeout, ["connect"]))
+	add("connect", _codes(socket, ["create_connection"]))
+	add("send", _codes(httplib.HTTPConnection, ["request", "_send_request", "_send_output", "endheaders", "send", "putrequest", "putheader"]))
+	add("wait", _codes(httplib.HTTPResponse, ["begin", "_read_status"]))
+	add("wait", _codes(httplib.HTTPConnection, ["getresponse"]))
+	add("read", _codes(httplib.HTTPResponse, ["read", "_read_chunked", "_safe_read"]))
+	add("decode", _codes(client.Resource, ["_decode", "_decode_fields"]))
+	add("decode", _codes(jsonfields))
+	for module in _modules("decoder", "scanner"):
+		add("decode", _codes(module))
+		add("decode", _codes(getattr(module, "JSONDecoder", None)))
+	add("decode", _codes(client.json, ["loads"]))
+	for cls in (client.TuplyDict, client.ViewRow, client.ViewRows):
+		add("row-wrap", _codes(cls))
+	table.pop(None, None)
+	return table
+
+def _phase_table():
+	global _phase_codes
+	if _phase_codes is None:
+		_phase_codes = _build_phase_codes()
+	return _phase_codes
+
+_labels = {}
+
+def _label(frame):
+	code = frame.f_code
+	label = _labels.get(code)
+	if label is None:
+		module = frame.f_globals.get('__name__', '?')
+		label = ("%s:%s" % (module, code.co_name)).replace(";", ":").replace(" ", "_")
+		_labels[code] = label
+	return label
+
+def sample_phase(frame, phase_codes=None):
+	"""The phase of the stack whose innermost frame is frame."""
+	if phase_codes is None:
+		phase_codes = _phase_table()
+	in_client = False
+	while frame is not None:
+		phase = phase_codes.get(frame.f_code)
+		if phase is not None:
+			return phase
+		if not in_client and frame.f_globals.get('__name__', '').startswith('lounge.client'):
+			in_client = True
+		frame = frame.f_back
+	if in_client:
+		return "client"
+	return "app"
+
+class Profile(object):
+	"""The samples taken between a start and a stop."""
+	def __init__(self, interval):
+		self.interval = interval
+		self.started = time.time()
+		self.stopped = None
+		self.samples = 0
+		# (phase, frame labels from the outermost in) -> count
+		self.stacks = {}
+		self.phases = dict([(phase, 0) for phase in PHASES])
+
+	def add(self, frame, phase_codes):
+		phase = sample_phase(frame, phase_codes)
+		labels = []
+		while frame is not None:
+			labels.append(_label(frame))
+			frame = frame.f_back
+		labels.reverse()
+		key = (phase, tuple(labels))
+		self.stacks[key] = self.stacks.get(key, 0) + 1
+		self.phases[phase] += 1
+		self.samples += 1
+
+	def duration(self):
+		return (self.stopped or time.time()) - self.started
+
+	def collapsed(self):
+		"""The samples as collapsed stack lines, for flame graphs."""
+		lines = []
+		for (phase, labels), count in sorted(self.stacks.items()):
+			lines.append("[%s];%s %d" % (phase, ";".join(labels), count))
+		return lines
+
+	def write_collapsed(self, path):
+		f = open(path, "w")
+		try:
+			for line in self.collapsed():
+				f.write(line + "\n")
+		finally:
+			f.close()
+
+	def phase_fractions(self):
+		"""phase -> the fraction of the samples spent in it."""
+		if not self.samples:
+			return dict([(phase, 0.0) for phase in PHASES])
+		return dict([(phase, count / float(self.samples)) for phase, count in self.phases.items()])
+
+	def report(self):
+		lines = ["%d samples over %.1fs" % (self.samples, self.duration())]
+		fractions = self.phase_fractions()
+		for phase in PHASES:
+			if self.phases[phase]:
+				lines.append("%-10s %5.1f%%  %d" % (phase, fractions[phase] * 100, self.phases[phase]))
+		return "\n".join(lines)
+
+class Sampler(object):
+	"""Samples the stacks of all other threads every interval seconds until stopped."""
+	def __init__(self, interval=0.005):
+		self.profile = Profile(interval)
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="Sampler")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def _run(self):
+		phase_codes = _phase_table()
+		me = threading.currentThread().ident
+		interval = self.profile.interval
+		while not self._stopped.isSet():
+			for ident, frame in sys._current_frames().items():
+				if ident != me:
+					self.profile.add(frame, phase_codes)
+			del frame
+			time.sleep(interval)
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not threading.currentThread():
+			self._thread.join()
+		self.profile.stopped = time.time()
+		return self.profile
+
+class SignalSampler(object):
+	"""Samples the main thread on SIGPROF, every interval seconds of CPU time.
+
+	A sampler thread only gets to look at the other threads between Python
+	bytecodes, so it misses time spent inside C calls (the C JSON encoder and
+	decoder, for one) and puts it down to whatever runs next.  A SIGPROF
+	handler runs right after the C call returns, in the frame that made it,
+	so the time goes to the right phase.  It only sees the main thread, and
+	only time on the CPU: nothing is sampled while waiting on the network.
+	Start and stop it from the main thread.
+	"""
+	def __init__(self, interval=0.005):
+		self.profile = Profile(interval)
+		phase_codes = _phase_table()
+		def sample(signum, frame):
+			self.profile.add(frame, phase_codes)
+		self._old_handler = signal.signal(signal.SIGPROF, sample)
+		signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0)
+		signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+		self.profile.stopped = time.time()
+		return self.profile
+
+# reentrant, since the signal handler can run while the main thread holds it
+_lock = threading.RLock()
+_sampler = None
+
+def start(interval=0.005, cpu=False):
+	"""Start profiling.  Does nothing if the profiler is already running.
+
+	By default every thread is sampled every interval seconds of wall clock
+	time.  With cpu=True, the main thread is sampled every interval seconds
+	of CPU time instead; see SignalSampler.
+	"""
+	global _sampler
+	_lock.acquire()
+	try:
+		if _sampler is None:
+			if cpu:
+				_sampler = SignalSampler(interval)
+			else:
+				_sampler = Sampler(interval)
+	finally:
+		_lock.release()
+
+def stop():
+	"""Stop profiling and return the Profile, or None if it wasn't running."""
+	global _sampler
+	_lock.acquire()
+	try:
+		sampler, _sampler = _sampler, None
+	finally:
+		_lock.release()
+	if sampler is None:
+		return None
+	return sampler.stop()
+
+def running():
+	return _sampler is not None
+
+def install_signal_handler(signum=signal.SIGUSR2, path="/tmp/lounge-profile.%(pid)d.folded", interval=0.005, cpu=False):
+	"""Toggle the profiler on signum.
+
+	Stopping writes the collapsed stacks to path (with %(pid)d filled in)
+	and the phase report to path + ".txt".
+	"""
+	def toggle(signum, frame):
+		if not running():
+			start(interval, cpu)
+			return
+		profile = stop()
+		if profile is None:
+			return
+		out = path % {'pid': os.getpid()}
+		profile.write_collapsed(out)
+		f = open(out + ".txt", "w")
+		try:
+			f.write(profile.report() + "\n")
+		finally:
+			f.close()
+	return signal.signal(signum, toggle)
@@ -0,0 +1,406 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Record the requests lounge.client makes and replay them as a load test.
+
+Recording hooks Resource._request, so every find, save, view query and so on
+is logged with its method, URL, body size, status and timing:
+
+	from lounge.client import replay
+	replay.start_recording("/tmp/workload.lwl")
+	...
+	replay.stop_recording()
+
+URLs are stored without the host and without db_prefix, so a workload
+recorded against one lounge can be replayed against another.  Bodies are
+not kept unless you pass keep_bodies=True; on replay, writes get a body of
+the recorded size instead.
+
+To replay a workload at its original pace with 8 connections:
+
+	python -m lounge.client.replay -c 8 /tmp/workload.lwl http://lounge.dev:6984/
+
+--speed 2 replays it twice as fast, and --max as fast as the target can
+take it.  Run it without a target to see what was recorded.
+"""
+
+import cgi
+import optparse
+import re
+import struct
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import httplib2
+
+from lounge import client, percentile
+from lounge.client import Resource
+
+MAGIC = "LWL1"
+# magic, wall clock time the recording started
+HEADER = struct.Struct("<4sd")
+# offset from the start, elapsed, status, method, body size, url length, stored body length
+RECORD = struct.Struct("<dfHBIHI")
+
+# the largest url and body lengths a record has room for
+MAX_URL = 0xffff
+MAX_BODY = 0xffffffff
+
+METHODS = ["GET", "PUT", "POST", "DELETE", "HEAD", "COPY"]
+_METHOD_CODES = dict([(name, i) for i, name in enumerate(METHODS)])
+
+# the start of a document or of a save response
+_REV = re.compile(r'"_?rev"\s*:\s*"([^"]+)"')
+
+class InvalidWorkload(Exception):
+	pass
+
+class RecordedRequest(object):
+	"""One request from a workload file."""
+	__slots__ = ['offset', 'elapsed', 'status', 'method', 'body_size', 'url', 'body']
+
+	def __init__(self, offset, elapsed, status, method, body_size, url, body=None):
+		self.offset = offset
+		self.elapsed = elapsed
+		self.status = status
+		self.method = method
+		self.body_size = body_size
+		self.url = url
+		self.body = body
+
+	def __repr__(self):
+		return "<%s %s %d %.1fms at %.3fs>" % (self.method, self.url, self.status, self.elapsed * 1000, self.offset)
+
+def url_template(uri):
+	"""The part of a request URI that is kept: the path and query, without db_prefix."""
+	scheme, netloc, path, query, fragment = urlparse.urlsplit(uri)
+	if client.db_prefix and path.startswith("/" + client.db_prefix):
+		path = "/" + path[len(client.db_prefix) + 1:]
+	if query:
+		return path + "?" + query
+	return path
+
+class Recorder(object):
+	"""Appends every request lounge.client makes to a workload file.
+
+	Install one with start_recording, or by setting lounge.client.recorder.
+	Requests with URLs longer than MAX_URL bytes can't be replayed from a
+	record, so they're counted in skipped instead.
+	"""
+	def __init__(self, path, keep_bodies=False):
+		self.path = path
+		self.keep_bodies = keep_bodies
+		self.count = 0
+		self.skipped = 0
+		self._lock = threading.Lock()
+		self._file = open(path, "wb")
+		self._start = time.time()
+		self._file.write(HEADER.pack(MAGIC, self._start))
+
+	def record(self, method, uri, body, status, start, elapsed):
+		"""Called by Resource._request after each request, successful or not.
+
+		body is the encoded request body, or None.
+		"""
+		url = url_template(uri)
+		if isinstance(url, unicode):
+			url = url.encode("utf8")
+		if len(url) > MAX_URL:
+			self._lock.acquire()
+			self.skipped += 1
+			self._lock.release()
+			return
+		body_size = min(body and len(body) or 0, MAX_BODY)
+		stored = ""
+		if self.keep_bodies and body and len(body) <= MAX_BODY:
+			stored = body
+		entry = RECORD.pack(start - self._start, elapsed, min(max(status, 0), 0xffff),
+			_METHOD_CODES.get(method, 0), body_size, len(url), len(stored)) + url + stored
+		self._lock.acquire()
+		try:
+			if self._file is not None:
+				self._file.write(entry)
+				self.count += 1
+		finally:
+			self._lock.release()
+
+	def close(self):
+		self._lock.acquire()
+		try:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+		finally:
+			self._lock.release()
+
+def start_recording(path, keep_bodies=False):
+	"""Start recording the requests made by this process to path."""
+	stop_recording()
+	client.recorder = Recorder(path, keep_bodies)
+	return client.recorder
+
+def stop_recording():
+	"""Stop recording, and return the Recorder that was in use, if any."""
+	recorder, client.recorder = client.recorder, None
+	if recorder is not None:
+		recorder.close()
+	return recorder
+
+def read_workload(path):
+	"""Return the start time and the list of RecordedRequests in a workload file."""
+	f = open(path, "rb")
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	if len(data) < HEADER.size:
+		raise InvalidWorkload("%s is not a workload file" % path)
+	magic, started = HEADER.unpack_from(data, 0)
+	if magic != MAGIC:
+		raise InvalidWorkload("%s is not a workload file" % path)
+	requests = []
+	offset = HEADER.size
+	# a partial record at the end is from a recorder that didn't get to close
+	while offset + RECORD.size <= len(data):
+		start, elapsed, status, method, body_size, url_len, stored_len = RECORD.unpack_from(data, offset)
+		offset += RECORD.size
+		if offset + url_len + stored_len > len(data):
+			break
+		url = data[offset:offset+url_len]
+		offset += url_len
+		body = None
+		if stored_len:
+			body = data[offset:offset+stored_len]
+			offset += stored_len
+		requests.append(RecordedRequest(start, elapsed, status, METHODS[method], body_size, url, body))
+	return started, requests
+
+def latency_summary(latencies):
+	"""p50, p90, p99 and max of a list of latencies, in seconds."""
+	latencies = sorted(latencies)
+	summary = {}
+	for p in (50, 90, 99):
+		summary['p%d' % p] = percentile(latencies, p)
+	summary['max'] = latencies and latencies[-1] or None
+	return summary
+
+class _ReplayResource(Resource):
+	def _encode(self, payload):
+		return "application/json", payload
+
+def _is_document(path):
+	"""Whether path is a document (/db/id) rather than a database or a _special resource."""
+	parts = path.strip("/").split("/")
+	if len(parts) == 3 and parts[1] == "_design":
+		return True
+	return len(parts) == 2 and not parts[1].startswith("_")
+
+def _synthetic_body(path, size, rev):
+	"""A JSON body of about size bytes that the resource at path will accept."""
+	if path.endswith("/_bulk_docs"):
+		return '{"docs": [{"pad": "%s"}]}' % ("x" * max(0, size - 24))
+	if path.endswith("/_all_docs") or "/_view/" in path:
+		return '{"keys": []}'
+	if rev is not None:
+		return '{"_rev": "%s", "pad": "%s"}' % (rev, "x" * max(0, size - len(rev) - 21))
+	return '{"pad": "%s"}' % ("x" * max(0, size - 11))
+
+_STORED_REV = re.compile(r'("_rev"\s*:\s*)"[^"]*"')
+
+class Replayer(object):
+	"""Replays RecordedRequests against the lounge at base_url.
+
+	speed scales the original pace (2 is twice as fast); None replays as fast
+	as possible.  Documents' revisions are tracked as they're read and
+	written, so replayed updates and deletes don't just conflict.
+	"""
+	def __init__(self, requests, base_url, prefix='', speed=1.0, concurrency=1, timeout=None):
+		self.requests = requests
+		self.base_url = base_url.rstrip("/")
+		self.prefix = prefix
+		self.speed = speed
+		self.concurrency = concurrency
+		self.timeout = timeout
+		self._revs = {}
+		self._lock = threading.Lock()
+
+	def _url(self, url, rev):
+		path, sep, query = url.partition("?")
+		if rev is not None and query:
+			args = [(k, k == "rev" and rev or v) for k, v in cgi.parse_qsl(query, keep_blank_values=True)]
+			query = urllib.urlencode(args)
+		if self.prefix:
+			path = "/" + self.prefix + path.lstrip("/")
+		return self.base_url + path + (query and "?" + query or "")
+
+	def _body(self, request, path, rev):
+		if request.body is not None:
+			if rev is not None:
+				return _STORED_REV.sub(lambda m: '%s"%s"' % (m.group(1), rev), request.body, 1)
+			return request.body
+		if request.method in ("PUT", "POST") and request.body_size:
+			return _synthetic_body(path, request.body_size, rev)
+		return None
+
+	def _issue(self, resource, request):
+		path = request.url.partition("?")[0]
+		document = _is_document(path)
+		rev = document and self._revs.get(path) or None
+		url = self._url(request.url, rev)
+		resource._key = url
+		content, content_type = resource._request(request.method, url, body=self._body(request, path, rev), raw=True)
+		if document:
+			if request.method == "DELETE":
+				self._revs.pop(path, None)
+			elif request.method in ("GET", "PUT"):
+				match = _REV.search(content, 0, 512)
+				if match:
+					self._revs[path] = match.group(1)
+
+	def _worker(self, queue, start, results):
+		resource = _ReplayResource()
+		resource._http = httplib2.Http(timeout=self.timeout)
+		latencies, errors, lateness = [], {}, 0.0
+		while True:
+			self._lock.acquire()
+			try:
+				request = queue.next()
+			except StopIteration:
+				request = None
+			self._lock.release()
+			if request is None:
+				break
+			if self.speed:
+				delay = start + request.offset / self.speed - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				else:
+					lateness = max(lateness, -delay)
+			issued = time.time()
+			try:
+				self._issue(resource, request)
+			except Exception, e:
+				# mostly LoungeError subclasses: NotFound, RevisionConflict, ...
+				errors[e.__class__.__name__] = errors.get(e.__class__.__name__, 0) + 1
+				continue
+			latencies.append(time.time() - issued)
+		self._lock.acquire()
+		try:
+			results.append((latencies, errors, lateness))
+		finally:
+			self._lock.release()
+
+	def run(self):
+		"""Replay the workload and return a dict summarizing how it went.
+
+		The summary has the number of requests, the elapsed time, throughput
+		(requests per second), the latency percentiles of the successful
+		requests, errors (a dict of LoungeError subclass name to count), and
+		behind, how far behind the original pace the replay fell.
+		"""
+		if self.requests:
+			first = self.requests[0].offset
+		else:
+			first = 0.0
+		# shift the schedule so the first request goes out right away
+		start = time.time() - first / (self.speed or 1)
+		queue = iter(self.requests)
+		results = []
+		threads = []
+		began = time.time()
+		for i in range(self.concurrency):
+			thread = threading.Thread(target=self._worker, args=(queue, start, results), name="Replayer-%d" % i)
+			thread.setDaemon(True)
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		elapsed = time.time() - began
+
+		latencies, errors, behind = [], {}, 0.0
+		for worker_latencies, worker_errors, lateness in results:
+			latencies.extend(worker_latencies)
+			for name, count in worker_errors.iteritems():
+				errors[name] = errors.get(name, 0) + count
+			behind = max(behind, lateness)
+		summary = latency_summary(latencies)
+		summary.update({
+			'requests': len(self.requests),
+			'elapsed': elapsed,
+			'throughput': elapsed and len(self.requests) / elapsed or 0.0,
+			'errors': errors,
+			'behind': behind,
+		})
+		return summary
+
+def replay(requests, base_url, prefix='', speed=1.0, concurrency=1, timeout=None):
+	"""Replay requests against base_url; see Replayer."""
+	return Replayer(requests, base_url, prefix, speed, concurrency, timeout).run()
+
+def _ms(value):
+	if value is None:
+		return "-"
+	return "%.1fms" % (value * 1000)
+
+def _print_latencies(summary):
+	print "latency p50: %s  p90: %s  p99: %s  max: %s" % (_ms(summary['p50']), _ms(summary['p90']), _ms(summary['p99']), _ms(summary['max']))
+
+def describe(requests):
+	"""Print what a workload holds."""
+	duration = requests and requests[-1].offset + requests[-1].elapsed or 0.0
+	print "%d requests over %.1fs" % (len(requests), duration)
+	methods = {}
+	statuses = {}
+	for request in requests:
+		methods[request.method] = methods.get(request.method, 0) + 1
+		statuses[request.status] = statuses.get(request.status, 0) + 1
+	print "methods: %s" % "  ".join(["%s %d" % item for item in sorted(methods.items())])
+	print "statuses: %s" % "  ".join(["%d: %d" % item for item in sorted(statuses.items())])
+	_print_latencies(latency_summary([r.elapsed for r in requests if r.status < 400]))
+
+def main(argv):
+	parser = optparse.OptionParser(usage="usage: %prog [options] <workload file> [<target url>]")
+	parser.add_option("-c", "--concurrency", type="int", default=1, help="connections to replay over [%default]")
+	parser.add_option("--speed", type="float", default=1.0, help="multiple of the original pace [%default]")
+	parser.add_option("--max", action="store_true", help="replay as fast as possible")
+	parser.add_option("--prefix", default="", help="prefix for the database names")
+	parser.add_option("--timeout", type="float", help="request timeout in seconds")
+	options, args = parser.parse_args(argv[1:])
+	if len(args) not in (1, 2):
+		parser.error("expected a workload file and an optional target")
+	started, requests = read_workload(args[0])
+	if len(args) == 1:
+		print "recorded %s" % time.ctime(started)
+		describe(requests)
+		return 0
+
+	speed = options.speed
+	if options.max:
+		speed = None
+	summary = replay(requests, args[1], options.prefix, speed, options.concurrency, options.timeout)
+	print "%d requests in %.1fs: %.1f requests/s" % (summary['requests'], summary['elapsed'], summary['throughput'])
+	_print_latencies(summary)
+	if speed:
+		print "fell behind the original pace by up to %s" % _ms(summary['behind'])
+	if summary['errors']:
+		print "errors: %s" % "  ".join(["%s %d" % item for item in sorted(summary['errors'].items())])
+	else:
+		print "errors: none"
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
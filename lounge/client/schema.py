@@ -0,0 +1,249 @@
+"""Declarative document schemas.
+
+Instead of building a validate_ method per attribute out of the helpers in
+lounge.client.validations, a Document subclass can describe its record with
+a schema.  The schema is compiled once per class into a single generated
+function that walks the record one time and reports problems through
+set_error, using the same messages as the validation helpers.
+
+Example:
+
+from lounge.client.schema import Field, ListOf, Object
+
+class Person(Document):
+	db_name = "people"
+	_schema = {
+		'name': Field(basestring, required=True, min_length=1, max_length=64),
+		'age': Field(int, min=0, max=150),
+		'email': Field(basestring, matches=r'^[^@]+@[^@]+$'),
+		'tags': ListOf(Field(basestring, not_blank=True), max_length=10),
+		'address': Object({'zip': Field(basestring, matches=r'^\d{5}$')}),
+	}
+
+	# hand-written validations still run after the schema
+	def validate_not_a_robot(self):
+		...
+
+Errors for list items are filed under the list attribute (like
+validations.each), and errors for nested objects under the dotted path,
+e.g. 'address.zip'.
+"""
+
+import re
+
+class Field(object):
+	"""Rules for one attribute of a record.
+
+	`type` -- a type or tuple of types the value must be an instance of
+	`required` -- the attribute must exist
+	`min_length`, `max_length` -- bounds on len(value)
+	`not_empty` -- len(value) must be > 0
+	`min`, `max` -- bounds on int(value)
+	`matches` -- a regular expression the value must match
+	`not_blank` -- the value must contain a non-whitespace character
+	`each` -- a Field applied to every item of a list value
+	`fields` -- a dict of Fields for the attributes of a nested object
+	`msg` -- use this message for every error on this field
+	"""
+	def __init__(self, type=None, required=False, min_length=None, max_length=None,
+			not_empty=False, min=None, max=None, matches=None, not_blank=False,
+			each=None, fields=None, msg=None):
+		self.type = type
+		self.required = required
+		self.min_length = min_length
+		self.max_length = max_length
+		self.not_empty = not_empty
+		self.min = min
+		self.max = max
+		self.matches = matches
+		self.not_blank = not_blank
+		self.each = each
+		self.fields = fields
+		self.msg = msg
+
+def ListOf(item, **kwargs):
+	"""A list attribute whose items all follow the Field `item`."""
+	kwargs.setdefault('type', list)
+	return Field(each=item, **kwargs)
+
+def Object(fields, **kwargs):
+	"""A nested object whose attributes follow the dict of Fields `fields`."""
+	kwargs.setdefault('type', dict)
+	return Field(fields=fields, **kwargs)
+
+# sentinel for attributes missing from the record
+_MISSING = object()
+
+def _type_name(typ):
+	if isinstance(typ, tuple):
+		return ' or '.join([t.__name__ for t in typ])
+	return typ.__name__
+
+def _is_numeric(typ):
+	if not isinstance(typ, tuple):
+		typ = (typ,)
+	for t in typ:
+		if not (issubclass(t, (int, long, float)) and not issubclass(t, bool)):
+			return False
+	return True
+
+class _Compiler(object):
+	"""Generates the source of a validator function for a schema."""
+
+	def __init__(self):
+		self.lines = []
+		self.namespace = {'_MISSING': _MISSING}
+		self.counter = 0
+
+	def const(self, value):
+		name = '_c%d' % len(self.namespace)
+		self.namespace[name] = value
+		return name
+
+	def var(self, prefix):
+		self.counter += 1
+		return '%s%d' % (prefix, self.counter)
+
+	def emit(self, depth, line):
+		self.lines.append('\t' * depth + line)
+
+	def fail(self, depth, field, key, name, template):
+		"""Emit a set_error call.
+
+		`name` is a (static string, expression) pair; the static string is None
+		when the name depends on list indices.  In that case the message is only
+		formatted when the error actually happens.
+		"""
+		static, expr = name
+		if field.msg is not None:
+			msg = self.const(field.msg)
+		elif static is not None:
+			msg = self.const(template % static)
+		else:
+			msg = '%s %% (%s,)' % (self.const(template), expr)
+		self.emit(depth, 'set_error(%s, %s)' % (self.const(key), msg))
+		self.emit(depth, 'ok = False')
+
+	def attribute(self, depth, field, src, attr, key, name):
+		v = self.var('v')
+		self.emit(depth, '%s = %s.get(%s, _MISSING)' % (v, src, self.const(attr)))
+		if field.required:
+			self.emit(depth, 'if %s is _MISSING:' % v)
+			self.fail(depth + 1, field, key, name, '%s must exist')
+			self.emit(depth, 'else:')
+		else:
+			self.emit(depth, 'if %s is not _MISSING:' % v)
+		self.value(depth + 1, field, v, key, name)
+
+	def value(self, depth, field, v, key, name):
+		start = len(self.lines)
+		typ = field.type
+		if typ is not None:
+			self.emit(depth, 'if not isinstance(%s, %s):' % (v, self.const(typ)))
+			self.fail(depth + 1, field, key, name,
+				'type of %%s must be %s' % _type_name(typ).replace('%', '%%'))
+			self.emit(depth, 'else:')
+			depth += 1
+			body = len(self.lines)
+
+		if field.min_length is not None or field.max_length is not None or field.not_empty:
+			n = self.var('n')
+			if typ is not None:
+				self.emit(depth, '%s = len(%s)' % (n, v))
+				guard = ''
+			else:
+				self.emit(depth, 'try: %s = len(%s)' % (n, v))
+				self.emit(depth, 'except TypeError: %s = None' % n)
+				guard = '%s is None or ' % n
+			if field.not_empty:
+				self.emit(depth, 'if %s%s == 0:' % (guard, n))
+				self.fail(depth + 1, field, key, name, '%s should not be empty')
+			if field.min_length is not None:
+				self.emit(depth, 'if %s%s < %d:' % (guard, n, field.min_length))
+				self.fail(depth + 1, field, key, name,
+					'length of %%s must be >= %d' % field.min_length)
+			if field.max_length is not None:
+				self.emit(depth, 'if %s%s > %d:' % (guard, n, field.max_length))
+				self.fail(depth + 1, field, key, name,
+					'length of %%s must be <= %d' % field.max_length)
+
+		if field.min is not None or field.max is not None:
+			if typ is not None and _is_numeric(typ):
+				iv = v
+				guard = ''
+			else:
+				iv = self.var('i')
+				self.emit(depth, 'try: %s = int(%s)' % (iv, v))
+				self.emit(depth, 'except (TypeError, ValueError): %s = None' % iv)
+				guard = '%s is None or ' % iv
+			# bounds go in the namespace so floats aren't truncated
+			if field.min is not None:
+				self.emit(depth, 'if %s%s < %s:' % (guard, iv, self.const(field.min)))
+				self.fail(depth + 1, field, key, name,
+					'value of %%s must be >= %s' % field.min)
+			if field.max is not None:
+				self.emit(depth, 'if %s%s > %s:' % (guard, iv, self.const(field.max)))
+				self.fail(depth + 1, field, key, name,
+					'value of %%s must be <= %s' % field.max)
+
+		if field.matches is not None:
+			pattern = self.const(re.compile(field.matches))
+			self.emit(depth, 'if not (isinstance(%s, basestring) and %s.match(%s)):' % (v, pattern, v))
+			self.fail(depth + 1, field, key, name, '%s is not in the required format')
+
+		if field.not_blank:
+			pattern = self.const(re.compile(r'.*\S'))
+			self.emit(depth, 'if not (isinstance(%s, basestring) and %s.match(%s)):' % (v, pattern, v))
+			self.fail(depth + 1, field, key, name, '%s should not be blank')
+
+		if field.each is not None:
+			i = self.var('i')
+			item = self.var('v')
+			self.emit(depth, 'if isinstance(%s, (list, tuple)):' % v)
+			self.emit(depth + 1, 'for %s, %s in enumerate(%s):' % (i, item, v))
+			item_name = (None, "'%%s[%%d]' %% (%s, %s)" % (name[1], i))
+			self.value(depth + 2, field.each, item, key, item_name)
+
+		if field.fields is not None:
+			self.emit(depth, 'if isinstance(%s, dict):' % v)
+			self.fields(depth + 1, field.fields, v, key + '.', name)
+
+		if typ is not None and len(self.lines) == body:
+			self.emit(depth, 'pass')
+		if len(self.lines) == start:
+			self.emit(depth, 'pass')
+
+	def fields(self, depth, fields, src, prefix, parent=None):
+		names = fields.keys()
+		names.sort()
+		for attr in names:
+			if parent is None:
+				name = (attr, repr(attr))
+			elif parent[0] is not None:
+				name = (parent[0] + '.' + attr, repr(parent[0] + '.' + attr))
+			else:
+				name = (None, '%s + %s' % (parent[1], repr('.' + attr)))
+			self.attribute(depth, fields[attr], src, attr, prefix + attr, name)
+		if not names:
+			self.emit(depth, 'pass')
+
+	def compile(self, schema):
+		self.emit(0, 'def validate_schema(doc, rec):')
+		self.emit(1, 'set_error = doc.set_error')
+		self.emit(1, 'ok = True')
+		self.fields(1, schema, 'rec', '')
+		self.emit(1, 'return ok')
+		source = '\n'.join(self.lines) + '\n'
+		exec compile(source, '<schema>', 'exec') in self.namespace
+		fn = self.namespace['validate_schema']
+		fn.source = source
+		return fn
+
+def compile_schema(schema):
+	"""Compile a schema dict into a validator.
+
+	The result is a function taking (document, record) that calls
+	document.set_error for each problem and returns True if the record is
+	valid.
+	"""
+	return _Compiler().compile(schema)
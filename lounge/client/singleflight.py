@@ -0,0 +1,140 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Share one in-flight request between threads that make the same one.
+
+When lots of threads find the same hot document or run the same view query
+at once, they can all wait on a single GET instead of each making their
+own.  Turn it on for the whole process with
+
+	from lounge.client.singleflight import SingleFlight
+	client.single_flight = SingleFlight()
+
+Only GETs are shared, keyed by their full URL.  The threads share the raw
+response; each decodes it for itself, so every caller gets its own copy of
+the record and can change it freely.  Errors are shared too: if the request
+fails, everyone waiting on it gets the error.
+
+stats() says how many requests were made and how many callers rode along
+on someone else's, overall and for the busiest URLs.
+"""
+
+import sys
+import threading
+import time
+
+class _Call(object):
+	__slots__ = ['done', 'result', 'error']
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight(object):
+	"""Runs at most one call at a time per key; callers who arrive while it's
+	running wait for it and get its result.
+
+	Counters are kept for up to max_keys keys; after that, only the totals.
+	"""
+	def __init__(self, max_keys=1000):
+		self.max_keys = max_keys
+		self._lock = threading.Lock()
+		self._calls = {}
+		self.reset_stats()
+
+	def reset_stats(self):
+		self._lock.acquire()
+		try:
+			self._totals = {'calls': 0, 'shared': 0, 'wait': 0.0}
+			self._keys = {}
+		finally:
+			self._lock.release()
+
+	def _count(self, key, shared, wait):
+		# called with the lock held
+		counters = self._keys.get(key)
+		if counters is None and len(self._keys) < self.max_keys:
+			counters = self._keys[key] = {'calls': 0, 'shared': 0, 'wait': 0.0}
+		for c in (self._totals, counters):
+			if c is None:
+				continue
+			if shared:
+				c['shared'] += 1
+				c['wait'] += wait
+			else:
+				c['calls'] += 1
+
+	def do(self, key, f):
+		"""Return f(), or the result of the f() already running for key."""
+		self._lock.acquire()
+		call = self._calls.get(key)
+		if call is not None:
+			self._lock.release()
+			start = time.time()
+			call.done.wait()
+			self._lock.acquire()
+			try:
+				self._count(key, True, time.time() - start)
+			finally:
+				self._lock.release()
+			if call.error is not None:
+				raise call.error[0], call.error[1], call.error[2]
+			return call.result
+
+		call = self._calls[key] = _Call()
+		try:
+			self._count(key, False, 0)
+		finally:
+			self._lock.release()
+		try:
+			call.result = f()
+		except:
+			call.error = sys.exc_info()
+		# later callers start a new call; the ones already waiting get this one
+		self._lock.acquire()
+		try:
+			del self._calls[key]
+		finally:
+			self._lock.release()
+		call.done.set()
+		if call.error is not None:
+			raise call.error[0], call.error[1], call.error[2]
+		return call.result
+
+	def stats(self, top=10):
+		"""Counters for the process and for the top keys with the most shared calls.
+
+		calls is the number of requests made, shared the number of callers that
+		got another's result instead, and wait the total seconds those callers
+		waited.
+		"""
+		self._lock.acquire()
+		try:
+			stats = dict(self._totals)
+			keys = [(key, dict(counters)) for key, counters in self._keys.items()]
+		finally:
+			self._lock.release()
+		keys.sort(key=lambda item: -item[1]['shared'])
+		stats['keys'] = dict(keys[:top])
+		return stats
+
+	def key_stats(self, key):
+		"""The counters for one key, or None if it isn't tracked."""
+		self._lock.acquire()
+		try:
+			counters = self._keys.get(key)
+			return counters and dict(counters)
+		finally:
+			self._lock.release()
@@ -0,0 +1,195 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Pools of UUIDs for Document.generate_uuid.
+
+Instead of asking the lounge for one UUID per new document, each process
+keeps a pool per lounge, fetched batch_size at a time from _uuids.  When a
+pool runs low it's refilled from a background thread, so callers rarely
+wait.  A forked child starts with empty pools, so parent and child never
+hand out the same UUIDs.
+
+UUIDs can also be made locally, without asking the lounge at all:
+
+	client.uuid_pools.configure(mode='sequential')
+
+'random' makes version 4 style random UUIDs.  'sequential' makes UUIDs
+that start with the time in microseconds, so documents created around the
+same time sort together and inserts land near each other in the B-tree.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+MODES = ('server', 'random', 'sequential')
+
+class NoUUIDs(Exception):
+	"""A fetch for an empty pool came back with no UUIDs."""
+	pass
+
+def random_uuids(count):
+	"""count random 32 character hex UUIDs."""
+	data = os.urandom(16 * count).encode('hex')
+	return [data[i:i+32] for i in xrange(0, len(data), 32)]
+
+class SequentialUUIDs(object):
+	"""Makes UUIDs that sort in the order they were made.
+
+	Each is 14 hex digits of microseconds since the epoch and 18 random ones,
+	like CouchDB's utc_random.  Within a process the time part always goes
+	up, even if the clock doesn't.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._last = 0
+
+	def __call__(self, count):
+		suffixes = os.urandom(9 * count).encode('hex')
+		self._lock.acquire()
+		try:
+			now = max(int(time.time() * 1000000), self._last + 1)
+			self._last = now + count - 1
+		finally:
+			self._lock.release()
+		return ["%014x%s" % (now + i, suffixes[i*18:i*18+18]) for i in xrange(count)]
+
+class UUIDPool(object):
+	"""A thread-safe pool of UUIDs, refilled count at a time by fetch(count).
+
+	When fewer than low_water are left after a UUID is taken, a background
+	thread fetches another batch (unless background is False; then the pool
+	is only refilled when it's empty).  A pool used in a forked child throws
+	away what it had and fetches its own.
+	"""
+	def __init__(self, fetch, batch_size=1000, low_water=None, background=True):
+		self.fetch = fetch
+		self.batch_size = batch_size
+		if low_water is None:
+			low_water = batch_size / 4
+		self.low_water = low_water
+		self.background = background
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._uuids = collections.deque()
+		# held while fetching, so only one batch is fetched at a time
+		self._fetch_lock = threading.Lock()
+		self._refilling = False
+		self.fetches = 0
+
+	def __len__(self):
+		return len(self._uuids)
+
+	def _fill(self):
+		uuids = self.fetch(self.batch_size)
+		self._uuids.extend(uuids)
+		self.fetches += 1
+		return len(uuids)
+
+	def _refill(self):
+		try:
+			self._fetch_lock.acquire()
+			try:
+				if len(self._uuids) < self.low_water:
+					self._fill()
+			finally:
+				self._fetch_lock.release()
+		except Exception:
+			# next() will try again, and raise if the lounge is really down
+			logging.exception("UUIDPool: background refill failed")
+		self._refilling = False
+
+	def next(self):
+		"""Take a UUID from the pool, fetching more first if it's empty.
+
+		Raises NoUUIDs if that fetch doesn't return any.
+		"""
+		if self._pid != os.getpid():
+			self._reset()
+		while True:
+			try:
+				uuid = self._uuids.popleft()
+				break
+			except IndexError:
+				self._fetch_lock.acquire()
+				try:
+					if not self._uuids and not self._fill():
+						raise NoUUIDs("fetching %d UUIDs returned none" % self.batch_size)
+				finally:
+					self._fetch_lock.release()
+		if self.background and not self._refilling and len(self._uuids) < self.low_water:
+			self._fetch_lock.acquire()
+			try:
+				start = not self._refilling
+				self._refilling = True
+			finally:
+				self._fetch_lock.release()
+			if start:
+				thread = threading.Thread(target=self._refill, name="UUIDPool-refill")
+				thread.setDaemon(True)
+				thread.start()
+		return uuid
+
+class UUIDPools(object):
+	"""The UUID pools of a process: one per lounge, or one local pool.
+
+	fetch(url, count) gets count UUIDs from the lounge at url.
+	"""
+	def __init__(self, fetch, mode='server', batch_size=1000, low_water=None):
+		self._fetch = fetch
+		self._lock = threading.Lock()
+		self.configure(mode, batch_size, low_water)
+
+	def configure(self, mode='server', batch_size=1000, low_water=None):
+		"""Change where UUIDs come from.  Drops the current pools."""
+		if mode not in MODES:
+			raise ValueError("mode must be one of %s, not %r" % (", ".join(MODES), mode))
+		self._lock.acquire()
+		try:
+			self.mode = mode
+			self.batch_size = batch_size
+			self.low_water = low_water
+			self._pools = {}
+			if mode == 'random':
+				self._local = UUIDPool(random_uuids, batch_size, low_water, background=False)
+			elif mode == 'sequential':
+				# sequential UUIDs are made when they're needed, so they stay in order
+				self._local = UUIDPool(SequentialUUIDs(), 1, 0, background=False)
+			else:
+				self._local = None
+		finally:
+			self._lock.release()
+
+	def pool(self, url):
+		"""The pool that UUIDs for documents at the lounge at url come from."""
+		if self._local is not None:
+			return self._local
+		pool = self._pools.get(url)
+		if pool is None:
+			self._lock.acquire()
+			try:
+				pool = self._pools.get(url)
+				if pool is None:
+					fetch = lambda count: self._fetch(url, count)
+					pool = self._pools[url] = UUIDPool(fetch, self.batch_size, self.low_water)
+			finally:
+				self._lock.release()
+		return pool
+
+	def next(self, url):
+		return self.pool(url).next()
@@ -0,0 +1,292 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""A cache for view results.
+
+Every view query goes to every shard behind the lounge, so a dashboard that
+runs the same queries over and over can keep the results for a while:
+
+	cache = ViewCache(ttl=30, max_bytes=50 * 1024 * 1024)
+	rows = View.execute("users", "stats/by_day", args={"group": True}, cache=cache).rows
+
+Results are kept by lounge, database, view, and arguments (in any order),
+up to max_entries of them and max_bytes of response bodies, dropping the
+least recently used first.  Each call decodes its own copy of the result,
+so callers can change what they get back.
+
+With stale_ttl, a result up to stale_ttl seconds past its ttl is still
+returned, and a background thread fetches a fresh one for next time.
+
+watch(db_name) follows the database's _changes feed from a background
+thread and drops the database's results whenever anything in it changes,
+so with a watch in place, a long ttl doesn't mean stale results.
+"""
+
+import collections
+import copy
+try:
+	import simplejson as json
+except ImportError:
+	import json
+import logging
+import threading
+import time
+
+import httplib2
+
+from lounge import client
+
+class _Entry(object):
+	__slots__ = ['content', 'content_type', 'fetched', 'size', 'db']
+
+	def __init__(self, content, content_type, fetched, size, db):
+		self.content = content
+		self.content_type = content_type
+		self.fetched = fetched
+		self.size = size
+		self.db = db
+
+def _db_url(db_name, db_connectinfo=None):
+	return (db_connectinfo or client.db_connectinfo) + client.db_prefix + db_name
+
+def canonical_args(args):
+	"""The arguments of a view query, in a form that's the same however they were written."""
+	if not args:
+		return ()
+	return tuple(sorted([(k, json.dumps(v, sort_keys=True)) for k, v in args.iteritems()]))
+
+def _snapshot(view):
+	"""A copy of view to refresh from later.
+
+	By the time a refresh runs, View.execute has replaced view._rec (the
+	request body, for views that POST) with the result.
+	"""
+	fresh = view.__class__.__new__(view.__class__)
+	fresh.__dict__.update(view.__dict__)
+	fresh.__dict__['_rec'] = copy.deepcopy(view.__dict__.get('_rec'))
+	return fresh
+
+class ViewCache(object):
+	"""A bounded cache of view results; see the module docstring."""
+	def __init__(self, ttl=60, max_entries=1000, max_bytes=64 * 1024 * 1024, stale_ttl=0):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.stale_ttl = stale_ttl
+		self._lock = threading.Lock()
+		# key -> _Entry, least recently used first
+		self._entries = collections.OrderedDict()
+		self._bytes = 0
+		# database url -> how many times it's been invalidated
+		self._generations = {}
+		self._refreshing = set()
+		self._watchers = {}
+		self.stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'refreshes': 0,
+			'invalidations': 0, 'evictions': 0}
+
+	def __len__(self):
+		return len(self._entries)
+
+	def size(self):
+		"""The bytes of response bodies in the cache."""
+		return self._bytes
+
+	def _view_db(self, view):
+		return client.get_db_connectinfo(view) + view._db_name
+
+	def _key(self, view, args):
+		body = view._rec and json.dumps(view._rec, sort_keys=True) or None
+		return (view.__class__.__name__, self._view_db(view), view._key, canonical_args(args), body)
+
+	def _fetch(self, view, args, key, db):
+		"""Query the view and cache the result, unless the database changed meanwhile."""
+		self._lock.acquire()
+		generation = self._generations.get(db, 0)
+		self._lock.release()
+		content, content_type = view.get_results(args, raw=True)
+		self._lock.acquire()
+		try:
+			if self._generations.get(db, 0) == generation:
+				self._store(key, _Entry(content, content_type, time.time(), len(content) + len(repr(key)), db))
+		finally:
+			self._lock.release()
+		return content, content_type
+
+	def _store(self, key, entry):
+		# called with the lock held
+		old = self._entries.pop(key, None)
+		if old is not None:
+			self._bytes -= old.size
+		if entry.size > self.max_bytes:
+			return
+		self._entries[key] = entry
+		self._bytes += entry.size
+		while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+			key, old = self._entries.popitem(last=False)
+			self._bytes -= old.size
+			self.stats['evictions'] += 1
+
+	def _refresh(self, view, args, key, db):
+		try:
+			try:
+				self._fetch(view, args, key, db)
+				self._lock.acquire()
+				self.stats['refreshes'] += 1
+				self._lock.release()
+			except Exception:
+				logging.exception("ViewCache: refreshing %s failed" % view.url())
+		finally:
+			self._lock.acquire()
+			self._refreshing.discard(key)
+			self._lock.release()
+
+	def get(self, view, args):
+		"""The decoded result of view.get_results(args), from the cache if possible.
+
+		View.execute calls this when it's given a cache.
+		"""
+		key = self._key(view, args)
+		db = self._view_db(view)
+		now = time.time()
+		refresh = False
+		self._lock.acquire()
+		try:
+			entry = self._entries.get(key)
+			if entry is not None:
+				age = now - entry.fetched
+				if age > self.ttl + self.stale_ttl:
+					entry = None
+				else:
+					# most recently used goes last
+					del self._entries[key]
+					self._entries[key] = entry
+					if age > self.ttl:
+						self.stats['stale_hits'] += 1
+						refresh = key not in self._refreshing
+						self._refreshing.add(key)
+					else:
+						self.stats['hits'] += 1
+			if entry is None:
+				self.stats['misses'] += 1
+		finally:
+			self._lock.release()
+
+		if refresh:
+			thread = threading.Thread(target=self._refresh, args=(_snapshot(view), copy.deepcopy(args), key, db),
+				name="ViewCache-refresh")
+			thread.setDaemon(True)
+			thread.start()
+		if entry is not None:
+			content, content_type = entry.content, entry.content_type
+		else:
+			content, content_type = self._fetch(view, args, key, db)
+		return view._decode(content, content_type)
+
+	def invalidate(self, db_name=None, db_connectinfo=None):
+		"""Drop the cached results for a database, or for all of them."""
+		if db_name is None:
+			self._invalidate(None)
+		else:
+			self._invalidate([_db_url(db_name, db_connectinfo)])
+
+	def _invalidate(self, dbs):
+		self._lock.acquire()
+		try:
+			if dbs is None:
+				dbs = set([entry.db for entry in self._entries.itervalues()]) | set(self._generations)
+			for db in dbs:
+				self._generations[db] = self._generations.get(db, 0) + 1
+			dbs = set(dbs)
+			for key, entry in self._entries.items():
+				if entry.db in dbs:
+					del self._entries[key]
+					self._bytes -= entry.size
+			self.stats['invalidations'] += 1
+		finally:
+			self._lock.release()
+
+	def watch(self, db_name, db_connectinfo=None, timeout=60, retry=5):
+		"""Follow db_name's _changes from a background thread, dropping its
+		results whenever it changes.
+
+		timeout is how long each longpoll waits, in seconds, and retry how long
+		to wait after an error.  Returns the ChangesWatcher.
+		"""
+		db = _db_url(db_name, db_connectinfo)
+		self._lock.acquire()
+		try:
+			watcher = self._watchers.get(db)
+			if watcher is None:
+				watcher = self._watchers[db] = ChangesWatcher(db, lambda: self._invalidate([db]), timeout, retry)
+		finally:
+			self._lock.release()
+		return watcher
+
+	def stop_watching(self):
+		self._lock.acquire()
+		try:
+			watchers = self._watchers.values()
+			self._watchers = {}
+		finally:
+			self._lock.release()
+		for watcher in watchers:
+			watcher.stop()
+
+class ChangesWatcher(object):
+	"""Calls callback() from a daemon thread whenever the database at db_url changes.
+
+	It's also called once the watcher has caught up with the database, since
+	anything before that may have been missed.
+	"""
+	def __init__(self, db_url, callback, timeout=60, retry=5):
+		self.db_url = db_url
+		self.callback = callback
+		self.timeout = timeout
+		self.retry = retry
+		self._stopped = threading.Event()
+		self._resource = client.Resource()
+		self._resource._key = db_url
+		# longpolls outlast the usual db_timeout
+		self._resource._http = httplib2.Http(timeout=timeout + 30)
+		self._thread = threading.Thread(target=self._run, name="ChangesWatcher")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def _request(self, url, args=None):
+		return self._resource._request('GET', url, args=args)
+
+	def _run(self):
+		since = None
+		while not self._stopped.isSet():
+			try:
+				if since is None:
+					since = self._request(self.db_url)['update_seq']
+					self.callback()
+					continue
+				changes = self._request(self.db_url + "/_changes", args={
+					'feed': 'longpoll', 'since': json.dumps(since), 'timeout': int(self.timeout * 1000)})
+				if self._stopped.isSet():
+					return
+				since = changes['last_seq']
+				if changes['results']:
+					self.callback()
+			except Exception:
+				logging.exception("ChangesWatcher: following %s failed" % self.db_url)
+				# we may have missed changes; start over
+				since = None
+				self._stopped.wait(self.retry)
+
+	def stop(self):
+		"""Stop watching.  The thread finishes when its current longpoll does."""
+		self._stopped.set()
@@ -16,8 +16,16 @@ import os
 import os.path
 import sys
 import atexit
+import errno
+import fcntl
 import logging
+import resource
 import string
+import struct
+import tempfile
+import time
+
+from lounge import percentile
 
 class CronGuardException(Exception):
 	"""
@@ -38,6 +46,153 @@ class ProcessStillRunning(CronGuardException):
 	"""
 	pass
 
+class LockTimeout(ProcessStillRunning):
+	"""
+	Raised if we've waited for the previous process as long as we were told to
+	"""
+	pass
+
+# start, end, exit status, slot, peak RSS in KB
+RUN_RECORD = struct.Struct("<ddiiI")
+# the exit status of runs that didn't start because the previous one was still going
+SKIPPED = -1
+
+def _exit_status(code):
+	"""The status the interpreter exits with for SystemExit(code)."""
+	if code is None:
+		return 0
+	if isinstance(code, (int, long)):
+		return code
+	return 1
+
+class Run(object):
+	"""One record from a RunHistory."""
+	__slots__ = ('start', 'end', 'status', 'slot', 'maxrss')
+
+	def __init__(self, start, end, status, slot, maxrss):
+		self.start = start
+		self.end = end
+		self.status = status
+		self.slot = slot
+		self.maxrss = maxrss
+
+	def duration(self):
+		return self.end - self.start
+
+	def skipped(self):
+		return self.status == SKIPPED
+
+	def __repr__(self):
+		return "<Run %s %.1fs status=%d slot=%d maxrss=%dKB>" % (
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start)),
+			self.duration(), self.status, self.slot, self.maxrss)
+
+class RunHistory(object):
+	"""The runs of a cron job, as fixed-size records in an append-only file.
+
+	Once there are twice max_runs records, the file is rewritten with just the
+	newest max_runs.  Appending and rewriting both happen under an flock, so
+	any number of processes can share the file.
+	"""
+	def __init__(self, path, max_runs=1000):
+		self.path = path
+		self.max_runs = max_runs
+
+	def _open_locked(self):
+		while True:
+			fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			try:
+				# somebody may have replaced the file while we waited for it
+				if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+					return fd
+			except OSError:
+				pass
+			os.close(fd)
+
+	def append(self, start, end, status, slot=0, maxrss=0):
+		fd = self._open_locked()
+		try:
+			os.write(fd, RUN_RECORD.pack(start, end, status, slot, maxrss))
+			if os.fstat(fd).st_size >= 2 * self.max_runs * RUN_RECORD.size:
+				self._truncate()
+		finally:
+			os.close(fd)
+
+	def _truncate(self):
+		keep = open(self.path, "rb").read()[-self.max_runs * RUN_RECORD.size:]
+		fd, tmp_path = tempfile.mkstemp(prefix=".history", dir=os.path.dirname(os.path.abspath(self.path)))
+		try:
+			os.write(fd, keep)
+			os.close(fd)
+			os.chmod(tmp_path, 0644)
+			os.rename(tmp_path, self.path)
+		except:
+			os.unlink(tmp_path)
+			raise
+
+	def runs(self):
+		"""All the recorded runs, oldest first."""
+		try:
+			data = open(self.path, "rb").read()
+		except IOError, e:
+			if e.errno == errno.ENOENT:
+				return []
+			raise
+		n = len(data) / RUN_RECORD.size
+		return [Run(*RUN_RECORD.unpack_from(data, i * RUN_RECORD.size)) for i in xrange(n)]
+
+	def summary(self, interval=None, runs=None):
+		"""Statistics about the runs, as a dict.
+
+		Durations (p50, p95, max, in seconds) only count the runs that happened.
+		skipped counts runs that found the previous one still going, and
+		failed the ones that exited with a nonzero status.  Given the schedule
+		interval in seconds, over_interval counts the runs that took longer than
+		it, and p95_of_interval says how close the slow runs are to it.  trend
+		is the median of the newer half of the runs over the median of the
+		older half; above 1 means the job is slowing down.
+		"""
+		if runs is None:
+			runs = self.runs()
+		finished = [run for run in runs if not run.skipped()]
+		durations = sorted([run.duration() for run in finished])
+		result = {
+			'runs': len(finished),
+			'skipped': len(runs) - len(finished),
+			'failed': len([run for run in finished if run.status != 0]),
+			'p50': percentile(durations, 50),
+			'p95': percentile(durations, 95),
+			'max': None,
+			'maxrss': max([0] + [run.maxrss for run in finished]),
+			'trend': None,
+		}
+		if durations:
+			result['max'] = durations[-1]
+		half = len(finished) / 2
+		if half:
+			older = percentile(sorted([run.duration() for run in finished[:half]]), 50)
+			newer = percentile(sorted([run.duration() for run in finished[-half:]]), 50)
+			if older:
+				result['trend'] = newer / older
+		if interval:
+			result['over_interval'] = len([d for d in durations if d > interval])
+			if durations:
+				result['p95_of_interval'] = result['p95'] / interval
+		return result
+
+def partition(items, slot, slots):
+	"""Every slots-th item of items, starting at slot.
+
+	The partitions of all the slots cover items exactly once, as long as every
+	worker lists the items in the same order.  The split is fixed: nobody
+	picks up the partition of a slot whose worker never started or died
+	partway, so coverage depends on all of them running to the end.
+	"""
+	if not 0 <= slot < slots:
+		raise ValueError("slot %d is out of range for %d slots" % (slot, slots))
+	return list(items)[slot::slots]
+
 class CronGuard:
 	"""
 	Manages the creation and deletion of pidfiles from cron scripts.  When a
@@ -50,9 +205,45 @@ class CronGuard:
 	  cg = CronGuard()
 	  
 	The default usage should work for the majority of scripts.
+
+	With use_flock=True, the pidfile is locked with flock instead.  Taking the
+	lock is atomic, so two overlapping runs can't both get in, and the kernel
+	drops it when the process dies, so there are no stale pidfiles to guess
+	about.  The pid is still written to the file for anybody looking, but the
+	file is never unlinked (a process waiting on the old file would lock a
+	file nobody else can see).  By default a running previous process raises
+	ProcessStillRunning right away; with wait=True we wait for it to finish,
+	for at most timeout seconds if a timeout is given (then LockTimeout is
+	raised).
+
+	slots=N lets up to N copies run at once (always using flock, with one
+	pidfile per slot), and tells each one which slot it got in self.slot.
+	partition() splits a list of work, like ShardMap.shards(), between them:
+	  cg = CronGuard(slots=8)
+	  for shard in cg.partition(shard_map.shards("userinfo")):
+	    ...
+	ProcessStillRunning (or LockTimeout, with wait) means all the slots are
+	taken.  The split is static: every item is covered only if a worker runs
+	in each of the N slots.  If fewer than N start, or one dies, the items of
+	the missing slots are not processed that time around, so start all N (or
+	make the job safe to pick up the rest on its next run).
+
+	With history=True, each run is recorded in a RunHistory next to the
+	pidfile (foo.history for foo.pid): its start and end, exit status, slot
+	and peak RSS, or a skipped run if the previous one was still going.  The
+	status is whatever is in self.status at exit, 0 unless the script sets
+	it.  The guard doesn't touch sys.exit or sys.excepthook, so have it run
+	the job to record how it really ended:
+	  cg = CronGuard(history=True)
+	  cg.run(main)
+	records 1 if main raises, the exit code if it calls sys.exit(), and 0
+	otherwise.  self.exit(status) and self.finish(status) record a status
+	directly.  To see how a job is doing:
+	  python -m lounge.cronguard /var/run/lounge/foo.history [interval]
 	"""
 
-	def __init__(self, pidfile_dir = "/var/run/lounge", pidfile_name = None):
+	def __init__(self, pidfile_dir = "/var/run/lounge", pidfile_name = None, use_flock = False, wait = False, timeout = None, slots = 1, history = False, history_size = 1000):
+		self.started = time.time()
 		(exe_path, self.exe_name) = os.path.split(sys.argv[0])
 
 		if not pidfile_name:
@@ -60,7 +251,43 @@ class CronGuard:
 			if not pidfile_name:
 				raise InvalidPidfileName
 
+		self.history = None
+		if history:
+			history_name = pidfile_name
+			if history_name.endswith(".pid"):
+				history_name = history_name[:-len(".pid")]
+			self.history = RunHistory(os.path.join(pidfile_dir, history_name + ".history"), history_size)
+		self.status = 0
+		self.owner_pid = os.getpid()
+		self._recorded = False
+
 		self.pid_path = os.path.join (pidfile_dir, pidfile_name)
+		try:
+			self._acquire(use_flock, wait, timeout, slots)
+		except ProcessStillRunning:
+			self._record(SKIPPED)
+			raise
+
+		if self.history is not None:
+			# atexit handlers run last-registered first, so this runs while we still hold the pidfile
+			atexit.register(self.finish)
+
+	def _acquire(self, use_flock, wait, timeout, slots):
+		self.lock_fd = None
+		self.slot = 0
+		self.slots = slots
+		if slots > 1:
+			# one pidfile per slot; pid_path ends up being the one we hold
+			paths = ["%s.%d" % (self.pid_path, i) for i in range(slots)]
+			self.lock_fd, self.slot = self._lock_pidfile(paths, wait, timeout)
+			self.pid_path = paths[self.slot]
+		elif use_flock:
+			self.lock_fd, self.slot = self._lock_pidfile([self.pid_path], wait, timeout)
+		if self.lock_fd is not None:
+			self._write_locked_pidfile()
+			atexit.register(self.release)
+			return
+
 		if os.path.exists(self.pid_path):
 			#a pidfile already exists so get the pid and check if the process exists
 			try:
@@ -103,5 +330,145 @@ class CronGuard:
 	def _remove_pidfile(self):
 		os.unlink(self.pid_path)
 
+	def _try_lock(self, fd):
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return True
+		except IOError, e:
+			if e.errno not in (errno.EAGAIN, errno.EACCES):
+				raise
+			return False
+
+	def _lock_pidfile(self, paths, wait, timeout):
+		"""Take an exclusive flock on any one of paths.
+
+		Returns (fd, index of the path that was locked).
+		"""
+		fds = []
+		try:
+			for path in paths:
+				fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+				fds.append(fd)
+				# children the job starts mustn't keep holding the lock after it exits
+				fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+			if timeout is not None:
+				deadline = time.time() + timeout
+			delay = 0.01
+			while True:
+				for i, fd in enumerate(fds):
+					if self._try_lock(fd):
+						fds[i] = None
+						return fd, i
+				if not wait:
+					raise ProcessStillRunning
+				if timeout is None and len(fds) == 1:
+					# nothing else to do until the previous run is done
+					fcntl.flock(fds[0], fcntl.LOCK_EX)
+					fd, fds[0] = fds[0], None
+					return fd, 0
+				if timeout is None:
+					remaining = delay
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise LockTimeout
+				time.sleep(min(delay, remaining))
+				delay = min(delay * 2, 1.0)
+		finally:
+			for fd in fds:
+				if fd is not None:
+					os.close(fd)
+
+	def _write_locked_pidfile(self):
+		os.ftruncate(self.lock_fd, 0)
+		os.lseek(self.lock_fd, 0, 0)
+		os.write(self.lock_fd, "%d" % os.getpid())
+
+	def run(self, fn, *args, **kwargs):
+		"""Call fn(*args, **kwargs), recording how it ended as the exit status
+		of the run, and return what it returns."""
+		try:
+			result = fn(*args, **kwargs)
+		except SystemExit, e:
+			self.finish(_exit_status(e.code))
+			raise
+		except:
+			self.finish(1)
+			raise
+		self.finish(0)
+		return result
+
+	def exit(self, status=None):
+		"""sys.exit(status), recording status as the exit status of the run."""
+		self.status = _exit_status(status)
+		sys.exit(status)
+
+	def _record(self, status):
+		if self.history is None or self._recorded:
+			return
+		self._recorded = True
+		try:
+			maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			self.history.append(self.started, time.time(), status, self.slot, maxrss)
+		except (IOError, OSError), e:
+			# never let bookkeeping break the job itself
+			logging.warn("Couldn't record run in %s: %s" % (self.history.path, e))
+
+	def finish(self, status=None):
+		"""Record this run in the history, with self.status unless status is given.
+
+		Called at exit; only the first call records anything.
+		"""
+		if self.owner_pid != os.getpid():
+			return
+		if status is not None:
+			self.status = status
+		self._record(self.status)
+
+	def partition(self, items):
+		"""The share of items that belongs to our slot.  See partition(); the
+		other slots' shares are left to the workers in those slots."""
+		return partition(items, self.slot, self.slots)
+
+	def release(self):
+		"""Let the next run in.  Only needed with use_flock; called at exit."""
+		# forked children run our atexit handlers too, but the lock is the parent's
+		if self.lock_fd is None or self.owner_pid != os.getpid():
+			return
+		try:
+			os.ftruncate(self.lock_fd, 0)
+		finally:
+			# closing the file drops the lock
+			os.close(self.lock_fd)
+			self.lock_fd = None
+
+def main(argv):
+	if len(argv) not in (2, 3):
+		print >>sys.stderr, "usage: %s <history file> [schedule interval in seconds]" % argv[0]
+		return 2
+	interval = None
+	if len(argv) == 3:
+		interval = float(argv[2])
+	history = RunHistory(argv[1])
+	runs = history.runs()
+	summary = history.summary(interval, runs)
+	def seconds(value):
+		if value is None:
+			return "-"
+		return "%.1fs" % value
+	print "runs: %d  skipped: %d  failed: %d" % (summary['runs'], summary['skipped'], summary['failed'])
+	print "duration p50: %s  p95: %s  max: %s" % (seconds(summary['p50']), seconds(summary['p95']), seconds(summary['max']))
+	print "peak rss: %dKB" % summary['maxrss']
+	if summary['trend'] is not None:
+		print "trend: newer runs take %.2fx as long as older ones" % summary['trend']
+	if interval:
+		print "over the %s interval: %d" % (seconds(interval), summary['over_interval'])
+		if 'p95_of_interval' in summary:
+			print "p95 is %d%% of the interval" % (summary['p95_of_interval'] * 100)
+	print
+	for run in runs[-10:]:
+		print run
+	return 0
+
 if __name__ == "__main__":
-	cg1 = CronGuard()
+	sys.exit(main(sys.argv))
@@ -0,0 +1,783 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""An in-process stand-in for a lounge, for offline tests and benchmarks.
+
+FakeLounge serves the part of the CouchDB/lounge HTTP API that lounge.client
+uses, from memory, on a local port:
+
+	fake = FakeLounge(shards=8)
+	fake.start()
+	client.db_config['fake'] = fake.url
+	client.use_config('fake')
+	...
+	fake.stop()
+
+Supported: creating, inspecting and deleting databases; document GET, PUT,
+POST and DELETE with _rev conflicts and batch=ok; attachments; _bulk_docs;
+_all_docs with keys and include_docs; design doc views and _temp_view with
+key ranges, keys, descending, skip, limit, include_docs and the _count and
+_sum reduces (or a Python reduce); _changes, with since vectors when sharded
+and feed=longpoll; and _uuids.
+
+Documents are spread over the shards with the lounge's hash, and each shard
+has its own update sequence, so _changes takes and returns since vectors the
+way the lounge does.  Each shard is also reachable on its own under its
+ShardMap name (/shards%2F00000000-1fffffff%2Fdb/...); write_shard_config
+writes a ShardMap config that points at the fake.
+
+There is no JavaScript.  Views in language "python" define one function that
+takes a doc and yields (key, value) pairs, or calls emit(key, value):
+
+	def fun(doc):
+		if doc.get('type') == 'user':
+			yield doc['name'], None
+
+and register_map lets a Python callable stand in for a JavaScript map
+function, so existing design docs can be used unchanged.
+
+To make benchmarks reproducible, latency adds a delay (seconds, or a
+(low, high) range) to each request, and error_rate makes that fraction of
+requests fail with error_code; pass seed to get the same errors each run.
+"""
+
+import base64
+import BaseHTTPServer
+import cgi
+import copy
+import hashlib
+import logging
+import random
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import types
+import urllib
+import uuid
+try:
+	import simplejson as json
+except ImportError:
+	import json
+
+from lounge import shard_index
+
+_MISSING = object()
+
+class _HTTPError(Exception):
+	def __init__(self, code, error, reason):
+		Exception.__init__(self, code, error, reason)
+		self.code = code
+		self.error = error
+		self.reason = reason
+
+def _not_found(reason="missing"):
+	return _HTTPError(404, "not_found", reason)
+
+def _conflict():
+	return _HTTPError(409, "conflict", "Document update conflict.")
+
+def _collation_key(value):
+	"""Something that sorts like CouchDB collates JSON keys.
+
+	null < false < true < numbers < strings < arrays < objects.  Strings are
+	compared by code point rather than with ICU.  The result is hashable, so
+	it can also be used to find equal keys.
+	"""
+	if value is None:
+		return (0,)
+	if value is False:
+		return (1,)
+	if value is True:
+		return (2,)
+	if isinstance(value, (int, long, float)):
+		return (3, value)
+	if isinstance(value, basestring):
+		return (4, value)
+	if isinstance(value, (list, tuple)):
+		return (5, tuple([_collation_key(v) for v in value]))
+	if isinstance(value, dict):
+		return (6, tuple([(k, _collation_key(v)) for k, v in sorted(value.items())]))
+	raise TypeError("Can't collate %r" % (value,))
+
+def _new_rev(old_rev, doc):
+	n = 0
+	if old_rev:
+		n = int(old_rev.split('-', 1)[0])
+	digest = hashlib.md5(json.dumps(doc, sort_keys=True) + str(random.random())).hexdigest()
+	return "%d-%s" % (n + 1, digest)
+
+class _Shard(object):
+	"""The documents and update sequence of one shard of a database."""
+	def __init__(self):
+		self.docs = {} # id -> (doc, encoded doc) for live docs
+		self.revs = {} # id -> current rev, deleted docs included
+		self.attachments = {} # id -> {name: (content type, data, revpos)}
+		self.update_seq = 0
+		self.seq_of = {} # id -> seq of its last change
+		self.by_seq = {} # seq -> id
+
+	def bump(self, docid):
+		self.update_seq += 1
+		old = self.seq_of.get(docid)
+		if old is not None:
+			del self.by_seq[old]
+		self.seq_of[docid] = self.update_seq
+		self.by_seq[self.update_seq] = docid
+
+	def changes(self, since):
+		return [(seq, self.by_seq[seq]) for seq in sorted(self.by_seq) if seq > since]
+
+class _Database(object):
+	"""A database, or one shard of one (then home is the whole database)."""
+	def __init__(self, name, shards, sharded, home=None):
+		self.name = name
+		self.shards = shards
+		# whether update sequences are vectors
+		self.sharded = sharded
+		self.home = home or self
+		self.view_cache = {}
+
+	def shard_for(self, docid):
+		if len(self.shards) == 1:
+			return self.shards[0]
+		return self.shards[shard_index(docid, len(self.shards))]
+
+	def get(self, docid):
+		"""The (doc, encoded doc) pair for a live doc, or None."""
+		return self.shard_for(docid).docs.get(docid)
+
+	def iterdocs(self):
+		for shard in self.shards:
+			for docid, (doc, body) in shard.docs.iteritems():
+				yield docid, doc
+
+	def update_seq(self):
+		if self.sharded:
+			return [shard.update_seq for shard in self.shards]
+		return self.shards[0].update_seq
+
+	def version(self):
+		return tuple([shard.update_seq for shard in self.shards])
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def handle_error(self, request, client_address):
+		# clients that time out hang up on us; that's their business
+		if isinstance(sys.exc_info()[1], socket.error):
+			return
+		BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# keep connections open, like a real server; httplib2 reuses them
+	protocol_version = "HTTP/1.1"
+	server_version = "FakeLounge/1.0"
+	# the headers and body go out in separate writes; without this, a reused
+	# connection waits on delayed ACKs for ~40ms per request
+	disable_nagle_algorithm = True
+
+	def _handle(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = length and self.rfile.read(length) or ''
+		content_type = self.headers.get('Content-Type', 'application/octet-stream')
+		status, content_type, content = self.server.lounge.handle(self.command, self.path, body, content_type)
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		if self.command != 'HEAD':
+			self.wfile.write(content)
+
+	do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+	def log_message(self, format, *args):
+		pass
+
+class FakeLounge(object):
+	"""An in-memory lounge on a local port.  See the module docs."""
+
+	def __init__(self, shards=1, shard_map=None, host='127.0.0.1', port=0,
+			latency=0, error_rate=0.0, error_code=500, seed=None):
+		if shard_map is not None:
+			shards = len(shard_map.shardmap)
+		self.nshards = shards
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.error_rate = error_rate
+		self.error_code = error_code
+		self._random = random.Random(seed)
+		self._dbs = {}
+		self._registered_maps = {}
+		self._functions = {}
+		self._emitted = []
+		# one lock for all the data; longpoll _changes waits on it
+		self._lock = threading.Condition(threading.RLock())
+		self._server = None
+		self.stats = {'requests': 0, 'errors': 0, 'injected_errors': 0}
+
+	### running
+	def start(self):
+		"""Start serving from a background thread.  Returns self."""
+		self._server = _Server((self.host, self.port), _Handler)
+		self._server.lounge = self
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, name="FakeLounge")
+		self._thread.setDaemon(True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+	@property
+	def url(self):
+		return "http://%s:%d/" % (self.host, self.port)
+
+	def write_shard_config(self, path):
+		"""Write a ShardMap config with every shard on this server."""
+		config = {"shard_map": [[0]] * self.nshards, "nodes": [[self.host, self.port]]}
+		f = open(path, "w")
+		try:
+			json.dump(config, f)
+		finally:
+			f.close()
+
+	def register_map(self, source, function):
+		"""Use function(doc) for views whose map source is source.
+
+		function returns or yields (key, value) pairs.
+		"""
+		self._registered_maps[source] = function
+
+	def reset_stats(self):
+		self._lock.acquire()
+		try:
+			for key in self.stats:
+				self.stats[key] = 0
+		finally:
+			self._lock.release()
+
+	### HTTP
+	def handle(self, method, path, body, content_type):
+		"""Answer one request.  Returns (status, content type, content)."""
+		self._count('requests')
+		latency = self.latency
+		if isinstance(latency, tuple):
+			latency = self._random.uniform(*latency)
+		if latency:
+			time.sleep(latency)
+		if self.error_rate and self._random.random() < self.error_rate:
+			self._count('injected_errors')
+			return self._error(_HTTPError(self.error_code, "injected", "error injected by FakeLounge"))
+
+		if '?' in path:
+			path, query = path.split('?', 1)
+		else:
+			query = ''
+		params = {}
+		for key, values in cgi.parse_qs(query, keep_blank_values=True).iteritems():
+			params[key] = values[-1]
+		segments = [urllib.unquote(s).decode('utf8') for s in path.split('/')[1:]]
+		if segments and segments[-1] == '':
+			segments.pop()
+		try:
+			result = self._route(method, segments, params, body, content_type)
+		except _HTTPError, e:
+			return self._error(e)
+		except Exception, e:
+			logging.exception("FakeLounge: %s %s failed" % (method, path))
+			return self._error(_HTTPError(500, "unknown_error", str(e)))
+		if len(result) == 3:
+			return result
+		status, payload = result
+		return status, "application/json", json.dumps(payload)
+
+	def _count(self, stat):
+		self._lock.acquire()
+		try:
+			self.stats[stat] += 1
+		finally:
+			self._lock.release()
+
+	def _error(self, e):
+		self._count('errors')
+		return e.code, "application/json", json.dumps({"error": e.error, "reason": e.reason})
+
+	def _route(self, method, segments, params, body, content_type):
+		if not segments:
+			return 200, {"couchdb": "Welcome", "version": "fakelounge"}
+		if segments == ['_uuids']:
+			count = int(params.get('count', 1))
+			return 200, {"uuids": [uuid.uuid4().hex for i in xrange(count)]}
+		if segments == ['_all_dbs']:
+			return 200, sorted(self._dbs)
+
+		self._lock.acquire()
+		try:
+			dbname, rest = segments[0], segments[1:]
+			if not rest:
+				return self._database(method, dbname, body)
+			db = self._find_db(dbname)
+			if rest[0] == '_design' and len(rest) >= 2:
+				rest = [u'_design/' + rest[1]] + rest[2:]
+				if len(rest) == 3 and rest[1] == '_view':
+					return self._view(method, db, rest[0], rest[2], params, body)
+			if rest == ['_all_docs']:
+				return self._all_docs(method, db, params, body)
+			if rest == ['_bulk_docs']:
+				return self._bulk_docs(method, db, body)
+			if rest == ['_changes']:
+				return self._changes(method, db, params)
+			if rest == ['_temp_view']:
+				return self._temp_view(method, db, params, body)
+			if len(rest) == 1:
+				return self._document(method, db, rest[0], params, body)
+			return self._attachment(method, db, rest[0], '/'.join(rest[1:]), params, body, content_type)
+		finally:
+			self._lock.release()
+
+	### databases
+	def _find_db(self, name):
+		if name.startswith('shards/'):
+			# one shard of a database, by its ShardMap name
+			try:
+				ignored, range, dbname = name.split('/', 2)
+				low = int(range.split('-')[0], 16)
+			except ValueError:
+				raise _not_found("no_db_file")
+			home = self._dbs.get(dbname)
+			if home is None:
+				raise _not_found("no_db_file")
+			index = low / (0x100000000 / self.nshards)
+			return _Database(name, [home.shards[index]], False, home)
+		db = self._dbs.get(name)
+		if db is None:
+			raise _not_found("no_db_file")
+		return db
+
+	def _database(self, method, name, body):
+		if method == 'PUT':
+			if name in self._dbs:
+				raise _HTTPError(412, "file_exists", "The database could not be created, the file already exists.")
+			self._dbs[name] = _Database(name, [_Shard() for i in range(self.nshards)], self.nshards > 1)
+			return 201, {"ok": True}
+		db = self._find_db(name)
+		if method in ('GET', 'HEAD'):
+			doc_count = sum([len(shard.docs) for shard in db.shards])
+			del_count = sum([len(shard.revs) - len(shard.docs) for shard in db.shards])
+			return 200, {"db_name": name, "doc_count": doc_count, "doc_del_count": del_count,
+				"update_seq": db.update_seq(), "disk_size": 0}
+		if method == 'DELETE':
+			if db.home is not db:
+				raise _HTTPError(403, "forbidden", "delete the whole database instead of a shard")
+			del self._dbs[name]
+			self._lock.notifyAll()
+			return 200, {"ok": True}
+		if method == 'POST':
+			doc = self._decode(body)
+			docid = doc.get('_id') or uuid.uuid4().hex
+			rev = self._write(db, docid, doc)
+			return 201, {"ok": True, "id": docid, "rev": rev}
+		raise _HTTPError(405, "method_not_allowed", "Only GET,HEAD,PUT,POST,DELETE allowed")
+
+	def _decode(self, body):
+		try:
+			return json.loads(body)
+		except ValueError:
+			raise _HTTPError(400, "bad_request", "invalid UTF-8 JSON")
+
+	### documents
+	def _write(self, db, docid, doc, new_edits=True):
+		"""Store a new revision of a doc (or a tombstone, for _deleted).  Returns the rev."""
+		shard = db.shard_for(docid)
+		current = shard.revs.get(docid)
+		if new_edits:
+			given = doc.get('_rev')
+			if docid in shard.docs and given != current:
+				raise _conflict()
+			if docid not in shard.docs and given is not None and given != current:
+				raise _conflict()
+			rev = _new_rev(current, doc)
+		else:
+			rev = doc['_rev']
+
+		old_atts = shard.attachments.get(docid, {})
+		atts = {}
+		revpos = int(rev.split('-', 1)[0])
+		for name, info in (doc.get('_attachments') or {}).iteritems():
+			if info.get('stub'):
+				if name not in old_atts:
+					raise _HTTPError(412, "missing_stub", "no previous attachment named %s" % name)
+				atts[name] = old_atts[name]
+			else:
+				atts[name] = (info.get('content_type', 'application/octet-stream'),
+					base64.b64decode(info.get('data', '')), revpos)
+		self._store(db, docid, doc, rev, atts, doc.get('_deleted', False))
+		return rev
+
+	def _store(self, db, docid, doc, rev, atts, deleted=False):
+		shard = db.shard_for(docid)
+		shard.revs[docid] = rev
+		if deleted:
+			shard.docs.pop(docid, None)
+			shard.attachments.pop(docid, None)
+		else:
+			stored = dict(doc)
+			stored['_id'] = docid
+			stored['_rev'] = rev
+			stored.pop('_attachments', None)
+			if atts:
+				stored['_attachments'] = dict([(name, {"content_type": ct, "length": len(data), "revpos": pos, "stub": True})
+					for name, (ct, data, pos) in atts.iteritems()])
+				shard.attachments[docid] = atts
+			else:
+				shard.attachments.pop(docid, None)
+			shard.docs[docid] = (stored, json.dumps(stored))
+		shard.bump(docid)
+		self._lock.notifyAll()
+
+	def _document(self, method, db, docid, params, body):
+		if method in ('GET', 'HEAD'):
+			found = db.get(docid)
+			if found is None:
+				raise _not_found(docid in db.shard_for(docid).revs and "deleted" or "missing")
+			return 200, "application/json", found[1]
+		if method == 'PUT':
+			doc = self._decode(body)
+			if params.get('batch') == 'ok':
+				try:
+					self._write(db, docid, doc)
+				except _HTTPError:
+					# like CouchDB, batch mode doesn't tell you about conflicts
+					pass
+				return 202, {"ok": True, "id": docid}
+			rev = self._write(db, docid, doc)
+			return 201, {"ok": True, "id": docid, "rev": rev}
+		if method == 'DELETE':
+			if db.get(docid) is None:
+				raise _not_found()
+			rev = self._write(db, docid, {"_rev": params.get('rev'), "_deleted": True})
+			return 200, {"ok": True, "id": docid, "rev": rev}
+		raise _HTTPError(405, "method_not_allowed", "Only GET,HEAD,PUT,DELETE allowed")
+
+	def _attachment(self, method, db, docid, name, params, body, content_type):
+		shard = db.shard_for(docid)
+		if method in ('GET', 'HEAD'):
+			if db.get(docid) is None or name not in shard.attachments.get(docid, {}):
+				raise _not_found()
+			ct, data, revpos = shard.attachments[docid][name]
+			return 200, ct, data
+		if method not in ('PUT', 'DELETE'):
+			raise _HTTPError(405, "method_not_allowed", "Only GET,HEAD,PUT,DELETE allowed")
+		found = db.get(docid)
+		current = shard.revs.get(docid)
+		if found is not None and params.get('rev') != current:
+			raise _conflict()
+		doc = found and dict(found[0]) or {}
+		atts = dict(shard.attachments.get(docid, {}))
+		if method == 'DELETE':
+			if name not in atts:
+				raise _not_found()
+			del atts[name]
+		rev = _new_rev(current, doc)
+		if method == 'PUT':
+			atts[name] = (content_type, body, int(rev.split('-', 1)[0]))
+		self._store(db, docid, doc, rev, atts)
+		return (method == 'PUT' and 201 or 200), {"ok": True, "id": docid, "rev": rev}
+
+	def _bulk_docs(self, method, db, body):
+		if method != 'POST':
+			raise _HTTPError(405, "method_not_allowed", "Only POST allowed")
+		request = self._decode(body)
+		new_edits = request.get('new_edits', True)
+		results = []
+		for doc in request.get('docs', []):
+			docid = doc.get('_id') or uuid.uuid4().hex
+			try:
+				rev = self._write(db, docid, doc, new_edits)
+				results.append({"id": docid, "rev": rev})
+			except _HTTPError, e:
+				results.append({"id": docid, "error": e.error, "reason": e.reason})
+		return 201, results
+
+	### views
+	def _json_params(self, params, body=None):
+		"""Decode the JSON-encoded query args, plus keys from a POST body."""
+		decoded = {}
+		for key, value in params.iteritems():
+			if key in ('stale', 'feed', 'since', 'batch', 'rev'):
+				decoded[key] = value
+				continue
+			try:
+				decoded[key] = json.loads(value)
+			except ValueError:
+				raise _HTTPError(400, "query_parse_error", "Invalid JSON for %s: %s" % (key, value))
+		if body:
+			request = self._decode(body)
+			if 'keys' in request:
+				decoded['keys'] = request['keys']
+		return decoded
+
+	def _all_docs(self, method, db, params, body):
+		params = self._json_params(params, method == 'POST' and body or None)
+		include_docs = params.get('include_docs', False)
+		if 'keys' in params:
+			rows = []
+			for key in params['keys']:
+				shard = db.shard_for(key)
+				if key in shard.docs:
+					row = {"id": key, "key": key, "value": {"rev": shard.revs[key]}}
+					if include_docs:
+						row["doc"] = shard.docs[key][0]
+				elif key in shard.revs:
+					row = {"id": key, "key": key, "value": {"rev": shard.revs[key], "deleted": True}}
+					if include_docs:
+						row["doc"] = None
+				else:
+					row = {"key": key, "error": "not_found"}
+				rows.append(row)
+			total = sum([len(shard.docs) for shard in db.shards])
+			return 200, {"total_rows": total, "offset": 0, "rows": rows}
+
+		rows = []
+		for shard in db.shards:
+			for docid, (doc, encoded) in shard.docs.iteritems():
+				rows.append((docid, docid, docid, {"rev": doc['_rev']}))
+		rows.sort()
+		return 200, self._query(db, rows, params, lambda key: key)
+
+	def _view(self, method, db, ddoc_id, view_name, params, body):
+		if method not in ('GET', 'HEAD', 'POST'):
+			raise _HTTPError(405, "method_not_allowed", "Only GET,HEAD,POST allowed")
+		found = db.home.get(ddoc_id)
+		if found is None:
+			raise _not_found()
+		design = found[0]
+		view = design.get('views', {}).get(view_name)
+		if view is None:
+			raise _not_found("missing_named_view")
+		params = self._json_params(params, method == 'POST' and body or None)
+
+		cache_key = (ddoc_id, view_name)
+		version = (design['_rev'], db.version())
+		cached = db.view_cache.get(cache_key)
+		if cached is not None and cached[0] == version:
+			rows = cached[1]
+		else:
+			rows = self._map(db, design.get('language', 'javascript'), view['map'])
+			db.view_cache[cache_key] = (version, rows)
+		return 200, self._query(db, rows, params, _collation_key, view.get('reduce'), design.get('language', 'javascript'))
+
+	def _temp_view(self, method, db, params, body):
+		if method != 'POST':
+			raise _HTTPError(405, "method_not_allowed", "Only POST allowed")
+		view = self._decode(body)
+		language = view.get('language', 'javascript')
+		rows = self._map(db, language, view['map'])
+		return 200, self._query(db, rows, self._json_params(params), _collation_key, view.get('reduce'), language)
+
+	def _function(self, language, source):
+		"""Compile the Python function in source, or find a registered stand-in."""
+		if source in self._registered_maps:
+			return self._registered_maps[source]
+		function = self._functions.get(source)
+		if function is None:
+			if language != 'python':
+				raise _HTTPError(500, "unsupported_language",
+					"FakeLounge only runs python views; register a stand-in for: %s" % source)
+			namespace = {'emit': lambda key, value: self._emitted.append((key, value))}
+			try:
+				exec compile(source, "<view>", "exec") in namespace
+			except SyntaxError, e:
+				raise _HTTPError(400, "compilation_error", str(e))
+			functions = [f for f in namespace.values()
+				if isinstance(f, types.FunctionType) and f.func_code.co_filename == "<view>"]
+			if len(functions) != 1:
+				raise _HTTPError(400, "compilation_error", "expected exactly one function")
+			function = self._functions[source] = functions[0]
+		return function
+
+	def _map(self, db, language, source):
+		"""Run a map function over every doc; returns sorted (collation key, id, key, value) rows."""
+		function = self._function(language, source)
+		rows = []
+		for docid, doc in db.iterdocs():
+			if docid.startswith('_design/'):
+				continue
+			del self._emitted[:]
+			try:
+				result = function(copy.deepcopy(doc))
+				if result is None:
+					result = self._emitted
+				for key, value in result:
+					rows.append((_collation_key(key), docid, key, value))
+			except Exception:
+				# CouchDB skips docs that make the map function throw
+				logging.debug("FakeLounge: map function failed on %s" % docid, exc_info=True)
+		rows.sort()
+		return rows
+
+	def _query(self, db, rows, params, collate, reduce=None, language=None):
+		"""Apply view query args to sorted (collation key, id, key, value) rows."""
+		total = len(rows)
+		descending = params.get('descending', False)
+		if descending:
+			rows = rows[::-1]
+		offset = 0
+		keys = params.get('keys')
+		if 'key' in params:
+			keys = [params['key']]
+		if keys is not None:
+			by_key = {}
+			for row in rows:
+				by_key.setdefault(row[0], []).append(row)
+			selected = []
+			for key in keys:
+				selected.extend(by_key.get(collate(key), []))
+			rows = selected
+		else:
+			# compare (collated key, doc id) when a docid bound is given, and
+			# just the collated key otherwise
+			def position(row, docid):
+				return (row[0], docid is not None and row[1] or None)
+			start = params.get('startkey', params.get('start_key', _MISSING))
+			end = params.get('endkey', params.get('end_key', _MISSING))
+			start_id = params.get('startkey_docid')
+			end_id = params.get('endkey_docid')
+			if start is not _MISSING:
+				bound = (collate(start), start_id)
+				if descending:
+					kept = [row for row in rows if position(row, start_id) <= bound]
+				else:
+					kept = [row for row in rows if position(row, start_id) >= bound]
+				offset = len(rows) - len(kept)
+				rows = kept
+			if end is not _MISSING:
+				bound = (collate(end), end_id)
+				if params.get('inclusive_end', True):
+					if descending:
+						rows = [row for row in rows if position(row, end_id) >= bound]
+					else:
+						rows = [row for row in rows if position(row, end_id) <= bound]
+				else:
+					if descending:
+						rows = [row for row in rows if position(row, end_id) > bound]
+					else:
+						rows = [row for row in rows if position(row, end_id) < bound]
+
+		if reduce and params.get('reduce', True):
+			return {"rows": self._reduce(rows, params, reduce, language)}
+
+		skip = params.get('skip', 0)
+		limit = params.get('limit')
+		rows = rows[skip:]
+		if limit is not None:
+			rows = rows[:limit]
+		include_docs = params.get('include_docs', False)
+		result = []
+		for ck, docid, key, value in rows:
+			row = {"id": docid, "key": key, "value": value}
+			if include_docs:
+				found = db.get(docid)
+				row["doc"] = found and found[0] or None
+			result.append(row)
+		return {"total_rows": total, "offset": offset + skip, "rows": result}
+
+	def _reduce(self, rows, params, reduce, language):
+		if reduce == '_count':
+			function = lambda keys, values, rereduce: len(values)
+		elif reduce == '_sum':
+			function = lambda keys, values, rereduce: sum(values)
+		else:
+			function = self._function(language, reduce)
+		group_level = params.get('group_level')
+		if params.get('group', False) and group_level is None:
+			group_level = -1
+		groups = []
+		for ck, docid, key, value in rows:
+			if group_level is None:
+				group_key = None
+			elif group_level == -1 or not isinstance(key, list):
+				group_key = key
+			else:
+				group_key = key[:group_level]
+			if not groups or groups[-1][0] != group_key:
+				groups.append((group_key, [], []))
+			groups[-1][1].append([key, docid])
+			groups[-1][2].append(value)
+		return [{"key": key, "value": function(keys, values, False)} for key, keys, values in groups]
+
+	### changes
+	def _changes(self, method, db, params):
+		if method not in ('GET', 'HEAD'):
+			raise _HTTPError(405, "method_not_allowed", "Only GET,HEAD allowed")
+		since = params.get('since', '0')
+		try:
+			since = json.loads(since)
+		except ValueError:
+			raise _HTTPError(400, "bad_request", "Invalid since: %s" % since)
+		if not isinstance(since, list):
+			since = [since] * len(db.shards)
+		if len(since) != len(db.shards):
+			raise _HTTPError(400, "bad_request", "since needs one sequence per shard")
+		params = self._json_params(dict([(k, v) for k, v in params.iteritems() if k != 'since']))
+		limit = params.get('limit')
+		include_docs = params.get('include_docs', False)
+
+		deadline = time.time() + params.get('timeout', 60000) / 1000.0
+		while True:
+			results, last_seq = self._collect_changes(db, since, limit, include_docs)
+			if results or params.get('feed') != 'longpoll':
+				break
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			self._lock.wait(remaining)
+			if db.home.name not in self._dbs:
+				raise _not_found("no_db_file")
+		return 200, {"results": results, "last_seq": last_seq}
+
+	def _collect_changes(self, db, since, limit, include_docs):
+		current = list(since)
+		results = []
+		for i, shard in enumerate(db.shards):
+			for seq, docid in shard.changes(since[i]):
+				if limit is not None and len(results) >= limit:
+					break
+				current[i] = seq
+				row = {"seq": db.sharded and list(current) or seq, "id": docid,
+					"changes": [{"rev": shard.revs[docid]}]}
+				found = shard.docs.get(docid)
+				if found is None:
+					row["deleted"] = True
+				if include_docs:
+					row["doc"] = found and found[0] or None
+				results.append(row)
+		if db.sharded:
+			return results, current
+		return results, current[0]
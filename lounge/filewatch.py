@@ -0,0 +1,169 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Watch files for changes from a background thread.
+
+FileWatcher uses inotify when it's available (Linux, through ctypes) and falls
+back on a thread that stats the files every `interval` seconds.  Either way,
+the callback is called from the watcher thread with the list of paths that
+may have changed; it should check for itself whether they really did.
+
+Example:
+  def changed(paths):
+    for path in paths:
+      print path, "changed"
+  watcher = FileWatcher(["/etc/lounge/shards.conf"], changed)
+  ...
+  watcher.stop()
+"""
+
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+try:
+	import ctypes
+	import ctypes.util
+except ImportError:
+	ctypes = None
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+_IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")
+
+def _load_inotify():
+	if ctypes is None:
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		libc.inotify_init
+		libc.inotify_add_watch
+	except (OSError, AttributeError):
+		return None
+	return libc
+
+def stat_signature(path):
+	"""Something that changes whenever the file at path is changed or replaced.
+
+	Returns None if the file doesn't exist.
+	"""
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_mtime, st.st_size, st.st_ino)
+
+class FileWatcher(object):
+	"""Calls callback(paths) from a daemon thread when the files at paths change."""
+
+	def __init__(self, paths, callback, interval=0.5, use_inotify=True):
+		self.paths = [os.path.abspath(p) for p in paths]
+		self.callback = callback
+		self.interval = interval
+		self._stopped = threading.Event()
+		self._fd = None
+		# take the baseline now, not when the thread gets around to it
+		self._signatures = dict([(path, stat_signature(path)) for path in self.paths])
+		libc = use_inotify and _load_inotify() or None
+		if libc is not None:
+			self._fd = self._start_inotify(libc)
+		if self._fd is not None:
+			target = self._inotify_loop
+		else:
+			target = self._poll_loop
+		self._thread = threading.Thread(target=target, name="FileWatcher")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def _start_inotify(self, libc):
+		fd = libc.inotify_init()
+		if fd < 0:
+			return None
+		# watch the directories so that files replaced by a rename are noticed
+		self._watches = {}
+		for path in self.paths:
+			dirname, basename = os.path.split(path)
+			if dirname not in self._watches.values():
+				wd = libc.inotify_add_watch(fd, dirname, _IN_MASK)
+				if wd < 0:
+					os.close(fd)
+					return None
+				self._watches[wd] = dirname
+		return fd
+
+	def _call(self, paths):
+		try:
+			self.callback(paths)
+		except Exception:
+			logging.exception("FileWatcher: callback failed for %s" % ", ".join(paths))
+
+	def _inotify_loop(self):
+		try:
+			while not self._stopped.isSet():
+				try:
+					readable = select.select([self._fd], [], [], self.interval)[0]
+				except select.error, e:
+					if e.args[0] == errno.EINTR:
+						continue
+					raise
+				if not readable:
+					continue
+				data = os.read(self._fd, 65536)
+				changed = set()
+				offset = 0
+				while offset < len(data):
+					wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+					offset += _EVENT_HEADER.size
+					name = data[offset:offset+length].rstrip("\0")
+					offset += length
+					path = os.path.join(self._watches.get(wd, ""), name)
+					if path in self.paths:
+						changed.add(path)
+				if changed:
+					self._call(sorted(changed))
+		finally:
+			os.close(self._fd)
+
+	def _poll_loop(self):
+		signatures = self._signatures
+		while True:
+			self._stopped.wait(self.interval)
+			if self._stopped.isSet():
+				return
+			changed = []
+			for path in self.paths:
+				signature = stat_signature(path)
+				if signature != signatures[path]:
+					signatures[path] = signature
+					changed.append(path)
+			if changed:
+				self._call(changed)
+
+	def uses_inotify(self):
+		return self._fd is not None
+
+	def stop(self):
+		"""Stop watching.  Waits for the watcher thread to finish."""
+		self._stopped.set()
+		if self._thread is not threading.currentThread():
+			self._thread.join()
@@ -12,10 +12,18 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
-from xml.dom.minidom import parse
+from xml.dom import minidom
+from xml.parsers import expat
+import hashlib
+import marshal
 import os
+import tempfile
+import threading
 import time
 import logging
+import weakref
+
+from lounge.filewatch import FileWatcher
 
 class PrefsException(Exception):
 	pass
@@ -23,7 +31,232 @@ class PrefsException(Exception):
 class InvalidPrefEntry(PrefsException):
 	pass
 
-class Prefs:
+# sentinel for prefs missing from the index
+_MISSING = object()
+
+def _join(path, name):
+	"""Path of the child `name` of the node at `path`.
+
+	The root node's path is '', so its children are '/foo', '/bar', etc.
+	"""
+	return path + "/" + name
+
+def _normalize(pref_name):
+	"""Turn a pref name into the path it's indexed under.
+
+	get_pref ignores whatever comes before the first slash and everything
+	after a '*', so 'x/foo/*/bar' means the same thing as '/foo/*'.
+	"""
+	names = pref_name.split("/")[1:]
+	if "*" in names:
+		names = names[:names.index("*") + 1]
+	return "".join(["/" + name for name in names])
+
+def _convert(type, val, items):
+	"""Convert a pref's value attribute according to its type attribute.
+
+	items is the list of values of the pref's <item> elements.
+	"""
+	if type == "bool":
+		if val not in ['0','1']:
+			raise InvalidPrefEntry("Was expecting '0' or '1' for a boolean value, but found '%s'" % val)
+		else:
+			return (val == '1')
+	elif type == "string":
+		return val
+	elif type == "int":
+		return int(val)
+	elif type == "stringlist":
+		return items
+
+def _missing_pref(pref_name, default, no_missing_keys):
+	"""What get_pref does when it can't find a pref."""
+	if default is not None:
+		return default
+	elif no_missing_keys:
+		raise KeyError("get_pref couldn't find the requested preference: '%s'" % pref_name)
+	else:
+		logging.warning(""" get_pref couldn't find the requested preference: '%s' -- you're not using no_missing_keys, so this isn't an error, but you should probably make sure that the preference you're looking for is correct and switch over to using no_missing_keys.  Eventually, no_missing_keys will be the default behavior and then where will you be?  You'll be at Sad Towne, my friend.  Nobody wants to go to Sad Towne.  """ % pref_name)
+	return default
+
+# bump this whenever the layout of the parsed-prefs cache changes
+CACHE_VERSION = 1
+
+def _cache_path(cache_dir, filename):
+	return os.path.join(cache_dir, "prefs-%s.cache" % hashlib.md5(os.path.abspath(filename)).hexdigest())
+
+def _load_cached(cache_dir, filename, stat_info):
+	"""Return the cached (values, errors) for filename, or None if there's no valid entry."""
+	try:
+		f = open(_cache_path(cache_dir, filename), 'rb')
+	except IOError:
+		return None
+	try:
+		try:
+			version, path, size, mtime, ino, values, errors = marshal.load(f)
+		except (EOFError, ValueError, TypeError), e:
+			logging.warning("Prefs: ignoring unreadable cache entry for %s: %s" % (filename, e))
+			return None
+	finally:
+		f.close()
+	if version != CACHE_VERSION or path != os.path.abspath(filename) or \
+			(size, mtime, ino) != (stat_info.st_size, stat_info.st_mtime, stat_info.st_ino):
+		return None
+	for key, (name, args) in errors.items():
+		if name == InvalidPrefEntry.__name__:
+			errors[key] = InvalidPrefEntry(*args)
+		else:
+			errors[key] = ValueError(*args)
+	return values, errors
+
+def _store_cached(cache_dir, filename, stat_info, values, errors):
+	"""Write the parsed values for filename to the cache.
+
+	The entry is written to a temporary file and renamed into place, so other
+	processes only ever see whole entries.  Failures are logged and otherwise
+	ignored; the cache is only an optimization.
+	"""
+	errors = dict([(key, (e.__class__.__name__, e.args)) for key, e in errors.iteritems()])
+	entry = (CACHE_VERSION, os.path.abspath(filename),
+		stat_info.st_size, stat_info.st_mtime, stat_info.st_ino, values, errors)
+	try:
+		fd, tmp_path = tempfile.mkstemp(prefix=".prefs", dir=cache_dir)
+	except OSError, e:
+		logging.warning("Prefs: couldn't write cache entry for %s: %s" % (filename, e))
+		return
+	try:
+		f = os.fdopen(fd, 'wb')
+		try:
+			marshal.dump(entry, f)
+		finally:
+			f.close()
+		os.rename(tmp_path, _cache_path(cache_dir, filename))
+	except (OSError, IOError, ValueError), e:
+		logging.warning("Prefs: couldn't write cache entry for %s: %s" % (filename, e))
+		try:
+			os.unlink(tmp_path)
+		except OSError:
+			pass
+
+def _changed_paths(old_state, new_state):
+	"""The sorted paths whose value or error differs between two (index, errors) states."""
+	old_index, old_errors = old_state
+	new_index, new_errors = new_state
+	changed = set()
+	for path in set(old_index) | set(new_index):
+		if old_index.get(path, _MISSING) != new_index.get(path, _MISSING):
+			changed.add(path)
+	for path in set(old_errors) | set(new_errors):
+		old, new = old_errors.get(path), new_errors.get(path)
+		if old is None or new is None or (old.__class__, old.args) != (new.__class__, new.args):
+			changed.add(path)
+	return sorted(changed)
+
+class _Frame(object):
+	"""An element that's open while parsing a prefs file."""
+	__slots__ = ('is_pref', 'name', 'type', 'value', 'items', 'path', 'children', 'taken', 'star_error')
+
+	def __init__(self, is_pref, attrs, path):
+		self.is_pref = is_pref
+		self.name = attrs.get('name', '')
+		self.type = attrs.get('type', '')
+		self.value = attrs.get('value', '')
+		self.items = []
+		# path is None unless get_pref can reach this pref
+		self.path = path
+		self.children = {}
+		self.taken = set()
+		self.star_error = None
+
+class _PrefsParser(object):
+	"""Flattens a prefs file into (values, errors) with expat.
+
+	values maps each reachable path to its converted value (and '<path>/*' to
+	the dict of its children's values); errors maps paths to the exception
+	get_pref should raise for them.  Nothing but the currently open elements
+	is kept while parsing.
+	"""
+	def __init__(self):
+		self.values = {}
+		self.errors = {}
+		self.stack = []
+
+	def parse(self, filename):
+		parser = expat.ParserCreate()
+		parser.StartElementHandler = self.start
+		parser.EndElementHandler = self.end
+		f = open(filename, 'rb')
+		try:
+			parser.ParseFile(f)
+		finally:
+			f.close()
+		return self.values, self.errors
+
+	def start(self, tag, attrs):
+		stack = self.stack
+		if tag == "item":
+			# like getElementsByTagName, a stringlist gets all the items under it
+			value = attrs.get('value', '')
+			for frame in stack:
+				if frame.type == "stringlist":
+					frame.items.append(value)
+		path = None
+		if tag == "pref":
+			name = attrs.get('name', '')
+			if not stack:
+				if name == "/":
+					path = ""
+			else:
+				parent = stack[-1]
+				# the first child with a name wins, and get_pref can't reach
+				# names with a '*' or '/'
+				if parent.path is not None and parent.is_pref and name not in parent.taken \
+						and name != "*" and "/" not in name:
+					parent.taken.add(name)
+					path = _join(parent.path, name)
+		stack.append(_Frame(tag == "pref", attrs, path))
+
+	def end(self, tag):
+		frame = self.stack.pop()
+		if not frame.is_pref:
+			return
+		try:
+			value = _convert(frame.type, frame.value, frame.items)
+			error = None
+		except (PrefsException, ValueError), e:
+			error = e
+		if frame.path is not None:
+			if error is None:
+				self.values[frame.path] = value
+			else:
+				self.errors[frame.path] = error
+			star = _join(frame.path, "*")
+			if frame.star_error is None:
+				self.values[star] = frame.children
+			else:
+				self.errors[star] = frame.star_error
+		if self.stack:
+			parent = self.stack[-1]
+			if parent.path is not None and parent.is_pref:
+				if error is None:
+					parent.children[frame.name] = value
+				elif parent.star_error is None:
+					parent.star_error = error
+
+class BoundPrefs(object):
+	"""Prefs resolved by Prefs.bind, as attributes.
+
+	The attributes are plain instance attributes, replaced all together
+	whenever the Prefs they came from reload a changed file.
+	"""
+	def __init__(self, schema):
+		self._schema = schema
+
+	def __repr__(self):
+		names = sorted([name for name in self.__dict__ if not name.startswith('_')])
+		return "<BoundPrefs %s>" % ", ".join(["%s=%r" % (name, self.__dict__[name]) for name in names])
+
+class Prefs(object):
 	"""pass in any number of conf files to the constructor.
 	The hierarchy is from right to left.  e.g. if the value of foo in A is 100, and the value of foo in B is 200
 	And the constructor looks like Prefs('A','B') then calling get_prefs('foo') will return 200.
@@ -47,14 +280,47 @@ class Prefs:
 	If you want to override multiple prefs files, you can separate the pairs with semicolons.
 	Example of multiple overrides:
 		export LOUNGE_PREF_OVERRIDES='/first/pref/file:/first/over/ride;/second/pref/file:/second/over/ride'
+
+	Each file is flattened into a dict from full path (e.g. '/foo/bar', or '/foo/*' for all the values
+	under foo) to the converted value when it is loaded, and the files are merged into one dict, so
+	get_pref is a single lookup.  get_pref returns the same list or dict object every time it's asked
+	for a stringlist or a '*', so don't modify them.
+
+	Instead of reload, you can pass watch=True to watch the files from a background thread (using
+	inotify where it's available, or by statting them every watch_interval seconds).  Changed files are
+	reparsed on that thread and the new index is swapped in all at once, so get_pref never waits on a
+	reparse and never sees a half-updated index.  Call stop_watching() to stop.
+
+	Short-lived scripts can pass cache_dir to keep the parsed result of each file on disk.  Entries are
+	keyed by the path of the file that was actually read (after LOUNGE_PREF_OVERRIDES), its size, mtime
+	and inode, and are only used while all of those still match; otherwise the file is parsed and the
+	entry rewritten.
+
+	get_prefs looks up several prefs at once, all from the same version of the files.  bind turns a
+	schema into an object whose attributes are the (converted) prefs, so reading them on a hot path is
+	an attribute lookup:
+		conf = prefs.bind({'port': '/service/port',
+			'timeout': ('/service/timeout_ms', lambda ms: ms / 1000.0, 5.0)})
+		conf.port, conf.timeout
+	Bound objects are refreshed when a reload changes the files, so watch=True keeps them current.
+
+	The (index, errors) pair is never modified once it's published; a reload builds a new pair under a
+	writer lock and swaps it in with one assignment, so get_pref never takes a lock.  To rebuild derived
+	state (compiled regexes, routing tables) only when it's out of date, subscribe a callback to a pref
+	or to a subtree ('/routes/*'); it's called once per reload that changes any of those values.
 	"""
 	#args becomes a list of file names
 	#kwargs is a dictionary of arguments
 	def __init__(self, *args, **kwargs):
 		self.check_interval = 'check_interval' in kwargs and kwargs['check_interval'] or 30
-		self.pref_trees = []
+		self.pref_indexes = [] # (values, errors) flattened from each file
 		self.pref_files = {}#Key is the filename, value is a list (last change unix timestamp, index of file
-		# in self.pref_trees).  its a list, not a tuple because tuples are immutable
+		# in self.pref_indexes, size, inode).  its a list, not a tuple because tuples are immutable
+		self._reload_lock = threading.Lock()
+		self._watcher = None
+		self._bound = weakref.WeakKeyDictionary()
+		self._subscriptions = [] # (path, subtree, callback)
+		self.cache_dir = kwargs.get('cache_dir')
 
 		self.last_stat_check = 0
 		self.reload = 'reload' in kwargs and kwargs['reload'] or False
@@ -70,10 +336,13 @@ class Prefs:
 			if conf_file in self.pref_overrides:
 				logging.debug ("Prefs: using override: %s => %s" % (conf_file, self.pref_overrides[conf_file]))
 				conf_file = self.pref_overrides[conf_file]
-			dom = parse(conf_file)
-			self.pref_trees.append(dom)
 			stat_info = os.stat(conf_file)
-			self.pref_files[conf_file] = [stat_info.st_mtime, len(self.pref_trees)-1]
+			self.pref_indexes.append(self._compile(conf_file, stat_info))
+			self.pref_files[conf_file] = [stat_info.st_mtime, len(self.pref_indexes)-1, stat_info.st_size, stat_info.st_ino]
+		self._state = self._merge(self.pref_indexes)
+
+		if kwargs.get('watch'):
+			self.watch(kwargs.get('watch_interval', 0.5))
 
 	def _get_pref_overrides(self):
 		"""
@@ -97,6 +366,49 @@ class Prefs:
 			pref_overrides = dict(zip(pref_names,overrides))
 		return pref_overrides
 
+	def _compile(self, filename, stat_info=None, use_cache=True):
+		"""Flatten a prefs file into a dict from path to value, and a dict from path
+		to the exception get_pref should raise for entries that can't be converted.
+
+		stat_info should be taken before the file is read, so that a cache entry
+		never claims to be newer than what was parsed.
+		"""
+		if self.cache_dir is None or stat_info is None:
+			return _PrefsParser().parse(filename)
+		if use_cache:
+			cached = _load_cached(self.cache_dir, filename, stat_info)
+			if cached is not None:
+				return cached
+		values, errors = _PrefsParser().parse(filename)
+		_store_cached(self.cache_dir, filename, stat_info, values, errors)
+		return values, errors
+
+	def _merge(self, pref_indexes):
+		"""Merge flattened files into the (index, errors) pair get_pref uses."""
+		index = {}
+		errors = {}
+		# start with the file with the lowest precedence
+		for file_values, file_errors in pref_indexes[::-1]:
+			for path in file_errors:
+				index.pop(path, None)
+			for path in errors.keys():
+				if path in file_values:
+					del errors[path]
+			index.update(file_values)
+			errors.update(file_errors)
+		return index, errors
+
+	def _get_pref_trees(self):
+		"""The files as xml.dom.minidom documents, highest precedence first, the
+		way pref_trees used to hold them.  They're parsed from disk every time,
+		which is slow and takes a lot of memory, so this is only here for old
+		callers; use get_pref or get_prefs instead."""
+		files = sorted([(info[1], filename) for filename, info in self.pref_files.items()])
+		return [minidom.parse(filename) for index, filename in files]
+	pref_trees = property(_get_pref_trees)
+
+	# find_elem, get_all_vals and get_val work on xml.dom.minidom nodes, for
+	# anybody who still parses pref files that way
 	def find_elem(self, key, curr_tree):
 		for child in curr_tree.childNodes:
 			if not child.nodeName == "pref":
@@ -115,54 +427,186 @@ class Prefs:
 	
 	def get_val(self, node, type=None):
 		type = type and type or node.getAttribute("type")
-		val = node.getAttribute("value")
-		if type == "bool":
-			if val not in ['0','1']:
-				raise InvalidPrefEntry("Was expecting '0' or '1' for a boolean value, but found '%s'" % val)
-			else:
-				return (val == '1')
-		elif type == "string":
-			return val
-		elif type == "int":
-			return int(val)
-		elif type == "stringlist":
+		items = None
+		if type == "stringlist":
 			#return the value attribute of all children where nodetype == 'item'
-			return [self.get_val(n, "string") for n in node.getElementsByTagName("item")]
+			items = [self.get_val(n, "string") for n in node.getElementsByTagName("item")]
+		return _convert(type, node.getAttribute("value"), items)
+
+	def _lookup(self, state, pref_name, default):
+		index, errors = state
+		val = index.get(pref_name, _MISSING)
+		if val is not _MISSING:
+			return val
+		path = _normalize(pref_name)
+		val = index.get(path, _MISSING)
+		if val is not _MISSING:
+			return val
+		if path in errors:
+			e = errors[path]
+			raise e.__class__(*e.args)
+		return _missing_pref(pref_name, default, self.no_missing_keys)
 
 	def get_pref(self, pref_name, default=None):
-		if self.reload:
+		if self.reload and self._watcher is None:
+			self.check_reload()
+
+		# grab the index and errors together; a reload swaps in a new pair
+		return self._lookup(self._state, pref_name, default)
+
+	def get_prefs(self, pref_names, default=None):
+		"""Look up several prefs at once, returning a list of their values.
+
+		All of them come from the same version of the files, even if a reload
+		happens halfway through.
+		"""
+		if self.reload and self._watcher is None:
 			self.check_reload()
+		state = self._state
+		return [self._lookup(state, pref_name, default) for pref_name in pref_names]
+
+	def bind(self, schema):
+		"""Resolve a schema into a BoundPrefs object.
+
+		schema maps attribute names to either a pref name or a tuple of
+		(pref name, convert, default); convert (which may be None) is called on
+		the pref's value, and default is used as is when the pref is missing.
+		Raises like get_pref if any pref can't be resolved.
+		"""
+		bound = BoundPrefs(schema)
+		bound.__dict__.update(self._resolve(self._state, schema))
+		self._bound[bound] = True
+		return bound
 
-		keys = pref_name.split("/")
-		keys[0] = "/"
-		for curr_tree in self.pref_trees:
-			for key in keys:
-				if key == "*":
-					break
-				curr_tree = self.find_elem(key, curr_tree)
-				if curr_tree is None:#Element not found in this conf file, try the next one
-					break #we break here to cause the for key in keys: loop to terminate
-			if curr_tree is None: #if we broke out of the for key in keys: loop, skip to the next conf file
+	def _resolve(self, state, schema):
+		values = {}
+		for attr, spec in schema.iteritems():
+			if isinstance(spec, tuple):
+				pref_name, convert, default = spec
+			else:
+				pref_name, convert, default = spec, None, None
+			value = self._lookup(state, pref_name, _MISSING)
+			if value is _MISSING:
+				value = _missing_pref(pref_name, default, self.no_missing_keys)
+			elif convert is not None:
+				value = convert(value)
+			values[attr] = value
+		return values
+
+	def _refresh_bound(self, state):
+		for bound in self._bound.keys():
+			try:
+				values = self._resolve(state, bound._schema)
+			except Exception:
+				# keep serving the old values rather than half of the new ones
+				logging.exception("Prefs: couldn't refresh bound prefs; keeping the old values")
 				continue
-			if key == "*":
-				return self.get_all_vals(curr_tree)
-			return self.get_val(curr_tree)
-		if default is not None:
-			return default
-		elif self.no_missing_keys:
-			raise KeyError("get_pref couldn't find the requested preference: '%s'" % pref_name)
-		else:
-			logging.warning(""" get_pref couldn't find the requested preference: '%s' -- you're not using no_missing_keys, so this isn't an error, but you should probably make sure that the preference you're looking for is correct and switch over to using no_missing_keys.  Eventually, no_missing_keys will be the default behavior and then where will you be?  You'll be at Sad Towne, my friend.  Nobody wants to go to Sad Towne.  """ % pref_name)
-		return default
+			bound.__dict__.update(values)
 
 	def check_reload(self):
 		tm = int(time.time())
 		if self.last_stat_check + self.check_interval < tm:
 			self.last_stat_check = tm
+			self.reload_changed()
+
+	def reload_changed(self, force=()):
+		"""Reparse any file that has changed since it was loaded, and the files in force.
+
+		The new index is built on the side and swapped in at the end, and then
+		subscribers to prefs that changed are called.
+		Returns True if anything changed.
+		"""
+		self._reload_lock.acquire()
+		try:
+			old_state = self._state
+			pref_indexes = list(self.pref_indexes)
+			changed = False
 			for filename in self.pref_files:#iterate over all the files
-				stat_info = os.stat(filename)#stat them
+				try:
+					stat_info = os.stat(filename)#stat them
+				except OSError:
+					# probably in the middle of being replaced; we'll see it next time
+					continue
 				file = self.pref_files[filename]
-				if file[0] < stat_info.st_mtime:#if the files been changed since we last loaded
-					dom = parse(filename)#update the dom tree
-					file[0] - stat_info.st_mtime#and the stat time
-					self.pref_trees = self.pref_trees[0:file[1]] + [dom] + self.pref_trees[file[1]+1:]#splice
+				if filename in force or file[0] != stat_info.st_mtime or file[2] != stat_info.st_size or file[3] != stat_info.st_ino:
+					# a forced file may look unchanged, so don't trust the cache for it
+					pref_indexes[file[1]] = self._compile(filename, stat_info, filename not in force)#reparse the file
+					file[0], file[2], file[3] = stat_info.st_mtime, stat_info.st_size, stat_info.st_ino#and the stat info
+					changed = True
+			if changed:
+				state = self._merge(pref_indexes)
+				self.pref_indexes = pref_indexes
+				self._state = state
+				self._refresh_bound(state)
+		finally:
+			self._reload_lock.release()
+		if changed and self._subscriptions:
+			self._notify(_changed_paths(old_state, state))
+		return changed
+
+	def subscribe(self, pref_name, callback):
+		"""Call callback(paths) after a reload changes the pref at pref_name.
+
+		A pref_name ending in '/*' subscribes to everything under that node.
+		paths is the sorted list of changed paths the subscription covers; a
+		subscriber is called once per reload, however many of them changed.
+		Callbacks run on the thread that did the reload (the watcher thread,
+		with watch=True), after the new values are visible to get_pref.
+		"""
+		entry = self._subscription(pref_name) + (callback,)
+		# readers iterate over whatever list they find, so replace it instead of appending
+		self._reload_lock.acquire()
+		try:
+			self._subscriptions = self._subscriptions + [entry]
+		finally:
+			self._reload_lock.release()
+
+	def unsubscribe(self, pref_name, callback):
+		key = self._subscription(pref_name)
+		self._reload_lock.acquire()
+		try:
+			self._subscriptions = [entry for entry in self._subscriptions
+				if entry[:2] != key or entry[2] != callback]
+		finally:
+			self._reload_lock.release()
+
+	def _subscription(self, pref_name):
+		"""(path, subtree) for a subscription; a subtree's path is the prefix of the paths under it."""
+		path = _normalize(pref_name)
+		if path.endswith("/*"):
+			return (path[:-1], True)
+		return (path, False)
+
+	def _notify(self, changed):
+		for path, subtree, callback in self._subscriptions:
+			if subtree:
+				paths = [p for p in changed if p.startswith(path)]
+			elif path in changed:
+				paths = [path]
+			else:
+				continue
+			if not paths:
+				continue
+			try:
+				callback(paths)
+			except Exception:
+				logging.exception("Prefs: subscriber for %s failed" % path)
+
+	def watch(self, interval=0.5):
+		"""Start watching the pref files from a background thread.
+
+		While watching, get_pref doesn't check the files itself, even with reload.
+		"""
+		if self._watcher is None:
+			self._watched = dict([(os.path.abspath(f), f) for f in self.pref_files])
+			self._watcher = FileWatcher(self.pref_files.keys(), self._files_changed, interval)
+
+	def _files_changed(self, paths):
+		# trust the watcher even if the stat info looks the same; mtimes
+		# aren't always fine-grained enough to tell
+		self.reload_changed([self._watched[path] for path in paths])
+
+	def stop_watching(self):
+		if self._watcher is not None:
+			self._watcher.stop()
+			self._watcher = None
@@ -0,0 +1,212 @@
+#Copyright 2009 Meebo, Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Compiled Prefs snapshots that many processes share through mmap.
+
+Instead of every worker parsing the same pref files, compile them once:
+
+	python -m lounge.prefsnapshot /var/run/lounge/prefs.snap /etc/lounge/base.xml /etc/lounge/local.xml
+
+(or call write_snapshot from code) and have each worker map the result:
+
+	prefs = PrefsSnapshot("/var/run/lounge/prefs.snap")
+	prefs.get_pref("/service/port")
+
+The snapshot holds the merged index of a Prefs object, LOUNGE_PREF_OVERRIDES
+included, as an open-addressed hash table of marshalled values.  Workers
+map it read-only, so every process shares the same pages and nothing is
+parsed at startup.
+
+Each snapshot carries a version stamp.  write_snapshot replaces the file with
+a rename and then flags the old file as superseded; since the old file is
+still mapped by the workers, they see the flag on their next lookup and map
+the new file, without making any system calls in the meantime.
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+from lounge.prefs import Prefs, PrefsException, InvalidPrefEntry, _MISSING, _normalize, _missing_pref
+
+MAGIC = "LPS1"
+# magic, superseded flag, version stamp, number of slots, number of entries
+HEADER = struct.Struct("<4sIQII")
+SUPERSEDED_OFFSET = 4
+# hash, key offset, key length, value offset, value length
+SLOT = struct.Struct("<IIIII")
+
+class InvalidSnapshot(PrefsException):
+	pass
+
+def _hash(key):
+	return zlib.crc32(key) & 0xffffffff
+
+def _encode_key(key):
+	if isinstance(key, unicode):
+		return key.encode("utf8")
+	return key
+
+def write_snapshot(path, prefs):
+	"""Write the merged prefs of a Prefs object (or a list of pref file names) to path."""
+	if not isinstance(prefs, Prefs):
+		prefs = Prefs(*prefs)
+	index, errors = prefs._state
+
+	entries = []
+	for key, value in index.iteritems():
+		entries.append((_encode_key(key), "v" + marshal.dumps(value)))
+	for key, e in errors.iteritems():
+		entries.append((_encode_key(key), "e" + marshal.dumps((e.__class__.__name__, e.args))))
+
+	nslots = 8
+	while nslots < len(entries) * 2:
+		nslots *= 2
+	slots = [(0, 0, 0, 0, 0)] * nslots
+	blob = []
+	offset = HEADER.size + SLOT.size * nslots
+	for key, value in entries:
+		h = _hash(key)
+		i = h & (nslots - 1)
+		# a slot is free until it has a value; keys (like the root's) can be empty
+		while slots[i][4]:
+			i = (i + 1) & (nslots - 1)
+		slots[i] = (h, offset, len(key), offset + len(key), len(value))
+		blob.append(key)
+		blob.append(value)
+		offset += len(key) + len(value)
+
+	version = int(time.time() * 1000000)
+	dirname = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(prefix=".prefsnapshot", dir=dirname)
+	f = os.fdopen(fd, "wb")
+	old = None
+	try:
+		try:
+			f.write(HEADER.pack(MAGIC, 0, version, nslots, len(entries)))
+			for slot in slots:
+				f.write(SLOT.pack(*slot))
+			f.write("".join(blob))
+			f.flush()
+			os.fsync(f.fileno())
+			f.close()
+			os.chmod(tmp_path, 0644)
+
+			# hold on to the old file so we can flag it once it's been replaced
+			try:
+				old = open(path, "r+b")
+			except IOError:
+				old = None
+			os.rename(tmp_path, path)
+		except:
+			f.close()
+			os.unlink(tmp_path)
+			raise
+		if old is not None:
+			old.seek(SUPERSEDED_OFFSET)
+			old.write(struct.pack("<I", 1))
+	finally:
+		if old is not None:
+			old.close()
+	return version
+
+class PrefsSnapshot(object):
+	"""Read-only prefs served from a snapshot written by write_snapshot.
+
+	get_pref behaves like Prefs.get_pref, including default and
+	no_missing_keys, except that values are unmarshalled on each call, so
+	callers get their own copies of lists and dicts.
+	"""
+	def __init__(self, path, no_missing_keys=False):
+		self.path = path
+		self.no_missing_keys = no_missing_keys
+		self._remap()
+
+	def _remap(self):
+		while True:
+			f = open(self.path, "rb")
+			try:
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			finally:
+				f.close()
+			magic, superseded, version, nslots, count = HEADER.unpack_from(m, 0)
+			if magic != MAGIC:
+				raise InvalidSnapshot("%s is not a prefs snapshot" % self.path)
+			if not superseded:
+				break
+			# replaced between our open and our read; try again
+		# swap everything in at once for other threads
+		self._map = (m, nslots - 1, version)
+
+	@property
+	def version(self):
+		return self._map[2]
+
+	def check(self):
+		"""Map the newest snapshot if the current one has been replaced.
+
+		Returns True if it was.  get_pref does this on its own.
+		"""
+		if self._map[0][SUPERSEDED_OFFSET] != "\0":
+			self._remap()
+			return True
+		return False
+
+	def _lookup(self, snapshot, key):
+		m, mask, version = snapshot
+		key = _encode_key(key)
+		h = _hash(key)
+		i = h & mask
+		while True:
+			slot_h, key_off, key_len, val_off, val_len = SLOT.unpack_from(m, HEADER.size + SLOT.size * i)
+			if not val_len:
+				return _MISSING
+			if slot_h == h and key_len == len(key) and m[key_off:key_off+key_len] == key:
+				value = m[val_off:val_off+val_len]
+				if value[0] == "v":
+					return marshal.loads(value[1:])
+				name, args = marshal.loads(value[1:])
+				if name == InvalidPrefEntry.__name__:
+					raise InvalidPrefEntry(*args)
+				raise ValueError(*args)
+			i = (i + 1) & mask
+
+	def get_pref(self, pref_name, default=None):
+		if self._map[0][SUPERSEDED_OFFSET] != "\0":
+			self._remap()
+		snapshot = self._map
+		val = self._lookup(snapshot, pref_name)
+		if val is _MISSING:
+			path = _normalize(pref_name)
+			if path != pref_name:
+				val = self._lookup(snapshot, path)
+		if val is not _MISSING:
+			return val
+		return _missing_pref(pref_name, default, self.no_missing_keys)
+
+def main(argv):
+	if len(argv) < 3:
+		print >>sys.stderr, "usage: %s <snapshot> <pref file> [<pref file> ...]" % argv[0]
+		return 2
+	version = write_snapshot(argv[1], argv[2:])
+	print "wrote %s version %d" % (argv[1], version)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge.cronguard import CronGuard, ProcessStillRunning, LockTimeout, RunHistory, SKIPPED, partition
+
+class CronGuardTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.guards = []
+
+	def tearDown(self):
+		for guard in self.guards:
+			guard.finish()
+			guard.release()
+		shutil.rmtree(self.dir)
+
+	def guard(self, **kwargs):
+		kwargs.setdefault("use_flock", True)
+		guard = CronGuard(self.dir, "job.pid", **kwargs)
+		self.guards.append(guard)
+		return guard
+
+	def read_pidfile(self):
+		return open(os.path.join(self.dir, "job.pid")).read()
+
+	def testFlock(self):
+		first = self.guard()
+		self.assertEqual(self.read_pidfile(), str(os.getpid()))
+		self.assertRaises(ProcessStillRunning, self.guard)
+		start = time.time()
+		self.assertRaises(LockTimeout, self.guard, wait=True, timeout=0.2)
+		assert time.time() - start >= 0.2
+
+		first.release()
+		# the pidfile stays, but empty, and the next run can have it
+		self.assertEqual(self.read_pidfile(), "")
+		self.guard()
+		self.assertEqual(self.read_pidfile(), str(os.getpid()))
+
+	def testLockDiesWithProcess(self):
+		r, w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			try:
+				os.close(r)
+				CronGuard(self.dir, "job.pid", use_flock=True)
+				os.write(w, "x")
+				time.sleep(0.3)
+			finally:
+				os._exit(0)
+		os.close(w)
+		os.read(r, 1)
+		os.close(r)
+		self.assertEqual(self.read_pidfile(), str(pid))
+		# waiting gets in once the other process is gone, without cleaning up after it
+		self.guard(wait=True, timeout=5)
+		os.waitpid(pid, 0)
+		self.assertEqual(self.read_pidfile(), str(os.getpid()))
+
+	def testLockNotInherited(self):
+		first = self.guard()
+		child = subprocess.Popen(["sleep", "5"])
+		try:
+			first.release()
+			# the child doesn't keep the lock for us
+			self.guard()
+		finally:
+			child.kill()
+			child.wait()
+
+	def testSlots(self):
+		guards = [self.guard(slots=3) for i in range(3)]
+		self.assertEqual(sorted([g.slot for g in guards]), [0, 1, 2])
+		self.assertRaises(ProcessStillRunning, self.guard, slots=3)
+		self.assertRaises(LockTimeout, self.guard, slots=3, wait=True, timeout=0.1)
+
+		# a finished slot is handed to the next worker
+		guards[1].release()
+		self.assertEqual(self.guard(slots=3, wait=True, timeout=5).slot, 1)
+
+		shards = ["shard%d" % i for i in range(10)]
+		parts = [g.partition(shards) for g in guards]
+		self.assertEqual(sorted(sum(parts, [])), sorted(shards))
+		self.assertEqual(guards[0].partition(shards), partition(shards, guards[0].slot, 3))
+		self.assertRaises(ValueError, partition, shards, 3, 3)
+
+	def testHistory(self):
+		# only kept when asked for
+		self.guard().release()
+		assert not os.path.exists(os.path.join(self.dir, "job.history"))
+
+		first = self.guard(history=True)
+		self.assertRaises(ProcessStillRunning, self.guard, history=True)
+		first.finish(3)
+		first.finish(0)
+		first.release()
+
+		# runs are recorded with the status the job ends with
+		script = "import sys; sys.path = ['..'] + sys.path; from lounge.cronguard import CronGuard; exit = sys.exit; cg = CronGuard(%r, 'job.pid', history=True); %s"
+		bodies = [
+			# the guard leaves the interpreter's hooks alone
+			"cg.run(lambda: sys.exit is exit and sys.excepthook is sys.__excepthook__ or exit(9))",
+			"cg.run(int, 'boom')",
+			"cg.run(sys.exit, 3)",
+			"cg.exit(4)",
+			"cg.run(sys.exit, 'bye')",
+			"cg.status = 5",
+		]
+		for body in bodies:
+			status = subprocess.call([sys.executable, "-c", script % (self.dir, body)], stderr=open(os.devnull, "w"))
+			self.assertEqual(status, [0, 1, 3, 4, 1, 0][bodies.index(body)])
+
+		runs = RunHistory(os.path.join(self.dir, "job.history")).runs()
+		self.assertEqual([run.status for run in runs], [SKIPPED, 3, 0, 1, 3, 4, 1, 5])
+		assert runs[1].duration() >= 0 and runs[1].maxrss > 0
+
+	def testHistorySummary(self):
+		history = RunHistory(os.path.join(self.dir, "job.history"), max_runs=10)
+		for i in range(25):
+			history.append(1000 * i, 1000 * i + i, i == 24 and 1 or 0)
+		history.append(30000, 30000, SKIPPED)
+		runs = history.runs()
+		# the file is cut back to the newest runs once it doubles
+		assert 10 <= len(runs) < 20
+		self.assertEqual(runs[-1].status, SKIPPED)
+
+		summary = history.summary(interval=20)
+		self.assertEqual(summary["skipped"], 1)
+		self.assertEqual(summary["failed"], 1)
+		self.assertEqual(summary["max"], 24)
+		self.assertEqual(summary["over_interval"], 4)
+		assert summary["trend"] > 1
+
+if __name__ == "__main__":
+	main()
+
+# vi: noexpandtab ts=2 sw=2
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import gzip
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import ShardMap
+from lounge import client
+from lounge.client import *
+from lounge.client.export import export, ExportFailed
+from lounge.fakelounge import FakeLounge
+
+def read_docs(path):
+	f = gzip.open(path)
+	try:
+		return [json.loads(line) for line in f]
+	finally:
+		f.close()
+
+class ExportTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.out = os.path.join(self.dir, "out")
+		self.fake = FakeLounge(shards=4, seed=1).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		config = os.path.join(self.dir, "shards.conf")
+		self.fake.write_shard_config(config)
+		self.shard_map = ShardMap(config)
+		Database.create("things")
+		docs = [{"_id": "doc%03d" % i, "n": i} for i in range(200)]
+		Resource()._request('POST', self.fake.url + "things/_bulk_docs", body={"docs": docs})
+		DesignDoc.create("things", "things", language="python", views={})
+
+	def tearDown(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+		shutil.rmtree(self.dir)
+
+	def ids(self, paths):
+		docs = []
+		for path in paths:
+			docs.extend(read_docs(path))
+		return sorted([doc["_id"] for doc in docs])
+
+	def testShards(self):
+		shards = export("things", self.out, self.shard_map, workers=2, page_size=7)
+		self.assertEqual(len(shards), 4)
+		self.assertEqual(sum([shard.docs for shard in shards]), 201)
+		assert all([shard.done and shard.docs_per_second() > 0 for shard in shards])
+		ids = self.ids([shard.path for shard in shards])
+		self.assertEqual(ids, sorted(["doc%03d" % i for i in range(200)] + ["_design/things"]))
+
+		# a finished export has nothing left to do
+		self.fake.reset_stats()
+		export("things", self.out, self.shard_map)
+		self.assertEqual(self.fake.stats['requests'], 0)
+
+	def testResume(self):
+		self.fake.error_rate = 0.2
+		logging.disable(logging.ERROR)
+		try:
+			self.assertRaises(ExportFailed, export, "things", self.out, self.shard_map, page_size=5, retries=0)
+		finally:
+			logging.disable(logging.NOTSET)
+		self.fake.error_rate = 0
+		shards = export("things", self.out, self.shard_map, page_size=5, merge=True)
+		merged = os.path.join(self.out, "things.jsonl.gz")
+		self.assertEqual(os.listdir(self.out), ["things.jsonl.gz"])
+		# every document exactly once
+		self.assertEqual(len(self.ids([merged])), 201)
+		self.assertEqual(len(set(self.ids([merged]))), 201)
+
+	def testThroughLounge(self):
+		shards = export("things", self.out, compress=False, page_size=50)
+		self.assertEqual(len(shards), 1)
+		lines = open(shards[0].path).readlines()
+		self.assertEqual(len(lines), 201)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import sys
+import tempfile
+import urllib2
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+try:
+	import simplejson as json
+except ImportError:
+	import json
+
+from lounge import ShardMap
+from lounge import client
+from lounge.client import *
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+class FakeLoungeTestCase(TestCase):
+	def setUp(self):
+		self.fake = FakeLounge(shards=4).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		Database.create("things")
+
+	def tearDown(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+
+	def post(self, path, payload):
+		request = urllib2.Request(self.fake.url + path, json.dumps(payload), {'Content-Type': 'application/json'})
+		return json.loads(urllib2.urlopen(request).read())
+
+	def testShardedChanges(self):
+		for key in ["a", "b", "c", "d", "e"]:
+			Thing.create(key)
+		changes = Changes.find("things")
+		self.assertEqual(sorted([row["id"] for row in changes.results]), ["a", "b", "c", "d", "e"])
+		self.assertEqual(len(changes.last_seq), 4)
+		self.assertEqual(sum(changes.last_seq), 5)
+
+		Thing.find("c").destroy()
+		changes = Changes.find("things", since=changes.last_seq)
+		self.assertEqual([(row["id"], row["deleted"]) for row in changes.results], [("c", True)])
+
+	def testShards(self):
+		path = os.path.join(tempfile.mkdtemp(), "shards.conf")
+		try:
+			self.fake.write_shard_config(path)
+			shard_map = ShardMap(path)
+		finally:
+			shutil.rmtree(os.path.dirname(path))
+		keys = ["key%d" % i for i in range(20)]
+		for key in keys:
+			Thing.create(key)
+		found = []
+		for i, url in enumerate(shard_map.primary_shards("things")):
+			rows = json.loads(urllib2.urlopen(url + "/_all_docs").read())["rows"]
+			for row in rows:
+				self.assertEqual(shard_map.get_shard_index(row["id"]), i)
+			found.extend([row["id"] for row in rows])
+		self.assertEqual(sorted(found), sorted(keys))
+
+	def testBulkDocsAndViews(self):
+		results = self.post("things/_bulk_docs", {"docs": [
+			{"_id": "a", "kind": "x", "n": 1}, {"_id": "b", "kind": "y", "n": 2}, {"_id": "c", "kind": "x", "n": 3}]})
+		self.assertEqual([r["id"] for r in results], ["a", "b", "c"])
+		results = self.post("things/_bulk_docs", {"docs": [{"_id": "a"}, {"_id": "d"}]})
+		self.assertEqual(results[0]["error"], "conflict")
+		assert "rev" in results[1]
+
+		DesignDoc.create("things", "d", language="python", views={"by_kind": {
+			"map": "def fun(doc):\n\tif 'kind' in doc:\n\t\temit([doc['kind'], doc['n']], doc['n'])",
+			"reduce": "_sum"}})
+		view = View.execute("things", "d/by_kind", args={"reduce": False, "startkey": ["x"], "endkey": ["x", {}]})
+		self.assertEqual(view.rows.ids(), ["a", "c"])
+		view = View.execute("things", "d/by_kind", args={"reduce": False, "descending": True,
+			"startkey": ["x", {}], "endkey": ["x"], "limit": 1, "include_docs": True})
+		self.assertEqual(view.rows.docs()[0]["_id"], "c")
+		view = View.execute("things", "d/by_kind", args={"group_level": 1})
+		self.assertEqual(list(view.rows), [(["x"], 4), (["y"], 2)])
+
+	def testErrorInjection(self):
+		self.fake.error_rate = 1.0
+		self.fake.error_code = 504
+		self.assertRaises(ProxyTimedOut, Thing.find, "a")
+		self.assertEqual(self.fake.stats["injected_errors"], 1)
+		self.fake.error_rate = 0.0
+		self.assertRaises(NotFound, Thing.find, "a")
+
+if __name__ == "__main__":
+	main()
+
+# vi: noexpandtab ts=2 sw=2
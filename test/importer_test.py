@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+import gzip
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import ShardMap
+from lounge import client
+from lounge.client import *
+from lounge.client.importer import Importer, ImportFailed, BatchSizer
+from lounge.client.export import export
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+def write_docs(path, docs, compress=False):
+	if compress:
+		f = gzip.open(path, "wb")
+	else:
+		f = open(path, "w")
+	try:
+		for doc in docs:
+			f.write(json.dumps(doc) + "\n")
+	finally:
+		f.close()
+
+class LosesResponse(Importer):
+	"""Saves the second batch, but then times out as if the response was lost."""
+	calls = 0
+	def _post(self, resource, url, path, body):
+		self.calls += 1
+		if self.calls == 2:
+			resource._request('POST', url + path, body=body)
+			if not self.retries:
+				raise client.RequestTimedOut(408, url)
+			self._count(retries=1)
+			return Importer._post(self, resource, url, path, body)[0], True
+		return Importer._post(self, resource, url, path, body)
+
+class ImporterTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fake = FakeLounge(shards=4, seed=3).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		config = os.path.join(self.dir, "shards.conf")
+		self.fake.write_shard_config(config)
+		self.shard_map = ShardMap(config)
+		Database.create("things")
+		self.path = os.path.join(self.dir, "things.jsonl.gz")
+		write_docs(self.path, [{"_id": "doc%03d" % i, "_rev": "1-abc", "n": i} for i in range(200)], compress=True)
+
+	def tearDown(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+		shutil.rmtree(self.dir)
+
+	def count(self):
+		return len(Resource()._request('GET', self.fake.url + "things/_all_docs")['rows'])
+
+	def testImport(self):
+		importer = Importer("things", workers=3, batch_size=16, min_batch=4)
+		stats = importer.run(self.path)
+		self.assertEqual(stats['docs'], 200)
+		self.assertEqual(stats['saved'], 200)
+		self.assertEqual(stats['errors'], 0)
+		self.assertEqual(self.count(), 200)
+		self.assertEqual(Thing.find("doc123").n, 123)
+		# finished, so there's nothing to resume
+		assert not os.path.exists(self.path + ".checkpoint")
+
+	def testShards(self):
+		path = os.path.join(self.dir, "new.jsonl")
+		write_docs(path, [{"_id": "doc%03d" % i} for i in range(100)] + [{"anonymous": True}] * 10 +
+			[{"_id": "_design/things", "views": {}}])
+		stats = Importer("things", batch_size=200, shard_map=self.shard_map).run(path)
+		self.assertEqual(stats['docs'], 111)
+		# the design doc is saved on each shard
+		self.assertEqual(stats['saved'], 114)
+		# one batch per shard
+		self.assertEqual(stats['batches'], 4)
+		for url in self.shard_map.primary_shards("things"):
+			rows = Resource()._request('GET', url + "/_all_docs")['rows']
+			assert "_design/things" in [row['id'] for row in rows]
+		self.assertEqual(self.count(), 110 + 4)
+
+		# batches that fill slowly are sent before they're full
+		stats = Importer("things", batch_size=200, shard_map=self.shard_map, max_lag=20).run(path)
+		# (the anonymous docs get new _ids this time)
+		self.assertEqual((stats['saved'], stats['skipped']), (10, 104))
+		assert stats['batches'] >= 111 / 20 * 4, stats['batches']
+
+	def testSkip(self):
+		Thing.create("doc007", n="old")
+		stats = Importer("things").run(self.path)
+		self.assertEqual((stats['saved'], stats['skipped']), (199, 1))
+		self.assertEqual(Thing.find("doc007").n, "old")
+
+	def testOverwrite(self):
+		Thing.create("doc007", n="old", extra=True)
+		stats = Importer("things", conflicts='overwrite').run(self.path)
+		self.assertEqual((stats['saved'], stats['overwritten']), (199, 1))
+		doc = Thing.find("doc007")
+		self.assertEqual(doc.n, 7)
+		assert not hasattr(doc, 'extra')
+
+	def testMerge(self):
+		Thing.create("doc007", n="old", extra=True)
+		stats = Importer("things", conflicts='merge').run(self.path)
+		self.assertEqual((stats['saved'], stats['merged']), (199, 1))
+		doc = Thing.find("doc007")
+		self.assertEqual((doc.n, doc.extra), (7, True))
+
+		def keep_old(existing, imported):
+			return existing
+		Importer("things", conflicts='merge', merge=keep_old).run(self.path)
+		self.assertEqual(Thing.find("doc007").n, 7)
+
+	def testResume(self):
+		self.fake.error_rate = 0.1
+		logging.disable(logging.ERROR)
+		try:
+			self.assertRaises(ImportFailed, Importer("things", workers=1, batch_size=10, retries=0).run, self.path)
+		finally:
+			logging.disable(logging.NOTSET)
+		line = json.load(open(self.path + ".checkpoint"))['line']
+		assert 0 < line < 200
+		self.fake.error_rate = 0
+		stats = Importer("things", batch_size=10).run(self.path)
+		# only the lines after the checkpoint are read again
+		self.assertEqual(stats['docs'], 200 - line)
+		self.assertEqual(self.count(), 200)
+
+	def testResumeWithoutIds(self):
+		path = os.path.join(self.dir, "anonymous.jsonl")
+		write_docs(path, [{"n": i} for i in range(100)])
+		logging.disable(logging.ERROR)
+		try:
+			self.assertRaises(ImportFailed, LosesResponse("things", batch_size=10, workers=1, retries=0).run, path)
+		finally:
+			logging.disable(logging.NOTSET)
+		self.assertEqual(self.count(), 20)
+		stats = Importer("things", batch_size=10).run(path)
+		# the lines saved after the checkpoint got the same _ids again, not new ones
+		self.assertEqual(self.count(), 100)
+		self.assertEqual((stats['saved'], stats['skipped']), (90, 0))
+
+	def testRetryAfterSaving(self):
+		stats = LosesResponse("things", batch_size=50, workers=1, backoff=0).run(self.path)
+		self.assertEqual((stats['saved'], stats['skipped'], stats['retries']), (200, 0, 1))
+
+	def testUnexpectedResult(self):
+		class Confused(Importer):
+			def _post(self, resource, url, path, body):
+				result, retried = Importer._post(self, resource, url, path, body)
+				return result + [{'id': 'stranger', 'rev': '1-abc'}, {'id': 'other', 'error': 'conflict'}], retried
+		Thing.create("doc007", n="old")
+		importer = Confused("things", batch_size=50, conflicts='overwrite')
+		stats = importer.run(self.path)
+		self.assertEqual((stats['saved'], stats['overwritten']), (199, 1))
+		# one pair for each of the four batches, and one for the overwrite
+		self.assertEqual(stats['errors'], 10)
+		self.assertEqual(sorted(set([error['id'] for error in importer.errors])), ['other', 'stranger'])
+
+	def testRoundTrip(self):
+		Resource()._request('POST', self.fake.url + "things/_bulk_docs",
+			body={"docs": [{"_id": "doc%03d" % i, "n": i * 2} for i in range(200)]})
+		shards = export("things", os.path.join(self.dir, "out"), self.shard_map, merge=True)
+		Database.create("copy")
+		stats = Importer("copy").run(os.path.join(self.dir, "out", "things.jsonl.gz"))
+		self.assertEqual(stats['saved'], 200)
+		rows = Resource()._request('GET', self.fake.url + "copy/_all_docs", args={'include_docs': 'true'})['rows']
+		self.assertEqual(sorted([row['doc']['n'] for row in rows]), [i * 2 for i in range(200)])
+
+	def testBatchSizer(self):
+		sizer = BatchSizer(100, minimum=10, maximum=200, target=1.0)
+		sizer.record(100, 0.1)
+		self.assertEqual(sizer.size(), 150)
+		sizer.record(150, 0.1)
+		self.assertEqual(sizer.size(), 200)
+		sizer.record(200, 2.0)
+		self.assertEqual(sizer.size(), 100)
+		for i in range(10):
+			sizer.record(100, 0, ok=False)
+		self.assertEqual(sizer.size(), 10)
+
+if __name__ == "__main__":
+	main()
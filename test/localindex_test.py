@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import client
+from lounge.client import *
+from lounge.client.localindex import LocalIndex, encode_key
+from lounge.fakelounge import FakeLounge
+
+class User(Document):
+	db_name = "users"
+
+def by_age(doc):
+	if 'age' in doc:
+		yield [doc['age'], doc['name']], doc['name']
+
+def wait_for(predicate, timeout=5):
+	"""Poll predicate until it's true or timeout seconds pass."""
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if predicate():
+			return True
+		time.sleep(0.05)
+	return predicate()
+
+class LocalIndexTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, "index.db")
+		self.fake = FakeLounge(shards=4).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		Database.create("users")
+		for i, (name, age) in enumerate([("ann", 30), ("bob", 25), ("cat", 35), ("dan", 25)]):
+			User.create("u%d" % i, name=name, age=age)
+		User.create("nobody", name="x")
+
+	def tearDown(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+		shutil.rmtree(self.dir)
+
+	def names(self, rows):
+		return [row["value"] for row in rows]
+
+	def testKeyOrder(self):
+		keys = [None, False, True, -10.5, -1, 0, 1, 2.5, 100, "", "a", "a\0", "ab", "b", u"\xe9",
+			[], [None], [1], [1, "a"], [1, "b"], [2], ["a"], {}, {"a": 1}]
+		shuffled = list(keys)
+		random.shuffle(shuffled)
+		self.assertEqual(sorted(shuffled, key=encode_key), keys)
+		self.assertRaises(TypeError, encode_key, object())
+
+		# ints beyond 2**53 stay distinct and in order, among floats too
+		big = 2 ** 60
+		keys = [-big - 1, float(-big), -big + 1, 2.0 ** 53, 2 ** 53 + 1, big - 1, float(big), big + 1,
+			10 ** 300 + 1, 2.0 ** 1000, [big - 1, "b"], [big, "a"], [big + 1]]
+		shuffled = list(keys)
+		random.shuffle(shuffled)
+		self.assertEqual(sorted(shuffled, key=encode_key), keys)
+		self.assertEqual(encode_key(big), encode_key(float(big)))
+		self.assertRaises(ValueError, encode_key, 10 ** 400)
+
+	def testBuildAndQuery(self):
+		index = LocalIndex(self.path, User, by_age, page_size=2)
+		self.assertEqual(index.since(), None)
+		self.assertEqual(index.update(), 0)
+		self.assertEqual(len(index), 4)
+		self.fake.reset_stats()
+		self.assertEqual(self.names(index.query()), ["bob", "dan", "ann", "cat"])
+		self.assertEqual(self.names(index.query(startkey=[25], endkey=[30, {}])), ["bob", "dan", "ann"])
+		self.assertEqual(self.names(index.query(key=[35, "cat"])), ["cat"])
+		self.assertEqual(self.names(index.query(startkey=[30], descending=True, limit=2)), ["dan", "bob"])
+		self.assertEqual(self.names(index.query(startkey=[35, {}], endkey=[25, "dan"], descending=True, inclusive_end=False)), ["cat", "ann"])
+		row = index.query(limit=1)[0]
+		self.assertEqual((row["id"], row["key"]), ("u1", [25, "bob"]))
+		# no network
+		self.assertEqual(self.fake.stats['requests'], 0)
+
+	def testIncremental(self):
+		index = LocalIndex(self.path, User, by_age)
+		index.update()
+		bob = User.find("u1")
+		bob.age = 40
+		bob.save()
+		User.find("u0").destroy()
+		User.create("u9", name="eve", age=20)
+		self.assertEqual(index.update(), 3)
+		self.assertEqual(self.names(index.query()), ["eve", "dan", "cat", "bob"])
+		self.assertEqual(index.update(), 0)
+
+		# the checkpoint survives reopening; a new version starts over
+		reopened = LocalIndex(self.path, User, by_age)
+		self.assertEqual(reopened.since(), index.since())
+		self.assertEqual(len(reopened), 4)
+		rebuilt = LocalIndex(self.path, User, lambda doc: [(doc.get('name'), None)], version=2)
+		self.assertEqual(rebuilt.since(), None)
+		rebuilt.update()
+		self.assertEqual([row["key"] for row in rebuilt.query()], ["bob", "cat", "dan", "eve", "x"])
+
+	def testFollow(self):
+		index = LocalIndex(self.path, User, by_age)
+		index.follow(timeout=1)
+		try:
+			assert wait_for(lambda: len(index) == 4)
+			User.create("u9", name="eve", age=20)
+			assert wait_for(lambda: len(index) == 5)
+			self.assertEqual(index.query(limit=1)[0]["value"], "eve")
+		finally:
+			index.stop()
+
+if __name__ == "__main__":
+	main()
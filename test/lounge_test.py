@@ -16,6 +16,7 @@ from test_helpers import *
 
 from lounge import client
 from lounge.client.validations import *
+from lounge.client.schema import *
 
 def get_data_and_headers(url):
 	req = urllib2.urlopen(url)
@@ -28,7 +29,8 @@ class LoungeTestCase(TestCase):
 		create_test_db("pytest")
 
 	def tearDown(self):
-		time.sleep(0.5)
+		if fake_lounge is None:
+			time.sleep(0.5)
 		Database.find("pytest").destroy()
 
 	def testTimeout(self):
@@ -39,8 +41,15 @@ class LoungeTestCase(TestCase):
 		exceptions. """
 		old_dbtimeout = client.db_timeout
 		client.db_timeout = 0.000000000000000001
-		self.assertRaises(client.RequestTimedOut, TestDoc.create, 'hellothere')
-		client.db_timeout = old_dbtimeout
+		if fake_lounge is not None:
+			# a local server can answer before even a tiny timeout is noticed
+			fake_lounge.latency = 0.1
+		try:
+			self.assertRaises(client.RequestTimedOut, TestDoc.create, 'hellothere')
+		finally:
+			client.db_timeout = old_dbtimeout
+			if fake_lounge is not None:
+				fake_lounge.latency = 0
 
 	def testConnectionRefused(self):
 		""" Test that we properly throw an error when the connection is refused. """
@@ -89,6 +98,26 @@ class LoungeTestCase(TestCase):
 		self.assertEqual(view.rows[0][0], 'a')
 		self.assertEqual(view.rows[1][0], 'd')
 
+		# column access doesn't build row objects
+		self.assertEqual(view.rows.keys(), ['a', 'd'])
+		self.assertEqual(view.rows.ids(), ['a', 'd'])
+		self.assertEqual([doc['y'] for doc in view.rows.docs()], [1, 16])
+		key, value = view.rows[0]
+		self.assertEqual(key, 'a')
+		self.assertEqual(view.rows[0]['doc']['x'], 1)
+
+		# and it's still a list
+		rows = view.rows
+		assert isinstance(rows, list)
+		rows.sort(key=lambda row: row['doc']['y'], reverse=True)
+		self.assertEqual(rows.keys(), ['d', 'a'])
+		rows.append(('z', None))
+		self.assertEqual(rows[2], ('z', None))
+		self.assertEqual(rows.pop(0)[0], 'd')
+		rows[1:] = []
+		self.assertEqual([row[0] for row in rows], ['a'])
+		self.assertEqual(rows.index(rows[0]), 0)
+
 	def testBasics(self):
 		"""Test some basic read/write operations."""
 		a = TestDoc.create("a", x=1, y=1)
@@ -128,6 +157,28 @@ class LoungeTestCase(TestCase):
 		for i,key in enumerate(shard_keys):
 			TestDoc.find(key).destroy()
 	
+	def testLazyAndFields(self):
+		"""Find records lazily or with only some fields."""
+		TestDoc.create("a", x=1, y=2, z={"big": range(1000), "tricky": ["]}", {"[": "\\\"{"}]}, lazy="yes")
+
+		a = TestDoc.find("a", lazy=True)
+		assert "_rec" not in a.__dict__
+		assert a.x == 1
+		assert a.lazy == "yes"
+		a.w = 4
+		a.save()
+		assert TestDoc.find("a").w == 4
+
+		b = TestDoc.find("a", fields=["x", "w", "lazy", "missing"])
+		self.assertEqual(sorted(b.keys()), ["_id", "_rev", "lazy", "w", "x"])
+		assert b.w == 4
+		assert_raises(PartialDocument, b.save)
+
+		# reloading gets the whole thing back
+		b.reload()
+		assert b.z["big"][999] == 999
+		b.save()
+
 	def testMultiKey(self):
 		# test PUT
 		a = MultiKey.create("one", "two", x=2, y=3)
@@ -201,6 +252,29 @@ class LoungeTestCase(TestCase):
 		# clean up
 		TestDoc.find("a1").destroy()
 	
+	def testSaveWithMerge(self):
+		"""Resolve a conflicting save by reapplying the change."""
+		TestDoc.create("a1", x=1, friends=[])
+		a1, a2 = TestDoc.find("a1"), TestDoc.find("a1")
+		a1.y = 3
+		a1.save()
+
+		def add_friend(doc):
+			doc.friends.append("bob")
+		conflicts = client.merge_stats['conflicts']
+		self.assertEqual(a2.save_with_merge(add_friend), 2)
+		self.assertEqual(client.merge_stats['conflicts'], conflicts + 1)
+
+		a = TestDoc.find("a1")
+		assert a.y == 3
+		assert a.friends == ["bob"]
+
+		# give up after max_attempts
+		a1 = TestDoc.find("a1")
+		a1.x = 2
+		a1.save()
+		assert_raises(RevisionConflict, a.save_with_merge, add_friend, max_attempts=1)
+
 	def dontTestTempView(self):
 		"""Run a temporary view.
 
@@ -647,6 +721,73 @@ class LoungeTestCase(TestCase):
 		a.z = ['abc', 'abcc']
 		assert a.validate()
 	
+	def testSchemaValidation(self):
+		class CoolDoc(Document):
+			db_name = "pytest"
+			_schema = {
+				'name': Field(basestring, required=True, min_length=2, max_length=5),
+				'age': Field(int, min=0, max=150),
+				'tags': ListOf(Field(basestring, matches=r'^[abc]+$'), max_length=3),
+				'address': Object({'zip': Field(basestring, required=True)}),
+			}
+
+			# hand-written validations run alongside the schema
+			validate_x = exists("x")
+
+		a = CoolDoc.new('one', x=1)
+		assert not a.validate()
+		assert a.errors_for('name')==['name must exist']
+
+		a.name = 'kevin'
+		assert a.validate()
+		assert not a._errors
+
+		a.age = 200
+		a.tags = ['abc', 'abcd']
+		a.address = {}
+		del a['x']
+		assert not a.validate()
+		assert a.errors_for('age')==['value of age must be <= 150']
+		assert a.errors_for('tags')==['tags[1] is not in the required format']
+		assert a.errors_for('address.zip')==['address.zip must exist']
+		assert a.errors_for('x')==['x must exist']
+
+		a.age = 25
+		a.tags = ['abc', 'ab']
+		a.address = {'zip': '02139'}
+		a.x = 1
+		assert a.validate()
+		assert "_errors" not in a._rec
+
+		# a record field named schema isn't hidden by the class's
+		a.schema = 'v2'
+		assert a.schema == 'v2'
+
+		# validators added later are picked up
+		CoolDoc.validate_y = exists("y")
+		assert not a.validate()
+		assert a.errors_for('y')==['y must exist']
+
+		# changing other classes doesn't recompile this one's schema
+		compiled = CoolDoc._get_validators()[0]
+		DesignDoc.new("pytest", "cool")
+		TestDoc.anything = True
+		del TestDoc.anything
+		assert CoolDoc._get_validators()[0] is compiled
+
+		# but replacing its schema does
+		CoolDoc._schema = {'name': Field(basestring, max_length=3)}
+		assert not a.validate()
+		assert a.errors_for('name')==['length of name must be <= 3']
+
+		# float bounds aren't truncated
+		CoolDoc._schema = {'ratio': Field(float, min=0.5, max=1.5)}
+		a.name, a.y, a.ratio = 'kev', 1, 1.2
+		assert a.validate()
+		a.ratio = 0.2
+		assert not a.validate()
+		assert a.errors_for('ratio')==['value of ratio must be >= 0.5']
+
 	def testChanges(self):
 		a = TestDoc.create("a", x=1, y=1)
 		b = TestDoc.create("b", x=2, y=4)
@@ -703,6 +844,32 @@ class LoungeTestCase(TestCase):
 		self.assertRaises(Exception, a.set_path, 'two.integer.something', 'something')
 		a.set_path('two.nonexistant.something','something')
 
+		# list indices
+		a['three'] = {'list': [{'x': 1}, {'x': 2}]}
+		assert(a.get_path('three.list[1].x') == 2)
+		assert(a.get_path('three.list[-1].x') == 2)
+		assert(a.get_path('three.list[2].x') == None)
+		assert(a.get_path('three[0]') == None)
+		a.set_path('three.list[0].x', 5)
+		a.set_path('three.list[2].x', 6)
+		a.set_path('three.new[0]', 7)
+		assert(a['three']['list'] == [{'x': 5}, {'x': 2}, {'x': 6}])
+		assert(a['three']['new'] == [7])
+		self.assertRaises(IndexError, a.set_path, 'three.list[9].x', 'something')
+		self.assertRaises(TypeError, a.set_path, 'one.two[0]', 'something')
+		self.assertRaises(TypeError, a.set_path, 'three.list.x', 'something')
+
+		# keys with brackets that aren't indices are just keys
+		a.set_path('four.a[b', 1)
+		a.set_path('four.x[]', 2)
+		assert(a['four'] == {'a[b': 1, 'x[]': 2})
+		assert(a.get_path('four.a[b') == 1)
+
+		# many selectors at once
+		assert(a.get_paths(['one.two.three', 'three.list[1].x', 'missing']) == ['four', 2, None])
+		records = [{'a': {'b': 1, 'c': [2]}}, {'a': {'b': 3}}, None]
+		assert(project(records, ['a.b', 'a.c[0]']) == [[1, 2], [3, None], [None, None]])
+
 if __name__=="__main__":
 	# log all REST calls if the DEBUG env var is set
 	if os.environ.get("DEBUG",False):
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge.filewatch import FileWatcher
+from lounge.prefs import Prefs, InvalidPrefEntry
+from lounge.prefsnapshot import PrefsSnapshot, write_snapshot
+
+def wait_for(predicate, timeout=5):
+	"""Poll predicate until it's true or timeout seconds pass."""
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if predicate():
+			return True
+		time.sleep(0.05)
+	return predicate()
+
+BASE = """<?xml version="1.0"?>
+<pref name="/">
+	<pref name="service">
+		<pref name="port" type="int" value="8080"/>
+		<pref name="debug" type="bool" value="0"/>
+		<pref name="name" type="string" value="base"/>
+		<pref name="hosts" type="stringlist">
+			<item value="a"/>
+			<item value="b"/>
+		</pref>
+	</pref>
+	<pref name="broken" type="bool" value="maybe"/>
+	<pref name="only_base" type="string" value="here"/>
+</pref>
+"""
+
+OVERRIDE = """<?xml version="1.0"?>
+<pref name="/">
+	<pref name="service">
+		<pref name="port" type="int" value="9090"/>
+		<pref name="debug" type="bool" value="1"/>
+	</pref>
+</pref>
+"""
+
+class PrefsTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.base = self.write("base.xml", BASE)
+		self.override = self.write("override.xml", OVERRIDE)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def write(self, name, contents):
+		path = os.path.join(self.dir, name)
+		f = open(path, "w")
+		f.write(contents)
+		f.close()
+		return path
+
+	def testTypes(self):
+		prefs = Prefs(self.base)
+		self.assertEqual(prefs.get_pref("/service/port"), 8080)
+		self.assertEqual(prefs.get_pref("/service/debug"), False)
+		self.assertEqual(prefs.get_pref("/service/name"), "base")
+		self.assertEqual(prefs.get_pref("/service/hosts"), ["a", "b"])
+		self.assertRaises(InvalidPrefEntry, prefs.get_pref, "/broken")
+
+	def testHierarchy(self):
+		prefs = Prefs(self.base, self.override)
+		self.assertEqual(prefs.get_pref("/service/port"), 9090)
+		self.assertEqual(prefs.get_pref("/service/debug"), True)
+		self.assertEqual(prefs.get_pref("/service/name"), "base")
+		self.assertEqual(prefs.get_pref("/only_base"), "here")
+
+		# old callers can still walk the DOM trees, highest precedence first
+		trees = prefs.pref_trees
+		self.assertEqual(len(trees), 2)
+		port = prefs.find_elem("/", trees[0])
+		for key in ("service", "port"):
+			port = prefs.find_elem(key, port)
+		self.assertEqual(prefs.get_val(port), 9090)
+		self.assertRaises(AttributeError, setattr, prefs, "pref_trees", [])
+
+	def testSubtree(self):
+		prefs = Prefs(self.base, self.override)
+		# '*' returns the children of the first file that has the node
+		self.assertEqual(prefs.get_pref("/service/*"), {"port": 9090, "debug": True})
+		self.assertEqual(Prefs(self.base).get_pref("/service/*"),
+			{"port": 8080, "debug": False, "name": "base", "hosts": ["a", "b"]})
+		self.assertEqual(prefs.get_pref("/service/*/ignored"), prefs.get_pref("/service/*"))
+
+	def testMissing(self):
+		prefs = Prefs(self.base)
+		self.assertEqual(prefs.get_pref("/nope", 5), 5)
+		self.assertEqual(prefs.get_pref("/service/port/deeper"), None)
+		prefs = Prefs(self.base, no_missing_keys=True)
+		self.assertRaises(KeyError, prefs.get_pref, "/nope")
+
+	def testReload(self):
+		prefs = Prefs(self.base, self.override, reload=True, check_interval=-1)
+		self.assertEqual(prefs.get_pref("/service/port"), 9090)
+		self.write("override.xml", OVERRIDE.replace("9090", "91919"))
+		self.assertEqual(prefs.get_pref("/service/port"), 91919)
+
+	def testReloadOnlyOnce(self):
+		prefs = Prefs(self.base, self.override)
+		self.assertEqual(prefs.reload_changed(), False)
+		self.write("override.xml", OVERRIDE.replace("9090", "9191"))
+		os.utime(self.override, (0, 0))
+		self.assertEqual(prefs.reload_changed(), True)
+		self.assertEqual(prefs.get_pref("/service/port"), 9191)
+		# the new stat info was recorded, so it isn't parsed again
+		self.assertEqual(prefs.reload_changed(), False)
+
+	def testWatch(self):
+		prefs = Prefs(self.base, self.override, watch=True, watch_interval=0.1)
+		try:
+			self.assertEqual(prefs.get_pref("/service/port"), 9090)
+			self.write("override.xml", OVERRIDE.replace("9090", "9191"))
+			assert wait_for(lambda: prefs.get_pref("/service/port") == 9191)
+
+			# replacing the file with a rename is noticed too
+			tmp = self.write("override.xml.tmp", OVERRIDE.replace("9090", "9292"))
+			os.rename(tmp, self.override)
+			assert wait_for(lambda: prefs.get_pref("/service/port") == 9292)
+		finally:
+			prefs.stop_watching()
+
+	def testPollingWatcher(self):
+		changes = []
+		watcher = FileWatcher([self.base], changes.append, interval=0.05, use_inotify=False)
+		try:
+			assert not watcher.uses_inotify()
+			self.write("base.xml", BASE.replace("8080", "81818"))
+			assert wait_for(lambda: len(changes) > 0)
+			self.assertEqual(changes[0], [os.path.abspath(self.base)])
+		finally:
+			watcher.stop()
+
+	def testSnapshot(self):
+		path = os.path.join(self.dir, "prefs.snap")
+		prefs = Prefs(self.base, self.override)
+		version = write_snapshot(path, prefs)
+		snapshot = PrefsSnapshot(path, no_missing_keys=True)
+		self.assertEqual(snapshot.version, version)
+		for name in ["/service/port", "/service/debug", "/service/hosts", "/service/*", "/only_base", "x/service/name"]:
+			self.assertEqual(snapshot.get_pref(name), prefs.get_pref(name))
+		self.assertRaises(InvalidPrefEntry, snapshot.get_pref, "/broken")
+		self.assertRaises(KeyError, snapshot.get_pref, "/nope")
+		self.assertEqual(snapshot.get_pref("/nope", 5), 5)
+
+		# a new snapshot is picked up on the next lookup
+		self.write("override.xml", OVERRIDE.replace("9090", "9191"))
+		write_snapshot(path, [self.base, self.override])
+		self.assertEqual(snapshot.get_pref("/service/port"), 9191)
+		assert snapshot.version > version
+
+		# a failed replace leaves the old snapshot, and no files open
+		fds = len(os.listdir("/proc/self/fd"))
+		rename = os.rename
+		def fail(src, dst):
+			raise OSError("no")
+		os.rename = fail
+		try:
+			try:
+				write_snapshot(path, prefs)
+				self.fail("write_snapshot didn't raise")
+			except OSError:
+				# the traceback keeps write_snapshot's locals alive
+				self.assertEqual(len(os.listdir("/proc/self/fd")), fds)
+		finally:
+			os.rename = rename
+		self.assertEqual(sorted(os.listdir(self.dir)), ["base.xml", "override.xml", "prefs.snap"])
+		self.assertEqual(snapshot.get_pref("/service/port"), 9191)
+
+	def testCache(self):
+		cache_dir = os.path.join(self.dir, "cache")
+		os.mkdir(cache_dir)
+		os.utime(self.override, (1000000000, 1000000000))
+		Prefs(self.base, self.override, cache_dir=cache_dir)
+		self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+		# an entry is used while the size, mtime and inode still match
+		self.write("override.xml", OVERRIDE.replace("9090", "9191"))
+		os.utime(self.override, (1000000000, 1000000000))
+		cached = Prefs(self.base, self.override, cache_dir=cache_dir)
+		self.assertEqual(cached.get_pref("/service/port"), 9090)
+		self.assertEqual(cached.get_pref("/service/*"), {"port": 9090, "debug": True})
+		self.assertRaises(InvalidPrefEntry, cached.get_pref, "/broken")
+
+		# a changed file is parsed again, and a bad entry is ignored
+		self.write("override.xml", OVERRIDE.replace("9090", "91919"))
+		for name in os.listdir(cache_dir):
+			self.write(os.path.join("cache", name), "junk")
+		cached = Prefs(self.base, self.override, cache_dir=cache_dir)
+		self.assertEqual(cached.get_pref("/service/port"), 91919)
+		self.assertEqual(cached.get_pref("/service/name"), "base")
+
+	def testGetPrefs(self):
+		prefs = Prefs(self.base, self.override)
+		self.assertEqual(prefs.get_prefs(["/service/port", "/service/name", "/nope"], 1), [9090, "base", 1])
+
+	def testBind(self):
+		prefs = Prefs(self.base, self.override, no_missing_keys=True)
+		conf = prefs.bind({
+			"port": "/service/port",
+			"hosts": ("/service/hosts", tuple, None),
+			"timeout": ("/service/timeout_ms", lambda ms: ms / 1000.0, 5.0),
+		})
+		self.assertEqual((conf.port, conf.hosts, conf.timeout), (9090, ("a", "b"), 5.0))
+		self.assertRaises(KeyError, prefs.bind, {"nope": "/nope"})
+		self.assertRaises(InvalidPrefEntry, prefs.bind, {"broken": "/broken"})
+
+		# bound values follow reloads
+		self.write("override.xml", OVERRIDE.replace("9090", "91919"))
+		self.assertEqual(prefs.reload_changed(), True)
+		self.assertEqual(conf.port, 91919)
+
+		# a reload that breaks a bound pref leaves the old values
+		self.write("override.xml", OVERRIDE.replace('value="9090"', 'value="lots"'))
+		self.assertEqual(prefs.reload_changed(), True)
+		self.assertEqual(conf.port, 91919)
+
+	def testSubscribe(self):
+		prefs = Prefs(self.base, self.override)
+		calls = []
+		port = lambda paths: calls.append(("port", paths))
+		prefs.subscribe("/service/port", port)
+		prefs.subscribe("/service/name", lambda paths: calls.append(("name", paths)))
+		prefs.subscribe("/service/*", lambda paths: calls.append(("service", paths)))
+
+		self.write("override.xml", OVERRIDE.replace('value="1"', 'value="0"'))
+		prefs.reload_changed()
+		self.assertEqual(calls, [("service", ["/service/*", "/service/debug"])])
+
+		del calls[:]
+		self.write("override.xml", OVERRIDE.replace("9090", "91919"))
+		prefs.reload_changed()
+		self.assertEqual(calls, [("port", ["/service/port"]),
+			("service", ["/service/*", "/service/debug", "/service/port"])])
+
+		del calls[:]
+		prefs.unsubscribe("/service/port", port)
+		self.write("override.xml", OVERRIDE.replace('value="9090"', 'value="lots"'))
+		prefs.reload_changed()
+		self.assertEqual(calls, [("service", ["/service/*", "/service/port"])])
+
+	def testOverrides(self):
+		other = self.write("other.xml", OVERRIDE.replace("9090", "7070"))
+		os.environ["LOUNGE_PREF_OVERRIDES"] = "%s:%s" % (self.override, other)
+		try:
+			prefs = Prefs(self.base, self.override)
+		finally:
+			del os.environ["LOUNGE_PREF_OVERRIDES"]
+		self.assertEqual(prefs.get_pref("/service/port"), 7070)
+
+if __name__ == "__main__":
+	main()
+
+# vi: noexpandtab ts=2 sw=2
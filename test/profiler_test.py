@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge.client import *
+from lounge.client import profiler
+
+ROWS = [{"id": "doc%d" % i, "key": ["k", i], "value": {"n": i}} for i in range(1000)]
+PAYLOAD = json.dumps({"rows": ROWS})
+
+def busy(f, seconds=0.2):
+	deadline = time.time() + seconds
+	while time.time() < deadline:
+		f()
+
+def decode():
+	Resource()._decode(PAYLOAD, "application/json")
+
+def wrap():
+	for row in ViewRows(ROWS):
+		row["key"]
+
+def wait_for(predicate, timeout=5):
+	"""Poll predicate until it's true or timeout seconds pass."""
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if predicate():
+			return True
+		time.sleep(0.05)
+	return predicate()
+
+class ProfilerTestCase(TestCase):
+	def tearDown(self):
+		profiler.stop()
+
+	def testPhases(self):
+		self.assertEqual(profiler.stop(), None)
+		profiler.start(interval=0.001)
+		assert profiler.running()
+		busy(decode)
+		busy(wrap)
+		profile = profiler.stop()
+		assert not profiler.running()
+		assert profile.phases["row-wrap"] > 10, profile.report()
+		self.assertEqual(sum(profile.phases.values()), profile.samples)
+		self.assertAlmostEqual(sum(profile.phase_fractions().values()), 1.0)
+		assert "row-wrap" in profile.report()
+
+	def testCpu(self):
+		# the C JSON decoder's time goes to decode, not to the code after it
+		profiler.start(interval=0.001, cpu=True)
+		busy(decode)
+		profile = profiler.stop()
+		self.assertEqual(signal.getsignal(signal.SIGPROF), signal.SIG_DFL)
+		assert profile.samples > 20, profile.report()
+		assert profile.phases["decode"] > profile.samples / 2, profile.report()
+
+	def testCollapsed(self):
+		profiler.start(interval=0.001, cpu=True)
+		busy(decode, 0.1)
+		profile = profiler.stop()
+		lines = profile.collapsed()
+		assert lines
+		self.assertEqual(sum([int(line.rsplit(" ", 1)[1]) for line in lines]), profile.samples)
+		decoding = [line for line in lines if line.startswith("[decode];")]
+		assert decoding
+		assert "__main__:decode;lounge.client:_decode" in decoding[0], decoding[0]
+
+	def testSignal(self):
+		dir = tempfile.mkdtemp()
+		path = os.path.join(dir, "profile.%(pid)d.folded")
+		old = profiler.install_signal_handler(signal.SIGUSR2, path, interval=0.001)
+		try:
+			os.kill(os.getpid(), signal.SIGUSR2)
+			assert profiler.running()
+			busy(wrap, 0.1)
+			os.kill(os.getpid(), signal.SIGUSR2)
+			out = path % {'pid': os.getpid()}
+			assert wait_for(lambda: os.path.exists(out + ".txt"))
+			assert not profiler.running()
+			assert "row-wrap" in open(out + ".txt").read()
+			assert "[row-wrap];" in open(out).read()
+		finally:
+			signal.signal(signal.SIGUSR2, old)
+			shutil.rmtree(dir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import client
+from lounge.client import *
+from lounge.client import replay
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+class ReplayTestCase(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, "workload.lwl")
+		self.fake = FakeLounge(shards=4).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, 'rec_'
+
+	def tearDown(self):
+		replay.stop_recording()
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+		shutil.rmtree(self.dir)
+
+	def record_workload(self, keep_bodies=False):
+		recorder = replay.start_recording(self.path, keep_bodies)
+		Database.create("things")
+		for key in ["a", "b", "c"]:
+			Thing.create(key, n=1)
+		thing = Thing.find("a")
+		thing.n = 2
+		thing.save()
+		self.rev = thing._rev
+		thing.destroy()
+		self.assertRaises(NotFound, Thing.find, "a")
+		Resource()._request('POST', client.db_connectinfo + "rec_things/_bulk_docs", body={"docs": [{"n": 3}]})
+		self.assertEqual(replay.stop_recording(), recorder)
+		self.assertEqual(client.recorder, None)
+		return recorder
+
+	def testRecord(self):
+		recorder = self.record_workload()
+		started, requests = replay.read_workload(self.path)
+		self.assertEqual(len(requests), recorder.count)
+		self.assertEqual([(r.method, r.url, r.status) for r in requests], [
+			("PUT", "/things", 201),
+			("PUT", "/things/a", 201),
+			("PUT", "/things/b", 201),
+			("PUT", "/things/c", 201),
+			("GET", "/things/a", 200),
+			("PUT", "/things/a", 201),
+			("DELETE", "/things/a?rev=" + self.rev, 200),
+			("GET", "/things/a", 404),
+			("POST", "/things/_bulk_docs", 201),
+		])
+		assert requests[1].body_size > 0 and requests[1].body is None
+		assert requests == sorted(requests, key=lambda r: r.offset)
+
+		# a partial record is ignored
+		f = open(self.path, "ab")
+		f.write("\0" * 10)
+		f.close()
+		self.assertEqual(len(replay.read_workload(self.path)[1]), len(requests))
+
+	def testRecorderProblems(self):
+		recorder = replay.start_recording(self.path)
+		Database.create("things")
+		# too long to record, but the request itself still goes through
+		self.assertRaises(LoungeError, Thing.find, "x" * 70000)
+		self.assertEqual((recorder.count, recorder.skipped), (1, 1))
+
+		# a broken recorder doesn't break requests either
+		def broken(*args):
+			raise IOError("disk full")
+		recorder.record = broken
+		logging.disable(logging.ERROR)
+		try:
+			Thing.create("a", n=1)
+		finally:
+			logging.disable(logging.NOTSET)
+		self.assertEqual(Thing.find("a").n, 1)
+
+	def testReplay(self):
+		self.record_workload()
+		started, requests = replay.read_workload(self.path)
+		target = FakeLounge(shards=2).start()
+		try:
+			summary = replay.replay(requests, target.url, prefix="other_", speed=None, concurrency=1)
+			self.assertEqual(summary['requests'], len(requests))
+			self.assertEqual(target.stats['requests'], len(requests))
+			# revisions are tracked, so only the find of the deleted doc fails
+			self.assertEqual(summary['errors'], {"NotFound": 1})
+			assert summary['p50'] <= summary['p99'] <= summary['max']
+		finally:
+			target.stop()
+
+	def testReplayBodies(self):
+		self.record_workload(keep_bodies=True)
+		started, requests = replay.read_workload(self.path)
+		self.assertEqual(requests[1].body, '{"_id": "a", "n": 1}')
+		self.fake.reset_stats()
+		client.db_prefix = ''
+		summary = replay.replay(requests, self.fake.url, speed=100.0, concurrency=2)
+		self.assertEqual(summary['requests'], len(requests))
+		self.assertEqual(self.fake.stats['requests'], len(requests))
+		self.assertEqual(Thing.find("b").n, 1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+import sys
+import threading
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import client
+from lounge.client import *
+from lounge.client.singleflight import SingleFlight
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+def together(f, count=8):
+	"""Call f from count threads at once; return the results (or exceptions) in order."""
+	results = [None] * count
+	start = threading.Event()
+	def run(i):
+		start.wait()
+		try:
+			results[i] = f()
+		except Exception, e:
+			results[i] = e
+	threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+	for thread in threads:
+		thread.start()
+	start.set()
+	for thread in threads:
+		thread.join()
+	return results
+
+class SingleFlightTestCase(TestCase):
+	def setUp(self):
+		self.fake = FakeLounge().start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		Database.create("things")
+		Thing.create("hot", views=0, tags=["a"])
+		self.fake.latency = 0.2
+		self.fake.reset_stats()
+		client.single_flight = SingleFlight()
+
+	def tearDown(self):
+		client.single_flight = None
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+
+	def testFind(self):
+		things = together(lambda: Thing.find("hot"))
+		self.assertEqual(self.fake.stats['requests'], 1)
+		self.assertEqual([thing.views for thing in things], [0] * 8)
+		# everyone has their own copy
+		things[0].tags.append("b")
+		self.assertEqual(things[1].tags, ["a"])
+
+		stats = client.single_flight.stats()
+		self.assertEqual((stats['calls'], stats['shared']), (1, 7))
+		key = self.fake.url + "things/hot"
+		self.assertEqual(stats['keys'].keys(), [key])
+		self.assertEqual(client.single_flight.key_stats(key)['shared'], 7)
+		assert stats['wait'] > 0
+
+		# once it's done, the next find makes its own request
+		Thing.find("hot")
+		self.assertEqual(self.fake.stats['requests'], 2)
+
+	def testErrors(self):
+		errors = together(lambda: Thing.find("cold"))
+		self.assertEqual(self.fake.stats['requests'], 1)
+		for e in errors:
+			assert isinstance(e, NotFound), e
+			self.assertEqual(e.key, "cold")
+
+	def testOnlyReads(self):
+		Thing.find("hot")
+		def save():
+			Thing.new("new%d" % threading.currentThread().ident).save()
+		together(save, 4)
+		self.assertEqual(self.fake.stats['requests'], 5)
+
+	def testOff(self):
+		client.single_flight = None
+		together(lambda: Thing.find("hot"), 4)
+		self.assertEqual(self.fake.stats['requests'], 4)
+
+if __name__ == "__main__":
+	main()
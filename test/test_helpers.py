@@ -1,4 +1,8 @@
+import os
+
+from lounge import client
 from lounge.client import *
+from lounge.fakelounge import FakeLounge
 
 # these keys cover all 128 shards
 shard_keys = ['x152', 'x116', 'x67', 'x23', 'x22', 'x66', 'x117', 'x153', 'x139', 'x151', 'x20', 'x64', 'x65', 'x21', 'x150', 'x138', 'x74', 'x30', 'x141', 'x129', 'x128', 'x140', 'x31', 'x75', 'x33', 'x77', 'x106', 'x142', 'x143', 'x107', 'x76', 'x32', 'x180', 'x79', 'x124', 'x160', 'x161', 'x125', 'x78', 'x181', 'x56', 'x183', 'x163', 'x127', 'x126', 'x162', 'x182', 'x57', 'x137', 'x173', 'x193', 'x46', 'x47', 'x192', 'x172', 'x136', 'x170', 'x134', 'x69', 'x190', 'x191', 'x68', 'x135', 'x171', 'x166', 'x122', 'x53', 'x186', 'x187', 'x52', 'x123', 'x167', 'x121', 'x165', 'x185', 'x50', 'x51', 'x184', 'x164', 'x120', 'x40', 'x195', 'x175', 'x131', 'x130', 'x174', 'x194', 'x41', 'x196', 'x43', 'x132', 'x176', 'x177', 'x133', 'x42', 'x197', 'x25', 'x61', 'x110', 'x178', 'x179', 'x111', 'x60', 'x24', 'x62', 'x26', 'x157', 'x113', 'x112', 'x156', 'x27', 'x63', 'x103', 'x147', 'x36', 'x72', 'x73', 'x37', 'x146', 'x102', 'x168', 'x100', 'x71', 'x188', 'x189', 'x70', 'x101', 'x169']
@@ -17,6 +21,19 @@ class MultiKey(Document):
 	def make_key(cls, first, second):
 		return "%s:%s" % (first, second)
 
+# the map function the view tests use, and what it does
+test_view_map = "(function (doc) {if (doc.x == 1) {emit(doc._id, doc.y);}})"
+def test_view_fun(doc):
+	if doc.get('x') == 1:
+		yield doc['_id'], doc.get('y')
+
+# LOUNGE=fake runs the tests against a FakeLounge instead of a real lounge
+fake_lounge = None
+if os.environ.get("LOUNGE") == "fake":
+	fake_lounge = FakeLounge(shards=128).start()
+	fake_lounge.register_map(test_view_map, test_view_fun)
+	client.db_config['fake'] = fake_lounge.url
+
 def create_test_db(name):
 	try:
 		db = Database.find(name)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+import os
+import sys
+import threading
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import client
+from lounge.client import *
+from lounge.client.uuidpool import UUIDPool, SequentialUUIDs, NoUUIDs, random_uuids
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+class Counter(object):
+	"""A fetch function that counts its calls."""
+	def __init__(self):
+		self.calls = 0
+		self.next = 0
+
+	def __call__(self, count):
+		self.calls += 1
+		uuids = ["%032x" % i for i in range(self.next, self.next + count)]
+		self.next += count
+		return uuids
+
+class UUIDPoolTestCase(TestCase):
+	def setUp(self):
+		self.fake = FakeLounge().start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		Database.create("things")
+
+	def tearDown(self):
+		client.uuid_pools.configure()
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+
+	def testBatches(self):
+		client.uuid_pools.configure(batch_size=100, low_water=0)
+		self.fake.reset_stats()
+		ids = [Thing.create(x=1)._key for i in range(250)]
+		self.assertEqual(len(set(ids)), 250)
+		# 3 fetches and 250 saves
+		self.assertEqual(self.fake.stats['requests'], 253)
+		self.assertEqual(client.uuid_pools.pool(self.fake.url).fetches, 3)
+
+	def testBackgroundRefill(self):
+		fetch = Counter()
+		pool = UUIDPool(fetch, batch_size=10, low_water=5)
+		taken = [pool.next() for i in range(6)]
+		# the refill happens off the caller's thread
+		for thread in threading.enumerate():
+			if thread.getName() == "UUIDPool-refill":
+				thread.join()
+		self.assertEqual(fetch.calls, 2)
+		self.assertEqual(len(pool), 14)
+		taken += [pool.next() for i in range(100)]
+		self.assertEqual(len(set(taken)), 106)
+
+	def testEmptyFetch(self):
+		pool = UUIDPool(lambda count: [], batch_size=10, background=False)
+		self.assertRaises(NoUUIDs, pool.next)
+
+	def testThreads(self):
+		pool = UUIDPool(Counter(), batch_size=50, low_water=10)
+		taken = []
+		def take():
+			for i in range(500):
+				taken.append(pool.next())
+		threads = [threading.Thread(target=take) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(set(taken)), 2000)
+
+	def testFork(self):
+		pool = UUIDPool(random_uuids, batch_size=100, background=False)
+		pool.next()
+		r, w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.write(w, pool.next() + str(pool.fetches))
+			os._exit(0)
+		os.waitpid(pid, 0)
+		child = os.read(r, 64)
+		os.close(r)
+		os.close(w)
+		# the child fetched its own batch instead of sharing the parent's
+		self.assertEqual(child[32:], "1")
+		self.assertNotEqual(child[:32], pool.next())
+
+	def testLocal(self):
+		self.assertRaises(ValueError, client.uuid_pools.configure, mode='bogus')
+		client.uuid_pools.configure(mode='random')
+		self.fake.reset_stats()
+		Thing.create(x=1)
+		self.assertEqual(self.fake.stats['requests'], 1)
+
+		client.uuid_pools.configure(mode='sequential')
+		ids = [Thing.new(x=1)._key for i in range(1000)]
+		self.assertEqual(ids, sorted(ids))
+		self.assertEqual(len(set(ids)), 1000)
+		assert all([len(uuid) == 32 for uuid in ids])
+
+		batch = SequentialUUIDs()(5)
+		self.assertEqual(batch, sorted(batch))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+# prepend the location of the local python-lounge
+sys.path = ['..'] + sys.path
+
+from unittest import TestCase, main
+
+from lounge import client
+from lounge.client import *
+from lounge.client.viewcache import ViewCache, canonical_args
+from lounge.fakelounge import FakeLounge
+
+class Thing(Document):
+	db_name = "things"
+
+BY_COLOR = "def fun(doc):\n\tyield doc['color'], doc['n']"
+
+def wait_for(predicate, timeout=5):
+	"""Poll predicate until it's true or timeout seconds pass."""
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if predicate():
+			return True
+		time.sleep(0.05)
+	return predicate()
+
+class ViewCacheTestCase(TestCase):
+	def setUp(self):
+		self.fake = FakeLounge(shards=2).start()
+		self.old_config = client.db_connectinfo, client.db_prefix
+		client.db_connectinfo, client.db_prefix = self.fake.url, ''
+		Database.create("things")
+		DesignDoc.create("things", "things", language="python", views={"by_color": {"map": BY_COLOR}})
+		for i, color in enumerate(["red", "blue", "red"]):
+			Thing.create("t%d" % i, color=color, n=i)
+		self.fake.reset_stats()
+
+	def tearDown(self):
+		client.db_connectinfo, client.db_prefix = self.old_config
+		self.fake.stop()
+
+	def query(self, cache, **args):
+		return View.execute("things", "things/by_color", args=args, cache=cache).rows
+
+	def testHits(self):
+		cache = ViewCache(ttl=60)
+		rows = self.query(cache, key="red")
+		self.assertEqual(rows.values(), [0, 2])
+		rows[0]._dict["value"] = "changed"
+		# the arguments can be in any order, and everyone gets their own copy
+		self.assertEqual(self.query(cache, key="red").values(), [0, 2])
+		self.query(cache, startkey="a", endkey="z")
+		self.query(cache, endkey="z", startkey="a")
+		self.assertEqual(self.fake.stats['requests'], 2)
+		self.assertEqual((cache.stats['hits'], cache.stats['misses']), (2, 2))
+		self.assertEqual(canonical_args({"b": 1, "a": [2]}), canonical_args({"a": [2], "b": 1}))
+
+		cache.invalidate("things")
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.size(), 0)
+		self.query(cache, key="red")
+		self.assertEqual(self.fake.stats['requests'], 3)
+
+	def testLimits(self):
+		cache = ViewCache(ttl=60, max_entries=2)
+		for color in ["red", "blue", "green", "red"]:
+			self.query(cache, key=color)
+		self.assertEqual(len(cache), 2)
+		self.assertEqual(cache.stats['evictions'], 2)
+		self.assertEqual(cache.stats['hits'], 0)
+
+		cache = ViewCache(ttl=60, max_bytes=1)
+		self.query(cache, key="red")
+		self.assertEqual((len(cache), cache.size()), (0, 0))
+
+	def testExpiry(self):
+		cache = ViewCache(ttl=0.1)
+		self.query(cache, key="red")
+		time.sleep(0.15)
+		self.query(cache, key="red")
+		self.assertEqual(cache.stats['misses'], 2)
+
+	def testStaleWhileRevalidate(self):
+		cache = ViewCache(ttl=0.1, stale_ttl=60)
+		self.query(cache, key="red")
+		Thing.create("t3", color="red", n=3)
+		time.sleep(0.15)
+		# the stale result comes back right away, and a fresh one is fetched
+		self.assertEqual(self.query(cache, key="red").values(), [0, 2])
+		self.assertEqual(cache.stats['stale_hits'], 1)
+		assert wait_for(lambda: cache.stats['refreshes'] == 1)
+		self.assertEqual(self.query(cache, key="red").values(), [0, 2, 3])
+
+	def testStaleBulkDocs(self):
+		# the refresh POSTs the keys again, not the result it got last time
+		cache = ViewCache(ttl=0.1, stale_ttl=60)
+		fetch = lambda: BulkDocView.execute("things", keys=["t1"], cache=cache).rows.ids()
+		self.assertEqual(fetch(), ["t1"])
+		time.sleep(0.15)
+		self.assertEqual(fetch(), ["t1"])
+		assert wait_for(lambda: cache.stats['refreshes'] == 1)
+		self.assertEqual(fetch(), ["t1"])
+
+	def testWatch(self):
+		cache = ViewCache(ttl=60)
+		watcher = cache.watch("things", timeout=1)
+		try:
+			assert wait_for(lambda: cache.stats['invalidations'] == 1)
+			self.assertEqual(self.query(cache, key="red").values(), [0, 2])
+			self.assertEqual(self.query(cache, key="red").values(), [0, 2])
+			Thing.create("t3", color="red", n=3)
+			assert wait_for(lambda: len(cache) == 0)
+			self.assertEqual(self.query(cache, key="red").values(), [0, 2, 3])
+		finally:
+			cache.stop_watching()
+
+if __name__ == "__main__":
+	main()